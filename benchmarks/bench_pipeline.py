@@ -0,0 +1,200 @@
+"""Микробенчмарки стадий отбора аптек на синтетических данных.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_pipeline --profile quick --output bench.json
+    python -m benchmarks.bench_pipeline --profile full --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench_pipeline --profile full --baseline benchmarks/baseline.json --threshold 1.2
+
+Результат - JSON со списком замеров (медиана и минимум по повторам). При сравнении с baseline
+процесс завершается с кодом 1, если какой-либо замер медленнее baseline более чем в threshold раз.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import main
+from benchmarks.synthetic import DEFAULT_NOW, generate_delivery_options, generate_search_response
+
+PROFILES = {
+    "quick": {"pharmacies": [10, 100, 1000], "skus": [1, 10], "analog_depth": [3]},
+    "full": {"pharmacies": [10, 100, 1000, 10000, 50000], "skus": [1, 10, 50], "analog_depth": [1, 5]},
+}
+# Слишком большие сочетания (аптеки x товары) пропускаются, чтобы не упираться в память
+MAX_PRODUCTS = 1_000_000
+USER_LOCATION = (43.238949, 76.889709)
+
+
+def measure(function, repeat, loop, with_gc=False):
+    """Запускает function repeat раз, возвращает список длительностей в секундах.
+    Как и timeit, по умолчанию отключает сборщик мусора на время замера."""
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        if not with_gc:
+            gc.disable()
+        try:
+            started = time.perf_counter()
+            result = function()
+            if asyncio.iscoroutine(result):
+                loop.run_until_complete(result)
+            timings.append(time.perf_counter() - started)
+        finally:
+            gc.enable()
+    return timings
+
+
+def serialization_cases(result):
+    """Сериализация итогового ответа: путь FastAPI по умолчанию (jsonable_encoder + JSONResponse),
+    FastJSONResponse и FastJSONResponse с компактным ответом. Возвращает замеры и размеры тел ответов."""
+    cases = {
+        "serialize[default]": lambda: JSONResponse(content=jsonable_encoder(result)),
+        "serialize[fast]": lambda: main.FastJSONResponse(content=result),
+        "serialize[fast+compact]": lambda: main.FastJSONResponse(content=main.compact_result(result)),
+    }
+    response_bytes = {name: len(function().body) for name, function in cases.items()}
+    return list(cases.items()), response_bytes
+
+
+def pipeline_cases(search_response):
+    """Набор замеров для одного ответа поиска: (имя, функция без аргументов)."""
+    records = main.parse_search_response(search_response)
+    # Колонки движка columnar строятся один раз при разборе ответа (SearchResult.columns)
+    columns = main.AnalogColumns(records)
+    filtered = asyncio.run(main.filter_with_analogs(records))
+    # get_top_closest_pharmacies и best_option меряются на всех кандидатах, а не на 7 после сортировки,
+    # чтобы было видно поведение при больших FULFILLMENT_LIMIT
+    all_candidates = {"list_pharmacies": filtered["filtered_pharmacies"]}
+    shortlist = main.candidates_json(filtered["filtered_pharmacies"])
+    delivery_data = generate_delivery_options(shortlist)
+    lat, lon = USER_LOCATION
+    best = asyncio.run(main.best_option(delivery_data, now=DEFAULT_NOW))
+    serialization, response_bytes = serialization_cases(best)
+
+    def filter_engine(engine):
+        def run():
+            main.ANALOG_ENGINE = engine
+            return main.filter_with_analogs(records, columns)
+        return run
+
+    return [
+        ("parse_search_response", lambda: main.parse_search_response(search_response)),
+        ("analog_columns", lambda: main.AnalogColumns(records)),
+        ("filter_with_analogs[python]", filter_engine("python")),
+        ("filter_with_analogs[columnar]", filter_engine("columnar")),
+        ("sort_pharmacies_by_fulfillment", lambda: main.sort_pharmacies_by_fulfillment(filtered)),
+        ("get_top_closest_pharmacies", lambda: main.get_top_closest_pharmacies(all_candidates, lat, lon)),
+        ("select_candidates", lambda: main.select_candidates(records, lat, lon)),
+        ("candidates_json", lambda: main.candidates_json(filtered["filtered_pharmacies"])),
+        ("best_option", lambda: main.best_option(delivery_data, now=DEFAULT_NOW)),
+        *serialization,
+    ], len(filtered["filtered_pharmacies"]), len(delivery_data), response_bytes
+
+
+def run_benchmarks(profile, repeat, seed, with_gc=False):
+    loop = asyncio.new_event_loop()
+    results = []
+    for pharmacies in profile["pharmacies"]:
+        for skus in profile["skus"]:
+            if pharmacies * skus > MAX_PRODUCTS:
+                continue
+            for analog_depth in profile["analog_depth"]:
+                search_response = generate_search_response(pharmacies, skus, analog_depth, seed=seed)
+                cases, candidates, delivery_options, response_bytes = pipeline_cases(search_response)
+                for name, function in cases:
+                    timings = measure(function, repeat, loop, with_gc)
+                    results.append({
+                        "benchmark": name,
+                        "pharmacies": pharmacies,
+                        "skus": skus,
+                        "analog_depth": analog_depth,
+                        "candidates": candidates,
+                        "delivery_options": delivery_options,
+                        "repeat": repeat,
+                        "median_s": statistics.median(timings),
+                        "min_s": min(timings),
+                    })
+                    if name in response_bytes:
+                        results[-1]["response_bytes"] = response_bytes[name]
+                    print(f"{name:32} pharmacies={pharmacies:<6} skus={skus:<3} depth={analog_depth} "
+                          f"median={results[-1]['median_s'] * 1000:9.3f} ms", file=sys.stderr)
+    main.ANALOG_ENGINE = "python"
+    loop.close()
+    return results
+
+
+def result_key(result):
+    return result["benchmark"], result["pharmacies"], result["skus"], result["analog_depth"]
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """Возвращает список регрессий: замеры, медиана которых хуже baseline более чем в threshold раз."""
+    baseline_by_key = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        reference = baseline_by_key.get(result_key(result))
+        if reference is None or reference["median_s"] <= 0:
+            continue
+        ratio = result["median_s"] / reference["median_s"]
+        result["baseline_median_s"] = reference["median_s"]
+        result["ratio"] = round(ratio, 3)
+        if ratio > threshold:
+            regressions.append(result)
+    return regressions
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=PROFILES, default="quick")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Куда записать JSON с результатами (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON с результатами предыдущего запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Допустимое замедление относительно baseline")
+    parser.add_argument("--save-baseline", help="Сохранить результаты как новый baseline")
+    parser.add_argument("--with-gc", action="store_true", help="Не отключать сборщик мусора во время замеров")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("main").setLevel(logging.WARNING)
+    results = run_benchmarks(PROFILES[args.profile], args.repeat, args.seed, args.with_gc)
+    report = {
+        "profile": args.profile,
+        "seed": args.seed,
+        "with_gc": args.with_gc,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare_with_baseline(results, json.load(file), args.threshold)
+        report["regressions"] = [result_key(result) for result in regressions]
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as file:
+            file.write(output)
+
+    for result in regressions:
+        print(f"REGRESSION {result['benchmark']} pharmacies={result['pharmacies']} skus={result['skus']} "
+              f"depth={result['analog_depth']}: {result['ratio']}x baseline", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,254 @@
+"""Локальные заглушки URL_SEARCH и URL_PRICE для нагрузочного тестирования.
+
+Запуск из корня репозитория:
+    FAKE_SEARCH_LATENCY=lognormal:150:0.5 FAKE_PRICE_ERROR_RATE=0.02 \\
+        uvicorn benchmarks.fake_upstreams:app --port 8765
+
+    URL_SEARCH=http://127.0.0.1:8765/search URL_PRICE=http://127.0.0.1:8765/price uvicorn main:app
+
+Все настройки читаются из переменных окружения FAKE_<ИМЯ> (см. CONFIG_DEFAULTS). Задержка задается
+строкой "fixed:<мс>", "uniform:<от мс>:<до мс>" или "lognormal:<медиана мс>:<sigma>". Доля ошибок
+(HTTP 500) и таймаутов (ответ задерживается на FAKE_TIMEOUT_SECONDS) задается для каждого апстрима
+отдельно. Настройки можно поменять на лету через POST /config, счетчики вызовов доступны на
+GET /stats и сбрасываются через POST /stats/reset.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from benchmarks.synthetic import generate_delivery_quote, generate_search_response, pharmacy_index, pharmacy_location
+
+CONFIG_DEFAULTS = {
+    # "synthetic" - ответ из benchmarks.synthetic, "mock" - фиксированный ответ /search_medicines из main.py
+    "search_data": "synthetic",
+    "pharmacies": 500,
+    "analog_depth": 3,
+    "stock_ratio": 0.8,
+    # Балласт в source каждой аптеки, байт - для управления размером ответа поиска
+    "pad_bytes": 0,
+    "delivery_options": 2,
+    # "random" - случайные котировки, "distance" - цена и время растут с расстоянием от аптеки до адреса
+    # (аптеки при этом стоят на одних и тех же местах для всех корзин)
+    "price_model": "random",
+    "seed": 0,
+    # Момент, относительно которого генерируются часы работы аптек: "real" - текущее время Asia/Almaty
+    # (с точностью до минуты), иначе фиксированное местное время в ISO-формате, например "2024-10-21T20:30"
+    "now": "real",
+    "search_latency": "lognormal:120:0.5",
+    "price_latency": "lognormal:80:0.6",
+    "search_error_rate": 0.0,
+    "price_error_rate": 0.0,
+    "search_timeout_rate": 0.0,
+    "price_timeout_rate": 0.0,
+    "timeout_seconds": 30.0,
+}
+# Сколько сериализованных ответов поиска держать в памяти, чтобы генерация не была узким местом
+SEARCH_RESPONSE_CACHE_SIZE = 64
+ALMATY_TZ = pytz.timezone("Asia/Almaty")
+
+
+def load_config(environ=os.environ):
+    config = {}
+    for name, default in CONFIG_DEFAULTS.items():
+        value = environ.get(f"FAKE_{name.upper()}")
+        config[name] = default if value is None else type(default)(value)
+    return config
+
+
+def parse_latency(spec):
+    """Разбирает описание распределения задержки, возвращает функцию rng -> секунды."""
+    kind, *params = spec.split(":")
+    params = [float(param) for param in params]
+    if kind == "fixed" and len(params) == 1:
+        return lambda rng: params[0] / 1000
+    if kind == "uniform" and len(params) == 2:
+        return lambda rng: rng.uniform(params[0], params[1]) / 1000
+    if kind == "lognormal" and len(params) == 2:
+        mu = math.log(max(params[0], 1e-3))
+        return lambda rng: rng.lognormvariate(mu, params[1]) / 1000
+    raise ValueError(f"Unsupported latency spec: {spec!r}")
+
+
+class UpstreamBehaviour:
+    """Задержки и сбои одного апстрима плюс счетчики исходов."""
+
+    def __init__(self, name, config, rng):
+        self.name = name
+        self.rng = rng
+        self.configure(config)
+        self.reset()
+
+    def configure(self, config):
+        self.latency = parse_latency(config[f"{self.name}_latency"])
+        self.error_rate = config[f"{self.name}_error_rate"]
+        self.timeout_rate = config[f"{self.name}_timeout_rate"]
+        self.timeout_seconds = config["timeout_seconds"]
+
+    def reset(self):
+        self.calls = 0
+        self.outcomes = {"ok": 0, "error": 0, "timeout": 0}
+        self.response_bytes = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def respond(self, build_body):
+        """Имитирует обработку запроса: задержка, затем ошибка, зависание или ответ build_body()."""
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            roll = self.rng.random()
+            if roll < self.timeout_rate:
+                self.outcomes["timeout"] += 1
+                await asyncio.sleep(self.timeout_seconds)
+                return JSONResponse(content={"error": "Injected upstream timeout"}, status_code=504)
+            await asyncio.sleep(self.latency(self.rng))
+            if roll < self.timeout_rate + self.error_rate:
+                self.outcomes["error"] += 1
+                return JSONResponse(content={"error": "Injected upstream error"}, status_code=500)
+            body = await build_body()
+            self.outcomes["ok"] += 1
+            self.response_bytes += len(body)
+            return Response(content=body, media_type="application/json")
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {"calls": self.calls, **self.outcomes, "response_bytes": self.response_bytes,
+                "in_flight": self.in_flight, "max_in_flight": self.max_in_flight}
+
+
+app = FastAPI()
+config = load_config()
+rng = random.Random(config["seed"])
+upstreams = {name: UpstreamBehaviour(name, config, rng) for name in ("search", "price")}
+search_responses = OrderedDict()
+
+
+def stable_seed(*parts):
+    digest = hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def current_now():
+    if config["now"] == "real":
+        return datetime.now(ALMATY_TZ).replace(second=0, microsecond=0)
+    return ALMATY_TZ.localize(datetime.fromisoformat(config["now"]))
+
+
+async def load_search_data(city, basket, now):
+    if config["search_data"] == "mock":
+        import main
+        return json.loads((await main.search_medicines()).body)
+    return generate_search_response(
+        pharmacies=config["pharmacies"],
+        analog_depth=config["analog_depth"],
+        stock_ratio=config["stock_ratio"],
+        seed=stable_seed(config["seed"], city, basket),
+        now=now,
+        basket=basket,
+        layout_seed=config["seed"] if config["price_model"] == "distance" else None,
+    )
+
+
+def quote_distance_km(source_code, dst):
+    """Расстояние от синтетической аптеки до адреса доставки или None, если модель цен случайная."""
+    index = pharmacy_index(source_code)
+    if config["price_model"] != "distance" or index is None or not dst:
+        return None
+    lat, lon = pharmacy_location(config["seed"], index)
+    dlat = math.radians(dst["lat"] - lat)
+    dlon = math.radians(dst["lng"] - lon) * math.cos(math.radians(lat))
+    return 6371.0 * math.hypot(dlat, dlon)
+
+
+async def build_search_body(city, basket):
+    """Сериализованный ответ поиска; одна и та же корзина в одном городе в одну минуту всегда дает один и тот же
+    ответ (часы работы аптек сдвигаются вместе с FAKE_NOW)."""
+    now = current_now()
+    key = (city, json.dumps(basket, sort_keys=True), now)
+    body = search_responses.get(key)
+    if body is not None:
+        search_responses.move_to_end(key)
+        return body
+
+    data = await load_search_data(city, basket, now)
+    if config["pad_bytes"]:
+        padding = "x" * config["pad_bytes"]
+        for pharmacy in data["result"]:
+            pharmacy["source"]["padding"] = padding
+
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    search_responses[key] = body
+    while len(search_responses) > SEARCH_RESPONSE_CACHE_SIZE:
+        search_responses.popitem(last=False)
+    return body
+
+
+@app.post("/search")
+async def search(request: Request):
+    city = request.query_params.get("city", "")
+    basket = await request.json()
+    return await upstreams["search"].respond(lambda: build_search_body(city, basket))
+
+
+@app.post("/price")
+async def price(request: Request):
+    payload = await request.json()
+
+    async def build_body():
+        # Котировка зависит только от аптеки и адреса, как у настоящего апстрима
+        quote_rng = random.Random(stable_seed(config["seed"], payload.get("source_code"), payload.get("dst")))
+        distance_km = quote_distance_km(payload.get("source_code"), payload.get("dst"))
+        quote = generate_delivery_quote(quote_rng, config["delivery_options"], distance_km)
+        return json.dumps(quote).encode("utf-8")
+
+    return await upstreams["price"].respond(build_body)
+
+
+@app.get("/stats")
+async def stats():
+    return {name: upstream.stats() for name, upstream in upstreams.items()}
+
+
+@app.post("/stats/reset")
+async def reset_stats():
+    for upstream in upstreams.values():
+        upstream.reset()
+    return {"status": "ok"}
+
+
+@app.get("/config")
+async def get_config():
+    return config
+
+
+@app.post("/config")
+async def update_config(request: Request):
+    """Частичное обновление настроек, например {"price_error_rate": 0.1}."""
+    updates = await request.json()
+    unknown = set(updates) - set(CONFIG_DEFAULTS)
+    if unknown:
+        return JSONResponse(content={"error": f"Unknown settings: {sorted(unknown)}"}, status_code=400)
+    try:
+        new_config = {**config, **{name: type(CONFIG_DEFAULTS[name])(value) for name, value in updates.items()}}
+        for name in upstreams:
+            parse_latency(new_config[f"{name}_latency"])
+        if new_config["now"] != "real":
+            datetime.fromisoformat(new_config["now"])
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    config.update(new_config)
+    for upstream in upstreams.values():
+        upstream.configure(config)
+    search_responses.clear()
+    return config
@@ -0,0 +1,215 @@
+"""Нагрузочный тест /best_analog на локальных заглушках апстримов (benchmarks.fake_upstreams).
+
+Запуск из корня репозитория:
+    python -m benchmarks.loadtest --concurrency 20 --duration 30
+    python -m benchmarks.loadtest --requests 2000 --baskets 50 \\
+        --upstream-env FAKE_PHARMACIES=5000 --upstream-env FAKE_PRICE_ERROR_RATE=0.05 \\
+        --app-env PRICE_CONCURRENCY=20
+
+Скрипт поднимает заглушки и само приложение отдельными процессами uvicorn (или использует уже
+запущенные, если заданы --app-url и --upstream-url), гоняет запросы с заданной конкурентностью и
+печатает JSON: пропускную способность, p50/p95/p99 задержки, коды ответов и число вызовов апстримов.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import httpx
+
+from benchmarks.synthetic import generate_basket
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY_TIMEOUT = 30.0
+
+
+def parse_env_overrides(pairs):
+    overrides = {}
+    for pair in pairs or []:
+        name, separator, value = pair.partition("=")
+        if not separator:
+            raise SystemExit(f"Expected NAME=VALUE, got {pair!r}")
+        overrides[name] = value
+    return overrides
+
+
+def spawn_uvicorn(target, port, env, log_file):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", target, "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=REPO_ROOT, env={**os.environ, **env}, stdout=log_file, stderr=log_file,
+    )
+
+
+def wait_ready(url, process=None, timeout=READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise SystemExit(f"Process for {url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.RequestError:
+            pass
+        time.sleep(0.1)
+    raise SystemExit(f"{url} is not ready after {timeout} s")
+
+
+@contextmanager
+def servers(args):
+    """Поднимает заглушки и приложение, если их адреса не переданы явно. Возвращает (app_url, upstream_url)."""
+    processes = []
+    log_file = open(args.log, "a") if args.log else subprocess.DEVNULL
+    try:
+        upstream_url = args.upstream_url
+        if upstream_url is None:
+            upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+            processes.append(spawn_uvicorn("benchmarks.fake_upstreams:app", args.upstream_port,
+                                           parse_env_overrides(args.upstream_env), log_file))
+            wait_ready(f"{upstream_url}/stats", processes[-1])
+
+        app_url = args.app_url
+        if app_url is None:
+            app_url = f"http://127.0.0.1:{args.app_port}"
+            app_env = {"URL_SEARCH": f"{upstream_url}/search", "URL_PRICE": f"{upstream_url}/price",
+                       **parse_env_overrides(args.app_env)}
+            processes.append(spawn_uvicorn("main:app", args.app_port, app_env, log_file))
+            wait_ready(f"{app_url}/cache_stats", processes[-1])
+
+        yield app_url, upstream_url
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if log_file is not subprocess.DEVNULL:
+            log_file.close()
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по методу ближайшего ранга."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def run_load(app_url, baskets, concurrency, total_requests, duration, timeout):
+    """Гоняет POST /best_analog с concurrency параллельными клиентами, пока не выполнено total_requests
+    запросов или не истекло duration секунд. Возвращает список (секунды, статус)."""
+    samples = []
+    issued = 0
+    deadline = time.monotonic() + duration if duration else None
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=app_url, timeout=timeout, limits=limits) as client:
+        async def worker():
+            nonlocal issued
+            while True:
+                if total_requests is not None and issued >= total_requests:
+                    return
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                basket = baskets[issued % len(baskets)]
+                issued += 1
+                started = time.perf_counter()
+                try:
+                    response = await client.post("/best_analog", json=basket)
+                    status = response.status_code
+                except httpx.TimeoutException:
+                    status = "timeout"
+                except httpx.RequestError:
+                    status = "connection_error"
+                samples.append((time.perf_counter() - started, status))
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(seconds for seconds, _ in samples)
+    to_ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        "requests": len(samples),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else None,
+        "statuses": dict(Counter(str(status) for _, status in samples)),
+        "latency_ms": {
+            "mean": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p95": to_ms(percentile(latencies, 0.95)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, help="Сколько запросов выполнить (по умолчанию ограничено --duration)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Длительность теста, секунд")
+    parser.add_argument("--warmup", type=int, default=0, help="Запросов на прогрев, не входят в отчет")
+    parser.add_argument("--baskets", type=int, default=20, help="Сколько разных корзин гонять по кругу")
+    parser.add_argument("--skus", type=int, default=5, help="Товаров в корзине")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Таймаут одного запроса клиента, секунд")
+    parser.add_argument("--app-url", help="Уже запущенное приложение вместо собственного процесса")
+    parser.add_argument("--upstream-url", help="Уже запущенные заглушки вместо собственного процесса")
+    parser.add_argument("--app-port", type=int, default=8810)
+    parser.add_argument("--upstream-port", type=int, default=8811)
+    parser.add_argument("--app-env", action="append", metavar="NAME=VALUE", help="Переменные окружения приложения")
+    parser.add_argument("--upstream-env", action="append", metavar="NAME=VALUE",
+                        help="Настройки заглушек, например FAKE_PRICE_LATENCY=uniform:50:400")
+    parser.add_argument("--log", help="Файл для вывода запущенных процессов (по умолчанию выводится в никуда)")
+    parser.add_argument("--output", help="Куда записать JSON с результатами (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    baskets = [generate_basket(args.skus, seed=args.seed + index) for index in range(args.baskets)]
+    duration = None if args.requests is not None else args.duration
+
+    with servers(args) as (app_url, upstream_url):
+        if args.warmup:
+            asyncio.run(run_load(app_url, baskets, args.concurrency, args.warmup, None, args.timeout))
+        httpx.post(f"{upstream_url}/stats/reset").raise_for_status()
+
+        started = time.perf_counter()
+        samples = asyncio.run(run_load(app_url, baskets, args.concurrency, args.requests, duration, args.timeout))
+        elapsed = time.perf_counter() - started
+
+        upstream_stats = httpx.get(f"{upstream_url}/stats").json()
+        upstream_config = httpx.get(f"{upstream_url}/config").json()
+        cache_stats = httpx.get(f"{app_url}/cache_stats").json()
+
+    report = {
+        "concurrency": args.concurrency,
+        "baskets": args.baskets,
+        "skus": args.skus,
+        **summarize(samples, elapsed),
+        "upstream_calls": {
+            name: {**stats, "per_request": round(stats["calls"] / len(samples), 3) if samples else None}
+            for name, stats in upstream_stats.items()
+        },
+        "upstream_config": upstream_config,
+        "app_caches": cache_stats,
+    }
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,196 @@
+"""Генератор синтетических ответов URL_SEARCH и URL_PRICE для бенчмарков и нагрузочных тестов.
+
+Все данные детерминированы seed'ом: одинаковые параметры дают одинаковый ответ.
+"""
+import math
+import random
+from datetime import datetime, timedelta
+
+import pytz
+
+ALMATY_CENTER = (43.238949, 76.889709)
+DEFAULT_NOW = pytz.timezone("Asia/Almaty").localize(datetime(2024, 10, 21, 20, 30))
+
+# Доли аптек: круглосуточные, открытые, закрывающиеся в течение часа, закрытые
+DEFAULT_HOURS_MIX = (0.2, 0.6, 0.1, 0.1)
+
+NETWORKS = ["melissa", "apteka_so_sklada", "europharma", "sadykhan", "biosfera"]
+MANUFACTURERS = ["ЛеКос ТОО", "Фарева Амбуаз", "Ajanta Pharma Ltd", "Нобел АФФ", "Химфарм"]
+
+
+def format_upstream_time(value):
+    return value.astimezone(pytz.UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def random_point(rng, center=ALMATY_CENTER, radius_km=15.0):
+    """Случайная точка в круге радиуса radius_km вокруг center."""
+    distance = radius_km * math.sqrt(rng.random())
+    bearing = rng.random() * 2 * math.pi
+    lat = center[0] + distance / 111.2 * math.cos(bearing)
+    lon = center[1] + distance / (111.2 * math.cos(math.radians(center[0]))) * math.sin(bearing)
+    return round(lat, 6), round(lon, 6)
+
+
+def pharmacy_location(layout_seed, index, center=ALMATY_CENTER, radius_km=15.0):
+    """Координаты аптеки index в городе layout_seed - не зависят от корзины."""
+    return random_point(random.Random(f"{layout_seed}:{index}"), center, radius_km)
+
+
+def pharmacy_index(code):
+    """Номер синтетической аптеки по ее коду или None для чужих кодов."""
+    prefix, _, index = (code or "").rpartition("_")
+    return int(index) if prefix == "synthetic_pharmacy" and index.isdigit() else None
+
+
+def generate_source(rng, index, now=DEFAULT_NOW, hours_mix=DEFAULT_HOURS_MIX, center=ALMATY_CENTER, radius_km=15.0,
+                    location=None):
+    lat, lon = location or random_point(rng, center, radius_km)
+    code = f"synthetic_pharmacy_{index}"
+    source = {
+        "code": code,
+        "name": f"Аптека {index}",
+        "city": "Алматы",
+        "address": f"ул. Синтетическая, {index}",
+        "lat": lat,
+        "lon": lon,
+        "network_code": rng.choice(NETWORKS),
+        "with_reserve": rng.random() < 0.5,
+        "payment_on_site": True,
+        "kaspi_red": False,
+        "source_tags": [{"id": 1045, "meta": "5", "color": "#000000", "name": "public_client_time_to_confirmation"}],
+        "working_today": True,
+        "payment_by_card": rng.random() < 0.5,
+    }
+
+    kind = rng.choices(["round_the_clock", "open", "closing_soon", "closed"], weights=hours_mix)[0]
+    if kind == "round_the_clock":
+        source["opening_hours"] = "Круглосуточно"
+        return source
+
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if kind == "open":
+        opens, closes = today + timedelta(hours=8), now + timedelta(minutes=rng.randint(90, 180))
+    elif kind == "closing_soon":
+        opens, closes = today + timedelta(hours=8), now + timedelta(minutes=rng.randint(5, 55))
+    else:
+        opens, closes = today + timedelta(hours=8), now - timedelta(minutes=rng.randint(5, 120))
+    source["opening_hours"] = f"Пн-Вс: {opens:%H:%M}-{closes:%H:%M}"
+    source["opens_at"] = format_upstream_time(opens)
+    source["closes_at"] = format_upstream_time(closes)
+    return source
+
+
+def generate_product(rng, code, sku_index, quantity_desired, in_stock, analog_depth, sku=None):
+    base_price = rng.randint(5, 300) * 100
+    sku = sku or f"sku-{sku_index:04d}"
+    product = {
+        "source_code": code,
+        "sku": sku,
+        "name": f"Препарат {sku_index}",
+        "base_price": base_price,
+        "price_with_warehouse_discount": base_price,
+        "warehouse_discount": 0,
+        "quantity": rng.randint(quantity_desired, quantity_desired + 10) if in_stock else rng.randint(0, quantity_desired - 1),
+        "quantity_desired": quantity_desired,
+        "diff": 0,
+        "avg_price": 0,
+        "min_price": 0,
+        "pp_packing": "1 шт.",
+        "manufacturer_id": rng.choice(MANUFACTURERS),
+        "recipe_needed": rng.random() < 0.3,
+        "strong_recipe": False,
+    }
+    if analog_depth:
+        product["analogs"] = [
+            {
+                "source_code": code,
+                "sku": f"{sku}-analog-{analog_index}",
+                "name": f"Аналог {analog_index} препарата {sku_index}",
+                "base_price": rng.randint(5, 300) * 100,
+                "price_with_warehouse_discount": base_price,
+                "warehouse_discount": 0,
+                "quantity": rng.randint(0, quantity_desired + 5),
+                "quantity_desired": quantity_desired,
+                "diff": 0,
+                "avg_price": 0,
+                "min_price": 0,
+                "pp_packing": "1 шт.",
+                "manufacturer_id": rng.choice(MANUFACTURERS),
+                "recipe_needed": False,
+                "strong_recipe": False,
+            }
+            for analog_index in range(rng.randint(1, analog_depth))
+        ]
+    return product
+
+
+def generate_search_response(pharmacies=100, skus=5, analog_depth=3, stock_ratio=0.8, hours_mix=DEFAULT_HOURS_MIX,
+                             seed=0, now=DEFAULT_NOW, center=ALMATY_CENTER, radius_km=15.0, basket=None,
+                             layout_seed=None):
+    """Ответ URL_SEARCH: pharmacies аптек, в каждой skus товаров (с вероятностью stock_ratio в наличии)
+    и до analog_depth аналогов на товар. Если передан basket (тело запроса к URL_SEARCH - список
+    {"sku", "count_desired"}), товары и их количества берутся из него. Если передан layout_seed,
+    координаты аптек берутся из pharmacy_location и одинаковы для всех корзин."""
+    rng = random.Random(seed)
+    if basket is not None:
+        skus = len(basket)
+        sku_names = [item["sku"] for item in basket]
+        quantities = [max(1, item["count_desired"]) for item in basket]
+    else:
+        sku_names = [None] * skus
+        quantities = [rng.randint(1, 3) for _ in range(skus)]
+    result = []
+    for index in range(pharmacies):
+        location = None if layout_seed is None else pharmacy_location(layout_seed, index, center, radius_km)
+        source = generate_source(rng, index, now, hours_mix, center, radius_km, location)
+        products = [
+            generate_product(rng, source["code"], sku_index, quantities[sku_index], rng.random() < stock_ratio,
+                             analog_depth, sku_names[sku_index])
+            for sku_index in range(skus)
+        ]
+        result.append({
+            "source": source,
+            "products": products,
+            "total_sum": sum(product["base_price"] * product["quantity_desired"] for product in products),
+            "avg_sum": 0,
+            "min_sum": 0,
+        })
+    return {"result": result}
+
+
+def generate_basket(skus=5, seed=0):
+    """Тело запроса /best_analog для корзины из skus товаров."""
+    rng = random.Random(seed)
+    return {
+        "city": "synthetic-city",
+        "skus": [{"sku": f"sku-{sku_index:04d}", "count_desired": rng.randint(1, 3)} for sku_index in range(skus)],
+        "address": dict(zip(("lat", "lng"), random_point(rng, radius_km=10.0))),
+    }
+
+
+def generate_delivery_quote(rng, options=2, distance_km=None):
+    """Ответ URL_PRICE со списком вариантов доставки. Если передано расстояние от аптеки до адреса,
+    цена и время растут с расстоянием (с шумом), иначе случайны."""
+    delivery = []
+    for option_index in range(options):
+        if distance_km is None:
+            price, eta = rng.randint(3, 20) * 100, rng.randint(20, 180)
+        else:
+            price = int(round((300 + 90 * distance_km) * rng.uniform(0.85, 1.15), -1))
+            eta = int(15 + 6 * distance_km * rng.uniform(0.8, 1.2) + rng.randint(0, 20))
+        delivery.append({"provider": f"provider_{option_index}", "price": price, "eta": eta})
+    return {"status": "success", "result": {"delivery": delivery}}
+
+
+def generate_delivery_options(pharmacies, options=2, seed=0):
+    """Вход best_option: варианты доставки для списка аптек-кандидатов."""
+    rng = random.Random(seed)
+    delivery_data = []
+    for pharmacy in pharmacies:
+        for option in generate_delivery_quote(rng, options)["result"]["delivery"]:
+            delivery_data.append({
+                "pharmacy": pharmacy,
+                "total_price": pharmacy.get("total_sum", 0) + option["price"],
+                "delivery_option": option,
+            })
+    return delivery_data
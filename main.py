@@ -1,14 +1,34 @@
+import asyncio
+import bisect
 import json
 import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import heapq
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from itertools import chain
+from operator import attrgetter, itemgetter
 from fastapi import FastAPI, Request
 import httpx
+import httpcore
 import logging
 import math
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from datetime import datetime, timedelta
 import pytz
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # без orjson ответы сериализуются стандартным json
+    orjson = None
 
 load_dotenv()
 
@@ -16,505 +36,3655 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 app = FastAPI()
 
-URL_SEARCH = os.getenv("URL_SEARCH")
-URL_PRICE = os.getenv("URL_PRICE")
+URL_SEARCH = os.getenv("URL_SEARCH")
+URL_PRICE = os.getenv("URL_PRICE")
+
+
+def env_bool(name, default=False):
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
+
+# Настройки пула соединений к апстримам (URL_SEARCH / URL_PRICE)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = env_bool("HTTP2_ENABLED")
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+# После отмененных посреди обмена запросов клиент пересоздается не чаще раза в интервал (0 - не пересоздавать)
+HTTP_CLIENT_RECYCLE_INTERVAL = float(os.getenv("HTTP_CLIENT_RECYCLE_INTERVAL", "10"))
+UPSTREAM_TIMEOUTS = {
+    "search": float(os.getenv("SEARCH_TIMEOUT", "5")),
+    "price": float(os.getenv("PRICE_TIMEOUT", "5")),
+}
+
+# Параллельный запрос котировок доставки
+PRICE_CONCURRENCY = int(os.getenv("PRICE_CONCURRENCY", "10"))
+PRICE_QUOTE_TIMEOUT = float(os.getenv("PRICE_QUOTE_TIMEOUT", "8"))
+PRICE_PARTIAL_RESULTS = env_bool("PRICE_PARTIAL_RESULTS", True)
+
+# Бюджет времени на весь запрос /best_analog (секунды, 0 - без ограничения). Клиент может задать свой
+# бюджет заголовком REQUEST_DEADLINE_HEADER, но не больше REQUEST_DEADLINE_MAX. Запросы к апстримам
+# получают оставшийся бюджет как таймаут, опоздавшие котировки отбрасываются.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "10"))
+REQUEST_DEADLINE_MAX = float(os.getenv("REQUEST_DEADLINE_MAX", "30"))
+REQUEST_DEADLINE_HEADER = "X-Request-Deadline"
+
+# Хеджирование запросов к URL_PRICE: если ответа нет дольше перцентиля PRICE_HEDGE_PERCENTILE
+# недавних задержек, отправляется дублирующий запрос и используется первый ответ
+PRICE_HEDGE_ENABLED = env_bool("PRICE_HEDGE_ENABLED")
+PRICE_HEDGE_PERCENTILE = float(os.getenv("PRICE_HEDGE_PERCENTILE", "95"))
+PRICE_HEDGE_MIN_DELAY = float(os.getenv("PRICE_HEDGE_MIN_DELAY", "0.05"))
+PRICE_HEDGE_INITIAL_DELAY = float(os.getenv("PRICE_HEDGE_INITIAL_DELAY", "1"))  # пока мало замеров
+PRICE_HEDGE_MIN_SAMPLES = int(os.getenv("PRICE_HEDGE_MIN_SAMPLES", "20"))
+UPSTREAM_LATENCY_WINDOW = int(os.getenv("UPSTREAM_LATENCY_WINDOW", "200"))
+
+# Размыкатель цепи (circuit breaker) для каждого апстрима: при доле ошибок выше порога среди последних
+# CIRCUIT_BREAKER_WINDOW вызовов запросы отклоняются сразу, через CIRCUIT_BREAKER_OPEN_SECONDS
+# пропускаются пробные запросы (half-open), успешная проба замыкает цепь
+CIRCUIT_BREAKER_ENABLED = env_bool("CIRCUIT_BREAKER_ENABLED", True)
+CIRCUIT_BREAKER_WINDOW = int(os.getenv("CIRCUIT_BREAKER_WINDOW", "50"))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", "20"))
+CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv("CIRCUIT_BREAKER_ERROR_RATE", "0.5"))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "30"))
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_PROBES", "1"))
+
+# Что делать, если котировку аптеки получить не удалось: варианты через запятую, пробуются по порядку.
+# "cache" - последняя успешная котировка не старше PRICE_FALLBACK_TTL, "drop" - исключить аптеку.
+# Пустое значение - вернуть ошибку, как раньше.
+PRICE_FALLBACKS = [name.strip() for name in os.getenv("PRICE_FALLBACK", "").split(",") if name.strip()]
+PRICE_FALLBACK_TTL = float(os.getenv("PRICE_FALLBACK_TTL", "600"))
+PRICE_FALLBACK_MAX_BYTES = int(os.getenv("PRICE_FALLBACK_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Оценка котировок по накопленным наблюдениям: ранжируются QUOTE_ESTIMATOR_CANDIDATES ближайших аптек,
+# в URL_PRICE запрашиваются только те (не больше QUOTE_ESTIMATOR_MAX_QUOTES), что могут оказаться
+# самыми дешевыми или самыми быстрыми
+QUOTE_ESTIMATOR_ENABLED = env_bool("QUOTE_ESTIMATOR_ENABLED")
+QUOTE_ESTIMATOR_CANDIDATES = int(os.getenv("QUOTE_ESTIMATOR_CANDIDATES", "7"))
+QUOTE_ESTIMATOR_MAX_QUOTES = int(os.getenv("QUOTE_ESTIMATOR_MAX_QUOTES", "3"))
+QUOTE_ESTIMATOR_MIN_SAMPLES = int(os.getenv("QUOTE_ESTIMATOR_MIN_SAMPLES", "200"))  # до этого - обычный шорт-лист
+QUOTE_ESTIMATOR_WINDOW = int(os.getenv("QUOTE_ESTIMATOR_WINDOW", "5000"))  # последних наблюдений для обучения
+QUOTE_ESTIMATOR_REFIT_INTERVAL = float(os.getenv("QUOTE_ESTIMATOR_REFIT_INTERVAL", "30"))
+QUOTE_ESTIMATOR_MARGIN = float(os.getenv("QUOTE_ESTIMATOR_MARGIN", "2"))  # запас, в средних ошибках оценки
+# Доля запросов, где котируются все ранжированные аптеки, чтобы измерить, сколько точности теряет оценка
+QUOTE_ESTIMATOR_SHADOW_RATE = float(os.getenv("QUOTE_ESTIMATOR_SHADOW_RATE", "0.05"))
+
+# Кэш результатов поиска (URL_SEARCH)
+SEARCH_CACHE_ENABLED = env_bool("SEARCH_CACHE_ENABLED", True)
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Stale-while-revalidate: еще столько секунд после TTL устаревший ответ отдается сразу, а обновляется в фоне,
+# не чаще раза в SEARCH_STALE_REFRESH_INTERVAL по ключу (0 - выключено)
+SEARCH_STALE_TTL = float(os.getenv("SEARCH_STALE_TTL", "0"))
+SEARCH_STALE_REFRESH_INTERVAL = float(os.getenv("SEARCH_STALE_REFRESH_INTERVAL", "5"))
+
+# Кэш котировок доставки (URL_PRICE); адрес пользователя округляется до ячейки geohash
+QUOTE_CACHE_ENABLED = env_bool("QUOTE_CACHE_ENABLED", True)
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "30"))
+QUOTE_CACHE_MAX_BYTES = int(os.getenv("QUOTE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+QUOTE_CACHE_GEOHASH_PRECISION = int(os.getenv("QUOTE_CACHE_GEOHASH_PRECISION", "7"))  # 7 знаков ~ 150 м
+
+# Общий для всех воркеров хоста кэш (SQLite в режиме WAL): второй уровень под кэшами поиска и котировок
+# плюс расписания аптек, чтобы новый воркер стартовал прогретым
+SHARED_CACHE_ENABLED = env_bool("SHARED_CACHE_ENABLED")
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "/tmp/fast_delivery_analogs_cache.sqlite3")
+SHARED_CACHE_MAX_BYTES = int(os.getenv("SHARED_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+SHARED_CACHE_MMAP_BYTES = int(os.getenv("SHARED_CACHE_MMAP_BYTES", str(256 * 1024 * 1024)))
+SHARED_CACHE_PRUNE_INTERVAL = float(os.getenv("SHARED_CACHE_PRUNE_INTERVAL", "10"))
+SHARED_CACHE_BUSY_TIMEOUT = float(os.getenv("SHARED_CACHE_BUSY_TIMEOUT", "1"))
+SHARED_SCHEDULE_TTL = float(os.getenv("SHARED_SCHEDULE_TTL", str(24 * 3600)))
+
+# Прогрев при старте: ответы поиска для известных и популярных корзин (а через них координаты и расписания
+# аптек по городам) загружаются до того, как /ready начнет отвечать 200, и обновляются в фоне
+WARMUP_ENABLED = env_bool("WARMUP_ENABLED")
+WARMUP_BASKETS_FILE = os.getenv("WARMUP_BASKETS_FILE", "")  # JSON: [{"city": ..., "skus": [...]}, ...]
+WARMUP_POPULAR_BASKETS = int(os.getenv("WARMUP_POPULAR_BASKETS", "20"))  # самых частых корзин в обновлении
+WARMUP_REFRESH_INTERVAL = float(os.getenv("WARMUP_REFRESH_INTERVAL", "300"))  # 0 - без фонового обновления
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "60"))  # после этого /ready отвечает 200 в любом случае
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+
+# Сессии корзины (/best_analog/session): правка одного товара пересчитывает только его столбец
+SESSION_TTL = float(os.getenv("SESSION_TTL", "900"))  # сессия живет с последней правки
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Перезапрашивать котировку аптеки, оставшейся в шорт-листе, если изменился ее набор товаров для доставки
+SESSION_REQUOTE_CHANGED_ITEMS = env_bool("SESSION_REQUOTE_CHANGED_ITEMS")
+SESSION_ID_HEADER = "X-Session-Id"
+
+# Движок подбора аналогов: "python" (построчный) или "columnar" (NumPy)
+ANALOG_ENGINE = os.getenv("ANALOG_ENGINE", "python")
+
+# Режим конвейера отбора: "staged" (стадии по очереди), "streaming" (однопроходный отбор) или
+# "pipelined" (однопроходный отбор с упреждающими запросами котировок)
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "staged")
+FULFILLMENT_LIMIT = int(os.getenv("FULFILLMENT_LIMIT", "7"))  # аптек с наименьшим числом замен
+# Упреждающие котировки (PIPELINE_MODE=pipelined): сколько лишних запросов URL_PRICE на корзину допускается
+# сверх шорт-листа и через сколько аптек отбор отдает управление циклу событий
+QUOTE_PREFETCH_MAX_EXTRA = int(os.getenv("QUOTE_PREFETCH_MAX_EXTRA", "3"))
+QUOTE_PREFETCH_YIELD_EVERY = int(os.getenv("QUOTE_PREFETCH_YIELD_EVERY", "64"))
+
+# Расписания аптек: отбрасывать закрытые аптеки до запроса котировок
+# (отключает вариант "закрытая аптека на 30% дешевле")
+SCHEDULE_PREFILTER_CLOSED = env_bool("SCHEDULE_PREFILTER_CLOSED")
+
+# Выбор ближайших аптек
+CLOSEST_PHARMACIES_LIMIT = int(os.getenv("CLOSEST_PHARMACIES_LIMIT", "3"))
+SPATIAL_INDEX_ENABLED = env_bool("SPATIAL_INDEX_ENABLED", True)
+SPATIAL_INDEX_CELL_DEG = float(os.getenv("SPATIAL_INDEX_CELL_DEG", "0.01"))  # ~1.1 км по широте
+SPATIAL_INDEX_MIN_CANDIDATES = int(os.getenv("SPATIAL_INDEX_MIN_CANDIDATES", "500"))
+
+# Пакетная ручка /best_analog/batch
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "100"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))  # корзин одновременно в одном батче
+BATCH_GLOBAL_CONCURRENCY = int(os.getenv("BATCH_GLOBAL_CONCURRENCY", "8"))  # корзин одновременно во всех батчах
+
+# Компактный ответ: аптеки вынесены в словарь по коду, лишние поля отброшены (включается ?compact=1)
+RESPONSE_COMPACT = env_bool("RESPONSE_COMPACT")
+COMPACT_SOURCE_FIELDS = (
+    "code", "name", "city", "address", "lat", "lon", "opening_hours", "opens_at", "closes_at", "network_code",
+    "with_reserve", "payment_on_site", "payment_by_card", "kaspi_red", "working_today",
+)
+COMPACT_PRODUCT_FIELDS = (
+    "sku", "name", "base_price", "price_with_warehouse_discount", "warehouse_discount", "quantity",
+    "quantity_desired", "pp_packing", "manufacturer_id", "recipe_needed", "strong_recipe",
+)
+BEST_OPTION_KEYS = (
+    "cheapest_delivery_option", "alternative_cheapest_option", "fastest_delivery_option", "alternative_fastest_option",
+)
+
+# Потоковый ответ /best_analog
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+# Отладочные дампы стадий отбора (включаются env-переменной или заголовком запроса)
+DEBUG_DUMPS_ENABLED = env_bool("DEBUG_DUMPS_ENABLED")
+DEBUG_DUMP_HEADER = "X-Debug-Dump"
+DEBUG_DUMP_DIR = os.getenv("DEBUG_DUMP_DIR", "debug_dumps")
+DEBUG_DUMP_QUEUE_SIZE = int(os.getenv("DEBUG_DUMP_QUEUE_SIZE", "100"))
+DEBUG_TRACE_BUFFER_SIZE = int(os.getenv("DEBUG_TRACE_BUFFER_SIZE", "20"))
+
+# Define the payload
+payload = []
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Метрики в формате Prometheus. Запись - несколько операций над списками,
+# текст формируется только при обращении к /metrics.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (0, 1, 3, 7, 10, 30, 100, 300, 1000, 3000, 10000, 30000)
+
+
+def format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self.series = {}  # labels -> [счетчики по корзинам..., выше последней границы, сумма, количество]
+        metrics_registry.append(self)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.series = defaultdict(float)
+        metrics_registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.series[labels] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(self.labelnames, labels)} {value}" for labels, value in self.series.items())
+        return lines
+
+
+metrics_registry = []
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency", labelnames=("path", "status"))
+stage_duration = Histogram("best_analog_stage_duration_seconds", "Latency of /best_analog pipeline stages",
+                           labelnames=("stage",))
+stage_items = Histogram("best_analog_stage_items", "Pharmacies / candidates passed between pipeline stages",
+                        buckets=COUNT_BUCKETS, labelnames=("stage",))
+upstream_duration = Histogram("upstream_request_duration_seconds", "Latency of upstream calls",
+                              labelnames=("upstream", "status"))
+upstream_response_size = Histogram("upstream_response_size_bytes", "Size of upstream responses",
+                                   buckets=SIZE_BUCKETS, labelnames=("upstream",))
+upstream_errors = Counter("upstream_errors_total", "Upstream errors by code", labelnames=("upstream", "code"))
+upstream_hedges = Counter("upstream_hedged_requests_total", "Hedged duplicate upstream requests",
+                          labelnames=("upstream", "outcome"))
+circuit_breaker_transitions = Counter("circuit_breaker_transitions_total", "Circuit breaker state changes",
+                                      labelnames=("upstream", "state"))
+circuit_breaker_rejections = Counter("circuit_breaker_rejected_total", "Calls rejected by an open circuit breaker",
+                                     labelnames=("upstream",))
+price_fallbacks = Counter("price_quote_fallbacks_total", "Failed delivery quotes replaced by a fallback",
+                          labelnames=("fallback",))
+quote_prefetches = Counter("price_quote_prefetch_total", "Speculative delivery quote requests",
+                           labelnames=("outcome",))
+quote_estimator_decisions = Counter("price_quote_estimator_decisions_total",
+                                    "Ranked pharmacies quoted or skipped by the quote estimator",
+                                    labelnames=("decision",))
+session_quotes = Counter("basket_session_quotes_total", "Shortlisted pharmacies in basket session updates",
+                         labelnames=("outcome",))
+
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(time.perf_counter() - started, stage)
+
+
+GAUGE_HELP = {
+    "http_pool_in_flight": "Upstream requests in flight",
+    "circuit_breaker_state": "Circuit breaker state (1 for the current state)",
+    "upstream_hedge_delay_seconds": "Current hedged request delay",
+}
+
+
+def render_gauges():
+    """Состояние пулов соединений и кэшей в виде gauge-метрик. Сэмплы одной метрики идут подряд
+    после ее # HELP и # TYPE, как требует текстовый формат Prometheus."""
+    samples = defaultdict(list)  # имя метрики -> ['{метки} значение']
+    for upstream, stats in get_pool_stats().items():
+        samples["http_pool_in_flight"].append(f'{{upstream="{upstream}"}} {stats["in_flight"]}')
+    for name, cache in caches.items():
+        for key, value in cache.stats().items():
+            samples[f"cache_{key}"].append(f'{{cache="{name}"}} {value}')
+    for upstream, breaker in circuit_breakers.items():
+        for state in CircuitBreaker.STATES:
+            samples["circuit_breaker_state"].append(f'{{upstream="{upstream}",state="{state}"}} {int(breaker.state == state)}')
+    samples["upstream_hedge_delay_seconds"].append(f'{{upstream="price"}} {hedge_delay("price")}')
+
+    lines = []
+    for metric, metric_samples in samples.items():
+        help_text = GAUGE_HELP.get(metric, f"Cache {metric[len('cache_'):]} by cache")
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.extend(f"{metric}{sample}" for sample in metric_samples)
+    return lines
+
+
+class RequestMetricsMiddleware:
+    """ASGI-middleware: длительность HTTP-запросов (включая отдачу потоковых ответов) по шаблону пути и коду."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Шаблон пути вместо фактического, чтобы не плодить серии на каждый id
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_request_duration.observe(time.perf_counter() - started, path, status[0])
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+@app.get("/metrics")
+async def metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    lines.extend(render_gauges())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# Долгоживущие клиенты, по одному на апстрим (создаются на старте, закрываются на остановке)
+http_clients = {}
+http_client_stats = {}
+http_client_created_at = {}
+# httpcore (и 0.17, и 1.x) при отмене запроса во время установки соединения или в момент между
+# соединением и обменом может оставить соединение в пуле занятым навсегда (CONNECTING/NEW/ACTIVE без
+# запроса), и пул постепенно исчерпывается. Обычная отмена (в очереди пула, во время обмена) httpcore
+# убирает сама: закрывает соединение, а клиент с остальными keep-alive соединениями остается. Поэтому
+# после отмены пул проверяется, и только если в нем нашлись такие соединения, клиент апстрима
+# помечается и при следующем запросе заменяется новым (не чаще HTTP_CLIENT_RECYCLE_INTERVAL), а старый
+# закрывается вместе со всеми соединениями, когда завершатся начатые через него запросы: убрать одно
+# соединение из пула httpcore публичным API нельзя.
+tainted_upstreams = set()
+retired_clients = set()
+suspect_clients = set()  # клиенты, в которых были отмены: пул проверяется, пока они не завершатся
+client_calls = defaultdict(int)  # клиент -> запросов в работе
+client_transports = {}  # клиент -> UpstreamTransport
+
+
+class UpstreamResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def __aiter__(self):
+        with map_httpcore_errors():
+            async for chunk in self.stream:
+                yield chunk
+
+    async def aclose(self):
+        with map_httpcore_errors():
+            await self.stream.aclose()
+
+
+@contextmanager
+def map_httpcore_errors():
+    """Ошибки httpcore как одноименные исключения httpx (httpx.ReadTimeout, httpx.ConnectError, ...)."""
+    try:
+        yield
+    except httpcore.TimeoutException as e:
+        raise getattr(httpx, type(e).__name__, httpx.TimeoutException)(str(e)) from e
+    except (httpcore.NetworkError, httpcore.ProtocolError, httpcore.ProxyError, httpcore.UnsupportedProtocol) as e:
+        raise getattr(httpx, type(e).__name__, httpx.TransportError)(str(e)) from e
+
+
+class UpstreamTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx над собственным пулом httpcore (как httpx.AsyncHTTPTransport, но без прокси):
+    пул доступен через публичный API httpcore, поэтому после отмены запроса можно проверить, не осталось ли
+    в нем соединений, занятых без запроса."""
+
+    def __init__(self, limits, http2=False):
+        self.pool = httpcore.AsyncConnectionPool(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http2=http2,
+        )
+
+    async def handle_async_request(self, request):
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host, port=request.url.port,
+                             target=request.url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with map_httpcore_errors():
+            response = await self.pool.handle_async_request(core_request)
+        return httpx.Response(status_code=response.status, headers=response.headers,
+                              stream=UpstreamResponseStream(response.stream), extensions=response.extensions)
+
+    def stuck_connections(self, in_flight):
+        """Сколько соединений пула заведомо заняты без запроса: каждый запрос в работе держит не больше
+        одного соединения, остальные не свободные и не закрытые соединения httpcore уже не освободит."""
+        busy = sum(not connection.is_idle() for connection in self.pool.connections)
+        return max(0, busy - in_flight)
+
+    async def aclose(self):
+        await self.pool.aclose()
+
+
+def create_http_client(upstream):
+    """Создает httpx-клиент с пулом keep-alive соединений для указанного апстрима."""
+    http2 = HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("HTTP2_ENABLED is set but 'h2' package is not installed, falling back to HTTP/1.1")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(UPSTREAM_TIMEOUTS[upstream], connect=HTTP_CONNECT_TIMEOUT)
+    http_client_stats.setdefault(upstream, {"requests_total": 0, "in_flight": 0, "errors_total": 0,
+                                            "cancelled_total": 0, "recycled_total": 0})
+    http_client_created_at[upstream] = time.monotonic()
+    transport = UpstreamTransport(limits, http2)
+    client = httpx.AsyncClient(transport=transport, timeout=timeout)
+    client_transports[client] = transport
+    return client
+
+
+def get_http_client(upstream):
+    client = http_clients.get(upstream)
+    if client is not None and upstream in tainted_upstreams and HTTP_CLIENT_RECYCLE_INTERVAL > 0 \
+            and time.monotonic() - http_client_created_at[upstream] >= HTTP_CLIENT_RECYCLE_INTERVAL:
+        retire_http_client(upstream, client)
+        client = None
+    if client is None or client.is_closed:
+        client = create_http_client(upstream)
+        http_clients[upstream] = client
+    return client
+
+
+def retire_http_client(upstream, client):
+    """Выводит клиент из оборота; он закрывается, когда завершатся его запросы."""
+    del http_clients[upstream]
+    tainted_upstreams.discard(upstream)
+    http_client_stats[upstream]["recycled_total"] += 1
+    retired_clients.add(client)
+    if not client_calls.get(client):
+        close_retired_client(client)
+
+
+def release_http_client(upstream, client):
+    client_calls[client] -= 1
+    if client in suspect_clients:
+        check_stuck_connections(upstream, client)
+    if not client_calls[client]:
+        del client_calls[client]
+        if client in retired_clients:
+            close_retired_client(client)
+
+
+def check_stuck_connections(upstream, client):
+    """Проверка пула после отмен: клиент помечается на замену, только если в пуле остались соединения,
+    занятые без запроса. Без запросов в работе проверка точная, и клиент перестает быть подозрительным."""
+    transport = client_transports.get(client)
+    if transport is None or client in retired_clients:
+        suspect_clients.discard(client)
+        return
+    stuck = transport.stuck_connections(client_calls[client])
+    if stuck:
+        if http_clients.get(upstream) is client and upstream not in tainted_upstreams:
+            logger.warning(f"{stuck} {upstream} connection(s) left busy by a cancelled request, client will be recycled")
+            tainted_upstreams.add(upstream)
+        suspect_clients.discard(client)
+    elif not client_calls[client]:
+        suspect_clients.discard(client)
+
+
+def close_retired_client(client):
+    retired_clients.discard(client)
+    suspect_clients.discard(client)
+    client_transports.pop(client, None)
+    asyncio.ensure_future(client.aclose())
+
+
+class CircuitOpenError(httpx.RequestError):
+    """Запрос не отправлен: размыкатель цепи апстрима разомкнут."""
+
+
+class CircuitBreaker:
+    """Размыкатель цепи апстрима: closed -> open при всплеске ошибок -> half_open (пробные запросы) -> closed."""
+
+    STATES = ("closed", "open", "half_open")
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.state = "closed"
+        self.results = deque(maxlen=CIRCUIT_BREAKER_WINDOW)  # True - успешный вызов
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+
+    def allow(self):
+        """Можно ли отправить запрос. Возвращает (разрешено, это пробный запрос)."""
+        if not CIRCUIT_BREAKER_ENABLED:
+            return True, False
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < CIRCUIT_BREAKER_OPEN_SECONDS:
+                circuit_breaker_rejections.inc(self.upstream)
+                return False, False
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.probes_in_flight >= CIRCUIT_BREAKER_HALF_OPEN_PROBES:
+                circuit_breaker_rejections.inc(self.upstream)
+                return False, False
+            self.probes_in_flight += 1
+            return True, True
+        return True, False
+
+    def record(self, success, probe=False):
+        if not CIRCUIT_BREAKER_ENABLED:
+            return
+        if probe:
+            self.probes_in_flight -= 1
+            if self.state == "half_open":
+                self._transition("closed" if success else "open")
+            return
+        if self.state != "closed":
+            # Запоздавшие ответы на запросы, отправленные до размыкания
+            return
+        self.results.append(success)
+        if len(self.results) >= CIRCUIT_BREAKER_MIN_CALLS:
+            failures = len(self.results) - sum(self.results)
+            if failures / len(self.results) >= CIRCUIT_BREAKER_ERROR_RATE:
+                self._transition("open")
+
+    def release(self, probe):
+        """Запрос отменен до получения ответа (например, проиграл хеджирующему)."""
+        if probe and CIRCUIT_BREAKER_ENABLED:
+            self.probes_in_flight -= 1
+
+    def _transition(self, state):
+        logger.warning(f"Circuit breaker for {self.upstream}: {self.state} -> {state}")
+        self.state = state
+        if state == "open":
+            self.opened_at = time.monotonic()
+        elif state == "closed":
+            self.results.clear()
+        circuit_breaker_transitions.inc(self.upstream, state)
+
+
+circuit_breakers = {upstream: CircuitBreaker(upstream) for upstream in UPSTREAM_TIMEOUTS}
+# Задержки успешных ответов апстримов для расчета задержки хеджирования
+upstream_latencies = {upstream: deque(maxlen=UPSTREAM_LATENCY_WINDOW) for upstream in UPSTREAM_TIMEOUTS}
+
+
+async def upstream_post(upstream, url, deadline=None, **kwargs):
+    """POST в апстрим через общий клиент с учетом статистики использования пула и размыкателя цепи.
+    deadline - момент time.monotonic(), к которому нужен ответ: после него запрос отменяется с
+    asyncio.TimeoutError. Такой таймаут, как и отмена вызывающим после deadline, считается отказом апстрима."""
+    breaker = circuit_breakers[upstream]
+    allowed, probe = breaker.allow()
+    if not allowed:
+        raise CircuitOpenError(f"Circuit breaker for {upstream} is open")
+
+    client = get_http_client(upstream)
+    client_calls[client] += 1
+    stats = http_client_stats[upstream]
+    stats["requests_total"] += 1
+    stats["in_flight"] += 1
+    started = time.perf_counter()
+
+    def record_failure(error_name):
+        stats["errors_total"] += 1
+        upstream_duration.observe(time.perf_counter() - started, upstream, "error")
+        upstream_errors.inc(upstream, error_name)
+        breaker.record(False, probe)
+
+    try:
+        response = await asyncio.wait_for(client.post(url, **kwargs), remaining_budget(deadline))
+    except httpx.HTTPError as e:
+        record_failure(type(e).__name__)
+        raise
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        if isinstance(e, asyncio.TimeoutError) or (deadline is not None and time.monotonic() >= deadline):
+            # Апстрим не ответил к сроку: зависший апстрим должен размыкать цепь так же, как отвечающий ошибками
+            record_failure("TimeoutError")
+        else:
+            # Отмена до срока (проигравший хеджирующий запрос, отключение клиента) - не отказ апстрима
+            breaker.release(probe)
+        stats["cancelled_total"] += 1
+        suspect_clients.add(client)
+        raise
+    finally:
+        stats["in_flight"] -= 1
+        release_http_client(upstream, client)
+    elapsed = time.perf_counter() - started
+    upstream_duration.observe(elapsed, upstream, response.status_code)
+    upstream_response_size.observe(len(response.content), upstream)
+    if response.status_code >= 400:
+        upstream_errors.inc(upstream, response.status_code)
+    if response.status_code >= 500:
+        stats["errors_total"] += 1
+    breaker.record(response.status_code < 500, probe)
+    if response.status_code < 500:
+        upstream_latencies[upstream].append(elapsed)
+    return response
+
+
+def hedge_delay(upstream):
+    """Задержка перед дублирующим запросом: перцентиль PRICE_HEDGE_PERCENTILE недавних задержек апстрима."""
+    samples = upstream_latencies[upstream]
+    if len(samples) < PRICE_HEDGE_MIN_SAMPLES:
+        return PRICE_HEDGE_INITIAL_DELAY
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(PRICE_HEDGE_PERCENTILE / 100 * len(ordered)))
+    return max(PRICE_HEDGE_MIN_DELAY, ordered[index])
+
+
+async def hedged_upstream_post(upstream, url, deadline=None, **kwargs):
+    """upstream_post с хеджированием: если ответа нет дольше hedge_delay, отправляется такой же запрос,
+    используется первый успешный ответ, второй запрос отменяется. deadline - общий для обоих запросов."""
+    if not PRICE_HEDGE_ENABLED:
+        return await upstream_post(upstream, url, deadline, **kwargs)
+
+    primary = asyncio.ensure_future(upstream_post(upstream, url, deadline, **kwargs))
+    hedge = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay(upstream))
+        if done:
+            return primary.result()
+
+        hedge = asyncio.ensure_future(upstream_post(upstream, url, deadline, **kwargs))
+        upstream_hedges.inc(upstream, "sent")
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code < 500:
+                    if task is hedge:
+                        upstream_hedges.inc(upstream, "won")
+                    return task.result()
+        # Оба запроса неудачны - отдаем результат основного
+        return primary.result()
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+def get_pool_stats():
+    """Возвращает статистику по пулам соединений для мониторинга."""
+    result = {}
+    for upstream in http_clients:
+        stats = dict(http_client_stats.get(upstream, {}))
+        stats.update({
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            "http2": HTTP2_ENABLED,
+            "timeout": UPSTREAM_TIMEOUTS[upstream],
+            "circuit_breaker": circuit_breakers[upstream].state,
+        })
+        result[upstream] = stats
+    return result
+
+
+@app.on_event("startup")
+async def start_http_clients():
+    for upstream in UPSTREAM_TIMEOUTS:
+        get_http_client(upstream)
+    logger.info("HTTP clients started for upstreams: %s", ", ".join(http_clients))
+
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    for client in [*http_clients.values(), *retired_clients]:
+        await client.aclose()
+    http_clients.clear()
+    retired_clients.clear()
+    suspect_clients.clear()
+    client_transports.clear()
+
+
+@app.get("/http_pool_stats")
+async def http_pool_stats():
+    return get_pool_stats()
+
+
+def estimate_size(value):
+    """Приблизительный размер значения в байтах (по компактному JSON)."""
+    try:
+        return len(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+    except (TypeError, ValueError):
+        return 1024
+
+
+def dumps_bytes(data):
+    """Компактный JSON в байтах (значения общего кэша)."""
+    if orjson is None:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return orjson.dumps(data)
+
+
+def loads_bytes(data):
+    return json.loads(data) if orjson is None else orjson.loads(data)
+
+
+class SharedCacheStore:
+    """Кэш в файле SQLite (WAL, mmap), общий для всех процессов хоста: ключ -> байты со сроком жизни.
+    Сроки считаются по настенным часам, так как монотонные часы у процессов разные. Чтение идет прямо
+    из цикла событий (в режиме WAL читатели не ждут писателей), запись - в потоке-исполнителе. Размер
+    ограничивается фоновой чисткой: при превышении max_bytes первыми удаляются записи, которые раньше
+    всех истекут."""
+
+    # Сколько записей может ждать потока-исполнителя; остальные отбрасываются, а не копятся в памяти
+    MAX_PENDING_WRITES = 1000
+
+    def __init__(self, path, max_bytes, mmap_bytes=0, busy_timeout=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mmap_bytes = mmap_bytes
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self.prune_task = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.pending_writes = 0
+        self.dropped_writes = 0
+        self.errors = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def connection(self):
+        """Соединение текущего потока: соединения sqlite3 нельзя делить между потоками."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={int(self.mmap_bytes)}")
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, expires_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """Возвращает (значение, истекает_в) или None."""
+        try:
+            row = self.connection().execute("SELECT value, expires_at FROM entries WHERE key = ? AND expires_at > ?",
+                                            (key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Shared cache read failed: {e}")
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def scan(self, prefix):
+        """Все живые записи с ключом, начинающимся с prefix: список (ключ, значение)."""
+        return self.connection().execute(
+            "SELECT key, value FROM entries WHERE key >= ? AND key < ? AND expires_at > ?",
+            (prefix, prefix + "\uffff", time.time())).fetchall()
+
+    def set_many(self, entries):
+        """Записывает [(ключ, значение, истекает_в)] одной транзакцией."""
+        connection = self.connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("INSERT OR REPLACE INTO entries (key, value, size, expires_at) VALUES (?, ?, ?, ?)",
+                                   [(key, value, len(key) + len(value), expires_at)
+                                    for key, value, expires_at in entries])
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            self.errors += 1
+            logger.warning(f"Shared cache write failed: {e}")
+            return
+        self.writes += len(entries)
+
+    def set_later(self, entries):
+        """Запись в потоке-исполнителе, чтобы цикл событий не ждал блокировку файла
+        (вне цикла событий, например в бенчмарках, - сразу)."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.set_many(entries)
+            return
+        if self.pending_writes >= self.MAX_PENDING_WRITES:
+            self.dropped_writes += len(entries)
+            return
+        self.pending_writes += 1
+        future = loop.run_in_executor(None, self.set_many, entries)
+        future.add_done_callback(self._on_written)
+
+    def _on_written(self, future):
+        self.pending_writes -= 1
+
+    def prune(self):
+        """Удаляет истекшие записи, а если данных больше max_bytes - записи, которые истекут раньше других."""
+        connection = self.connection()
+        self.expirations += connection.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),)).rowcount
+        excess = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY expires_at").fetchall():
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("DELETE FROM entries WHERE key = ?", victims)
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        self.evictions += len(victims)
+
+    def start(self):
+        if self.prune_task is None or self.prune_task.done():
+            self.prune_task = asyncio.create_task(self.prune_loop())
+
+    async def prune_loop(self):
+        while True:
+            await asyncio.sleep(SHARED_CACHE_PRUNE_INTERVAL)
+            try:
+                await asyncio.to_thread(self.prune)
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning(f"Shared cache prune failed: {e}")
+
+    def stats(self):
+        try:
+            entries, size = self.connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE expires_at > ?", (time.time(),)).fetchone()
+        except sqlite3.Error:
+            entries = size = None
+        lookups = self.hits + self.misses
+        # Счетчики - по текущему воркеру, записи и размер - по всему файлу
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "pending_writes": self.pending_writes,
+            "dropped_writes": self.dropped_writes,
+            "errors": self.errors,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+shared_cache = SharedCacheStore(SHARED_CACHE_PATH, SHARED_CACHE_MAX_BYTES, SHARED_CACHE_MMAP_BYTES,
+                                SHARED_CACHE_BUSY_TIMEOUT) if SHARED_CACHE_ENABLED else None
+
+
+class TTLCache:
+    """LRU-кэш с TTL, ограничением по памяти и объединением одновременных промахов (single-flight).
+    Если задан codec - пара (dumps(value) -> bytes, loads(key, bytes) -> value) - и включен общий кэш,
+    промахи сначала ищутся в shared_cache, а новые значения записываются и туда.
+    stale_ttl > 0 включает stale-while-revalidate в get_or_load: еще stale_ttl секунд после истечения
+    значение отдается сразу, а обновляется в фоне не чаще раза в refresh_interval по ключу."""
+
+    def __init__(self, name, ttl, max_bytes, sizeof=estimate_size, codec=None, stale_ttl=0, refresh_interval=0):
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.codec = codec
+        self.stale_ttl = stale_ttl
+        self.refresh_interval = refresh_interval
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._in_flight = {}
+        self._refreshed_at = {}  # key -> время последнего фонового обновления
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.shared_hits = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refreshes_skipped = 0
+        caches[name] = self
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return self.get_shared(key)
+        expires_at, size, value = entry
+        now = time.monotonic()
+        if expires_at <= now:
+            # В окне stale_ttl запись остается для get_stale
+            if expires_at + self.stale_ttl <= now:
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return self.get_shared(key)
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get_stale(self, key):
+        """Истекшее значение, если не прошло stale_ttl секунд после истечения, иначе None."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] + self.stale_ttl <= time.monotonic():
+            return None
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def set(self, key, value, ttl=None, share=True):
+        """ttl - срок жизни записи (по умолчанию ttl кэша); share=False - не записывать в общий кэш."""
+        ttl = self.ttl if ttl is None else ttl
+        size = self.sizeof(value)
+        if size > self.max_bytes or ttl <= 0:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self.current_bytes += size
+        # Вытесняем самые давно использованные записи, пока не уложимся в лимит памяти
+        while self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+        if share and self.codec is not None and shared_cache is not None:
+            shared_cache.set_later([(self.shared_key(key), self.codec[0](value), time.time() + ttl)])
+
+    def shared_key(self, key):
+        return f"{self.name}:{json.dumps(key, ensure_ascii=False, separators=(',', ':'))}"
+
+    def get_shared(self, key):
+        """Значение из общего кэша (с оставшимся там сроком жизни) или None."""
+        if self.codec is None or shared_cache is None:
+            return None
+        row = shared_cache.get(self.shared_key(key))
+        if row is None:
+            return None
+        data, expires_at = row
+        try:
+            value = self.codec[1](key, data)
+        except (TypeError, ValueError, KeyError) as e:
+            logger.warning(f"Broken {self.name} entry in shared cache: {e}")
+            return None
+        self.shared_hits += 1
+        self.set(key, value, ttl=expires_at - time.time(), share=False)
+        return value
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+        self._refreshed_at.pop(key, None)
+
+    def remove(self, key):
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._refreshed_at.clear()
+        self.current_bytes = 0
+
+    async def get_or_load(self, key, loader):
+        """Возвращает значение из кэша или загружает его; одновременные промахи по ключу ждут одну загрузку.
+        Ответы с ошибкой (JSONResponse) не кэшируются. При stale_ttl устаревшее значение возвращается
+        сразу, а загрузка идет в фоне; пока она не удалась, продолжает отдаваться устаревшее значение."""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        stale = self.get_stale(key) if self.stale_ttl > 0 else None
+        if stale is not None:
+            self.stale_hits += 1
+            self.refresh(key, loader)
+            return stale
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._load(key, loader)
+        else:
+            self.coalesced += 1
+        # shield: отмена одного из ожидающих запросов не отменяет общую загрузку
+        return await asyncio.shield(task)
+
+    def refresh(self, key, loader):
+        """Фоновое обновление значения, не чаще раза в refresh_interval по ключу."""
+        if key in self._in_flight:
+            return
+        now = time.monotonic()
+        if now - self._refreshed_at.get(key, -math.inf) < self.refresh_interval:
+            self.refreshes_skipped += 1
+            return
+        self._refreshed_at[key] = now
+        self.refreshes += 1
+        self._load(key, loader)
+
+    def _load(self, key, loader):
+        task = asyncio.ensure_future(loader())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda done: self._on_loaded(key, done))
+        return task
+
+    def _on_loaded(self, key, task):
+        self._in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        value = task.result()
+        if value is not None and not isinstance(value, JSONResponse):
+            self.set(key, value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+            "shared_hits": self.shared_hits,
+            "stale_ttl": self.stale_ttl,
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "refreshes_skipped": self.refreshes_skipped,
+        }
+
+
+batch_global_slots = asyncio.Semaphore(BATCH_GLOBAL_CONCURRENCY)
+
+caches = {}
+# Значения в общем кэше - JSON; ответ поиска восстанавливается через search_result_from_data вместе с
+# временем получения, чтобы возраст данных в ответе не обнулялся
+JSON_CODEC = (dumps_bytes, lambda key, data: loads_bytes(data))
+SEARCH_CODEC = (
+    lambda result: dumps_bytes({"fetched_at": result.fetched_at, "data": result.raw}),
+    lambda key, data: search_result_from_data(key[0], *itemgetter("data", "fetched_at")(loads_bytes(data))),
+)
+search_cache = TTLCache("search", SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_BYTES, sizeof=lambda result: search_result_size(result),
+                        codec=SEARCH_CODEC, stale_ttl=SEARCH_STALE_TTL, refresh_interval=SEARCH_STALE_REFRESH_INTERVAL)
+
+
+def search_cache_key(encoded_city, payload):
+    """Ключ кэша поиска: хэш города + отсортированный список (sku, count_desired)."""
+    basket = tuple(sorted((item["sku"], item["count_desired"]) for item in payload))
+    return encoded_city, basket
+
+
+quote_cache = TTLCache("quote", QUOTE_CACHE_TTL, QUOTE_CACHE_MAX_BYTES, codec=JSON_CODEC)
+# Последние успешные котировки для PRICE_FALLBACK=cache; живут дольше основного кэша котировок
+quote_fallback_cache = TTLCache("quote_fallback", PRICE_FALLBACK_TTL, PRICE_FALLBACK_MAX_BYTES, codec=JSON_CODEC)
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat, lon, precision):
+    """Кодирует координаты в geohash заданной длины."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        coord_range, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (coord_range[0] + coord_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            coord_range[0] = mid
+        else:
+            bits <<= 1
+            coord_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def quote_cache_key(source_code, items, user_lat, user_lon):
+    """Ключ кэша котировки: аптека + отсортированные товары + ячейка geohash адреса доставки."""
+    canonical_items = tuple(sorted((item["sku"], item["quantity"]) for item in items))
+    return source_code, canonical_items, geohash_encode(user_lat, user_lon, QUOTE_CACHE_GEOHASH_PRECISION)
+
+
+@app.get("/cache_stats")
+async def cache_stats():
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    if shared_cache is not None:
+        stats["shared"] = shared_cache.stats()
+    return stats
+
+
+@app.on_event("startup")
+async def start_shared_cache():
+    """Открывает общий кэш и загружает из него расписания аптек; если файл недоступен, работаем без него."""
+    global shared_cache
+    if shared_cache is None:
+        return
+    try:
+        schedules = load_shared_schedules()
+    except sqlite3.Error as e:
+        logger.error(f"Shared cache {SHARED_CACHE_PATH} is unavailable, running without it: {e}")
+        shared_cache = None
+        return
+    logger.info(f"Shared cache {SHARED_CACHE_PATH}: loaded {schedules} pharmacy schedules")
+    shared_cache.start()
+
+
+@app.on_event("shutdown")
+async def stop_shared_cache():
+    if shared_cache is not None and shared_cache.prune_task is not None:
+        shared_cache.prune_task.cancel()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse с сериализацией через orjson, если он установлен. Контент должен быть уже готовым
+    JSON-совместимым объектом: в отличие от возврата dict из обработчика, jsonable_encoder не вызывается."""
+
+    def render(self, content):
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def dumps_json(data):
+    """Строка JSON для потоковых событий."""
+    if orjson is None:
+        return json.dumps(data, ensure_ascii=False)
+    return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+
+
+def wants_compact(request):
+    compact = request.query_params.get("compact")
+    if compact is None:
+        return RESPONSE_COMPACT
+    return compact.strip().lower() in ("1", "true", "yes", "on")
+
+
+def compact_pharmacy(pharmacy):
+    """Аптека без неиспользуемых клиентом полей. Аналоги остаются только у замененных товаров."""
+    source = pharmacy.get("source", {})
+    replaced = {replacement["original_sku"] for replacement in pharmacy.get("replaced_skus", ())}
+    products = []
+    for product in pharmacy.get("products", ()):
+        compact_product = {field: product[field] for field in COMPACT_PRODUCT_FIELDS if field in product}
+        if product.get("sku") in replaced and product.get("analogs"):
+            compact_product["analogs"] = [
+                {field: analog[field] for field in COMPACT_PRODUCT_FIELDS if field in analog}
+                for analog in product["analogs"]
+            ]
+        products.append(compact_product)
+    compact = {
+        "source": {field: source[field] for field in COMPACT_SOURCE_FIELDS if field in source},
+        "products": products,
+    }
+    for field in ("total_sum", "replacements_needed", "replaced_skus", "distance"):
+        if field in pharmacy:
+            compact[field] = pharmacy[field]
+    return compact
+
+
+def compact_result(result):
+    """Компактная форма ответа best_option: каждая аптека один раз в "pharmacies" (по коду),
+    в вариантах доставки - только ссылка pharmacy_code."""
+    pharmacies = {}
+    compact = {"pharmacies": pharmacies}
+    for key, value in result.items():
+        if key not in BEST_OPTION_KEYS or value is None:
+            compact[key] = value
+            continue
+        code = value["pharmacy"].get("source", {}).get("code")
+        if code not in pharmacies:
+            pharmacies[code] = compact_pharmacy(value["pharmacy"])
+        compact[key] = {"pharmacy_code": code, "total_price": value["total_price"],
+                        "delivery_option": value["delivery_option"]}
+    return compact
+
+
+def render_result(result, compact=False):
+    """Ответ с результатом подбора: ошибки (JSONResponse) возвращаются как есть."""
+    if isinstance(result, JSONResponse):
+        return result
+    return FastJSONResponse(content=compact_result(result) if compact else result)
+
+
+@app.post("/best_analog")
+async def main_process(request: Request):
+
+    trace = start_trace(request)
+    try:
+        deadline = get_request_deadline(request)
+    except ValueError:
+        return JSONResponse(content={"error": f"Invalid {REQUEST_DEADLINE_HEADER} header"}, status_code=400)
+    try:
+        # Receive the front end data (city hash, sku's, user address)
+        request_data = await request.json()
+        stream_format = get_stream_format(request)
+        if stream_format:
+            return await stream_basket(request_data, trace, stream_format, deadline, wants_compact(request))
+        return render_result(await process_basket(request_data, trace, deadline=deadline), wants_compact(request))
+
+    except json.JSONDecodeError:
+        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+
+
+@app.post("/best_analog/batch")
+async def batch_process(request: Request):
+    """Оценка нескольких корзин за один вызов. Одинаковые запросы к URL_SEARCH и URL_PRICE внутри
+    батча выполняются один раз, результаты возвращаются в исходном порядке с ошибками по каждой корзине."""
+    try:
+        request_data = await request.json()
+    except json.JSONDecodeError:
+        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
+
+    try:
+        budget = get_request_budget(request)
+    except ValueError:
+        return JSONResponse(content={"error": f"Invalid {REQUEST_DEADLINE_HEADER} header"}, status_code=400)
+
+    baskets = request_data.get("baskets") if isinstance(request_data, dict) else request_data
+    if not isinstance(baskets, list) or not baskets:
+        return JSONResponse(content={"error": "A non-empty list of baskets is required"}, status_code=400)
+    if len(baskets) > BATCH_MAX_SIZE:
+        return JSONResponse(content={"error": f"Too many baskets, maximum is {BATCH_MAX_SIZE}"}, status_code=400)
+
+    shared_searches = {}
+    shared_quotes = {}
+    batch_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    compact = wants_compact(request)
+
+    async def run_basket(index, basket):
+        # Ограничение и на батч, и на все батчи сразу, чтобы они не вытесняли обычные запросы
+        async with batch_slots, batch_global_slots:
+            # Бюджет корзины отсчитывается с момента, когда она получила слот, а не с начала батча:
+            # иначе корзины в хвосте большого батча тратят его в очереди и доходят до апстрима без времени
+            deadline = budget_deadline(budget)
+            try:
+                result = await process_basket(basket, shared_searches=shared_searches, shared_quotes=shared_quotes,
+                                              deadline=deadline)
+            except Exception as e:
+                logger.error(f"Unexpected error in batch item {index}: {e}")
+                result = JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+        if isinstance(result, JSONResponse):
+            return {"index": index, "status": result.status_code, "error": json.loads(result.body.decode("utf-8"))}
+        return {"index": index, "status": 200, "result": compact_result(result) if compact else result}
+
+    results = await asyncio.gather(*(run_basket(index, basket) for index, basket in enumerate(baskets)))
+    return FastJSONResponse(content={"results": results})
+
+
+def get_request_budget(request):
+    """Бюджет запроса в секундах из заголовка REQUEST_DEADLINE_HEADER или REQUEST_DEADLINE; None - без ограничения."""
+    budget = REQUEST_DEADLINE
+    header = request.headers.get(REQUEST_DEADLINE_HEADER)
+    if header is not None:
+        budget = float(header)
+        if not math.isfinite(budget) or budget <= 0:
+            raise ValueError(header)
+        budget = min(budget, REQUEST_DEADLINE_MAX)
+    return budget if budget > 0 else None
+
+
+def budget_deadline(budget):
+    """Момент (time.monotonic), к которому истекает бюджет, начатый сейчас, или None без ограничения."""
+    return None if budget is None else time.monotonic() + budget
+
+
+def get_request_deadline(request):
+    """Момент (time.monotonic), к которому запрос должен быть обработан, или None без ограничения."""
+    return budget_deadline(get_request_budget(request))
+
+
+def remaining_budget(deadline):
+    """Сколько секунд осталось до дедлайна (None - без ограничения)."""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def budget_timeout(timeout, deadline):
+    """Таймаут вызова с учетом оставшегося бюджета запроса."""
+    remaining = remaining_budget(deadline)
+    return timeout if remaining is None else min(timeout, remaining)
+
+
+def deadline_exceeded_response():
+    return JSONResponse(content={"error": "Request deadline exceeded"}, status_code=504)
+
+
+def get_stream_format(request):
+    """Потоковый ответ включается параметром ?stream=ndjson|sse или заголовком Accept."""
+    stream_format = request.query_params.get("stream", "").lower()
+    if stream_format in STREAM_MEDIA_TYPES:
+        return stream_format
+    accept = request.headers.get("accept", "")
+    for stream_format, media_type in STREAM_MEDIA_TYPES.items():
+        if media_type in accept:
+            return stream_format
+    return None
+
+
+def format_stream_event(stream_format, event, data):
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {dumps_json(data)}\n\n"
+    return dumps_json({"event": event, "data": data}) + "\n"
+
+
+async def stream_basket(request_data, trace, stream_format, deadline=None, compact=False):
+    """Потоковый вариант /best_analog: сначала шорт-лист аптек, затем котировки по мере поступления,
+    в конце - итоговый выбор best_option. Ошибки до шорт-листа возвращаются обычным JSON-ответом."""
+    events = asyncio.Queue()
+
+    async def produce():
+        try:
+            result = await process_basket(request_data, trace, emit=lambda event, data: events.put_nowait((event, data)),
+                                          deadline=deadline)
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            result = JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+        if isinstance(result, JSONResponse):
+            events.put_nowait(("error", {"status": result.status_code, **json.loads(result.body.decode("utf-8"))}))
+        else:
+            events.put_nowait(("result", compact_result(result) if compact else result))
+        events.put_nowait(None)
+
+    producer = asyncio.create_task(produce())
+    first_event = await events.get()
+    if first_event[0] == "error":
+        await producer
+        error = dict(first_event[1])
+        return JSONResponse(content=error, status_code=error.pop("status"))
+
+    async def body():
+        event = first_event
+        try:
+            while event is not None:
+                yield format_stream_event(stream_format, *event)
+                event = await events.get()
+        finally:
+            # Клиент отключился - прекращаем работу над запросом
+            if not producer.done():
+                producer.cancel()
+
+    return StreamingResponse(body(), media_type=STREAM_MEDIA_TYPES[stream_format])
+
+
+async def shared_call(shared, key, loader):
+    """Выполняет loader один раз на ключ в пределах словаря shared (например, одного батча)."""
+    if shared is None:
+        return await loader()
+    task = shared.get(key)
+    if task is None:
+        task = shared[key] = asyncio.ensure_future(loader())
+    return await asyncio.shield(task)
+
+
+def parse_basket_request(request_data):
+    """Проверяет тело запроса /best_analog. Возвращает (хэш города, payload для URL_SEARCH, широта, долгота)
+    или JSONResponse с ошибкой."""
+    if not isinstance(request_data, dict):
+        return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
+
+    encoded_city = request_data.get("city")  # Encoded city hash
+    sku_data = request_data.get("skus", [])  # List of SKU items
+
+    #Save the latitude and longitude of user
+    user_lat = request_data.get("address", {}).get("lat")
+    user_lon = request_data.get("address", {}).get("lng")
+
+    # Validate the incoming data
+    if not encoded_city or not sku_data or user_lat is None or user_lon is None:
+        return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
+
+    if not isinstance(user_lat, (int, float)) or not isinstance(user_lon, (int, float)):
+        return JSONResponse(content={"error": "Invalid data type for user coordinates"}, status_code=400)
+
+    for item in sku_data:
+        if not isinstance(item.get("sku"), str) or not isinstance(item.get("count_desired"), int):
+            return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
+
+    # Build the payload
+    payload = [{"sku": item["sku"], "count_desired": item["count_desired"]} for item in sku_data]
+    return encoded_city, payload, user_lat, user_lon
+
+
+async def process_basket(request_data, trace=None, shared_searches=None, shared_quotes=None, emit=None,
+                         deadline=None):
+    """Полный цикл подбора для одной корзины: поиск, аналоги, ближайшие аптеки, доставка, выбор лучших.
+    emit(event, data) - необязательный обработчик промежуточных событий (шорт-лист, котировки).
+    deadline - момент time.monotonic(), после которого стадии не запускаются, а котировки не ждутся."""
+    basket = parse_basket_request(request_data)
+    if isinstance(basket, JSONResponse):
+        return basket
+    encoded_city, payload, user_lat, user_lon = basket
+    if WARMUP_ENABLED:
+        catalog_warmer.record(encoded_city, payload)
+
+    # Perform the search for medicines in pharmacies
+    search_timeout = budget_timeout(UPSTREAM_TIMEOUTS["search"], deadline)
+    with stage_timer("search"):
+        try:
+            pharmacies = await asyncio.wait_for(
+                shared_call(shared_searches, search_cache_key(encoded_city, payload),
+                            lambda: find_medicines_in_pharmacies(encoded_city, payload, search_timeout, deadline)),
+                remaining_budget(deadline),
+            )
+        except asyncio.TimeoutError:
+            return deadline_exceeded_response()
+    if isinstance(pharmacies, JSONResponse):
+        return pharmacies  # Ошибка апстрима поиска
+    stage_items.observe(len(pharmacies.pharmacies), "search")
+    if not pharmacies.pharmacies:
+        logger.error("No pharmacies found with the provided SKU data")
+        return JSONResponse(content={"error": "No pharmacies found with the provided SKU data"}, status_code=404)
+    dump_stage(trace, pharmacies.raw, 'data1_found_all.json')
+    search_fetched_at = pharmacies.fetched_at
+    search_columns = pharmacies.columns
+    pharmacies = pharmacies.pharmacies
+
+    if SCHEDULE_PREFILTER_CLOSED:
+        # Закрытые по расписанию аптеки не участвуют в отборе и не запрашиваются в URL_PRICE
+        pharmacies = prefilter_open_pharmacies(pharmacies, encoded_city)
+
+    #Save only pharmacies with all sku's in stock
+    #filtered_pharmacies = await filter_pharmacies(pharmacies)
+
+    # С обученной оценкой котировок ранжируется больше ближайших аптек, чем будет котироваться
+    use_estimator = QUOTE_ESTIMATOR_ENABLED and quote_estimator.ready and PIPELINE_MODE != "pipelined"
+    closest_limit = QUOTE_ESTIMATOR_CANDIDATES if use_estimator else None
+
+    prefetcher = None
+    if PIPELINE_MODE == "pipelined":
+        # Однопроходный отбор, котировки предварительного шорт-листа запрашиваются по ходу отбора
+        prefetcher = QuotePrefetcher(user_lat, user_lon, shared_quotes, deadline)
+        with stage_timer("select_candidates"):
+            try:
+                closest_pharmacies = await select_candidates_pipelined(pharmacies, user_lat, user_lon, prefetcher,
+                                                                       encoded_city=encoded_city)
+            except BaseException:
+                prefetcher.cancel()
+                raise
+        stage_items.observe(closest_pharmacies["candidates_count"], "filter_with_analogs")
+        if not closest_pharmacies["candidates_count"]:
+            logger.error("No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))")
+            return JSONResponse(content={"error": "No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))"}, status_code=404)
+    elif PIPELINE_MODE == "streaming":
+        # Однопроходный отбор без промежуточных списков
+        with stage_timer("select_candidates"):
+            closest_pharmacies = select_candidates(pharmacies, user_lat, user_lon, closest_limit=closest_limit,
+                                                   encoded_city=encoded_city)
+        stage_items.observe(closest_pharmacies["candidates_count"], "filter_with_analogs")
+        if not closest_pharmacies["candidates_count"]:
+            logger.error("No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))")
+            return JSONResponse(content={"error": "No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))"}, status_code=404)
+    else:
+        #Save pharmacies with analogs
+        with stage_timer("filter_with_analogs"):
+            analog_pharmacies = await filter_with_analogs(pharmacies, search_columns)
+        stage_items.observe(len(analog_pharmacies.get("filtered_pharmacies", [])), "filter_with_analogs")
+        if not analog_pharmacies.get("filtered_pharmacies"):
+            logger.error("No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))")
+            return JSONResponse(content={"error": "No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))"}, status_code=404)
+        if trace is not None:
+            dump_stage(trace, {"filtered_pharmacies": [{"pharmacy": candidate} for candidate in
+                                                       candidates_json(analog_pharmacies["filtered_pharmacies"])]},
+                       'data2_with_analogs.json')
+
+        with stage_timer("sort_pharmacies_by_fulfillment"):
+            top_pharmacies = await sort_pharmacies_by_fulfillment(analog_pharmacies)
+        if trace is not None:
+            dump_stage(trace, {"list_pharmacies": candidates_json(top_pharmacies["list_pharmacies"])},
+                       'data3_top_pharmacies.json')
+
+        with stage_timer("get_top_closest_pharmacies"):
+            closest_pharmacies = await get_top_closest_pharmacies(top_pharmacies, user_lat, user_lon, limit=closest_limit)
+    shadow_codes = None
+    if use_estimator:
+        # Котируются только аптеки, которые по оценке могут оказаться самыми дешевыми или самыми быстрыми;
+        # в теневых запросах котируются все, чтобы измерить, что теряет оценка
+        chosen = quote_estimator.choose(closest_pharmacies["list_pharmacies"], user_lat, user_lon,
+                                        encoded_city=encoded_city)
+        if random.random() < QUOTE_ESTIMATOR_SHADOW_RATE:
+            shadow_codes = {candidate.source.code for candidate in chosen}
+        else:
+            closest_pharmacies = {"list_pharmacies": chosen}
+    # Дальше (котировки, best_option, ответ) работают с публичным форматом, он строится только для шорт-листа
+    prefetched = {}
+    if prefetcher is not None:
+        closest_pharmacies, prefetched = prefetcher.finalize(closest_pharmacies["list_pharmacies"])
+    else:
+        closest_pharmacies = {"list_pharmacies": candidates_json(closest_pharmacies["list_pharmacies"])}
+    stage_items.observe(len(closest_pharmacies["list_pharmacies"]), "shortlist")
+    dump_stage(trace, closest_pharmacies, 'data4_closest_pharmacies.json')
+    if emit is not None:
+        emit("shortlist", {"list_pharmacies": closest_pharmacies["list_pharmacies"]})
+    if remaining_budget(deadline) == 0:
+        cancel_prefetched(prefetched)
+        return deadline_exceeded_response()
+
+    # Получение всех опций доставки
+    quote_stats = {}
+    with stage_timer("get_delivery_options"):
+        delivery_options = await get_delivery_options(closest_pharmacies, user_lat, user_lon, shared_quotes,
+                                                      on_quote=emit and (lambda quote: emit("quote", quote)),
+                                                      deadline=deadline, quote_stats=quote_stats,
+                                                      semaphore=prefetcher and prefetcher.semaphore,
+                                                      prefetched=prefetched)
+    if isinstance(delivery_options, JSONResponse):
+        return delivery_options  # Возвращаем JSONResponse сразу, если это ошибка
+    if shadow_codes is not None:
+        delivery_options = quote_estimator.evaluate(delivery_options, shadow_codes)
+    dump_stage(trace, delivery_options, 'data5_delivery_options.json')
+
+    # Выбор самой дешевой и самой быстрой аптеки
+    stage_items.observe(len(delivery_options), "delivery_options")
+    with stage_timer("best_option"):
+        result = await best_option(delivery_options, encoded_city=encoded_city)
+    if isinstance(result, dict):
+        # Выбор сделан не по всем аптекам шорт-листа: часть котировок опоздала или завершилась ошибкой
+        result["partial"] = bool(quote_stats.get("late") or quote_stats.get("failed"))
+        # Возраст ответа поиска, на котором сделан выбор; stale - ответ старше SEARCH_CACHE_TTL
+        result["data_age"] = round(max(0.0, time.time() - search_fetched_at), 1)
+        result["stale"] = result["data_age"] > SEARCH_CACHE_TTL
+    dump_stage(trace, result, 'data6_best_delivery_options.json')
+
+    return result
+
+
+class BasketSession:
+    """Корзина сессии /best_analog/session. По каждому товару хранится его столбец ответа поиска:
+    аптека -> (запись аптеки только с этим товаром, замены как в match_pharmacy_products или None, если
+    товар аптека не соберет). По аптекам ведутся суммы по столбцам, поэтому правка одного товара
+    пересчитывает только его столбец, а отбор шорт-листа идет по готовым числам."""
+
+    def __init__(self, session_id, encoded_city, user_lat, user_lon):
+        self.id = session_id
+        self.city = encoded_city
+        self.user_lat = user_lat
+        self.user_lon = user_lon
+        self.items = {}  # sku -> count_desired в порядке добавления
+        self.columns = {}  # sku -> {code: (PharmacyRecord, замены или None)}
+        self.fetched_at = {}  # sku -> время получения ответа поиска, из которого взят столбец
+        self.sources = {}  # code -> SourceRecord
+        self.order = {}  # code -> порядковый номер аптеки, разрешает равенство ключей отбора
+        self.present = {}  # code -> в скольких столбцах есть аптека
+        self.blocked = {}  # code -> сколько товаров аптека не соберет
+        self.replacements = {}  # code -> сколько товаров заменяется аналогами
+        self.distances = {}
+        self.quotes = {}  # code -> (ключ котировки, варианты доставки) для аптек шорт-листа
+        self.version = 0  # растет с каждой правкой; по нему воркер видит, что сессию правил другой воркер
+        self.lock = asyncio.Lock()
+
+    def spec(self):
+        """Описание корзины в формате запроса /best_analog - для восстановления сессии другим воркером."""
+        return {"city": self.city, "address": {"lat": self.user_lat, "lng": self.user_lon},
+                "skus": [{"sku": sku, "count_desired": count} for sku, count in self.items.items()],
+                "version": self.version}
+
+    def size(self):
+        return 1024 + 200 * sum(len(column) for column in self.columns.values())
+
+    def set_address(self, user_lat, user_lon):
+        """Меняет адрес и возвращает прежнее состояние адреса для restore_address."""
+        previous = (self.user_lat, self.user_lon, self.distances, self.quotes)
+        if (user_lat, user_lon) != (self.user_lat, self.user_lon):
+            self.user_lat, self.user_lon = user_lat, user_lon
+            self.distances = {}
+            self.quotes = {}  # Котировки зависят от адреса
+        return previous
+
+    def restore_address(self, previous):
+        """Возвращает адрес, расстояния и котировки, сохраненные set_address. True, если адрес изменился."""
+        changed = previous[:2] != (self.user_lat, self.user_lon)
+        self.user_lat, self.user_lon, self.distances, self.quotes = previous
+        return changed
+
+    def set_column(self, sku, count_desired, pharmacies, fetched_at=None):
+        """Заменяет столбец товара sku записями pharmacies (PharmacyRecord только с товарами sku), полученными
+        в fetched_at; pharmacies=None удаляет товар из корзины."""
+        for code, (_, matches) in self.columns.pop(sku, {}).items():
+            self._account(code, matches, -1)
+        if pharmacies is None:
+            self.items.pop(sku, None)
+            self.fetched_at.pop(sku, None)
+            return
+        self.items[sku] = count_desired
+        self.fetched_at[sku] = time.time() if fetched_at is None else fetched_at
+        column = {}
+        for pharmacy in pharmacies:
+            code = pharmacy.source.code
+            if code is None or code in column:
+                continue
+            self.order.setdefault(code, len(self.order))
+            self.sources[code] = pharmacy.source
+            matches = match_pharmacy_products(pharmacy)
+            column[code] = (pharmacy, matches)
+            self._account(code, matches, 1)
+        self.columns[sku] = column
+
+    def _account(self, code, matches, sign):
+        present = self.present.get(code, 0) + sign
+        if not present:
+            for totals in (self.present, self.blocked, self.replacements):
+                totals.pop(code, None)
+            return
+        self.present[code] = present
+        if matches is None:
+            self.blocked[code] = self.blocked.get(code, 0) + sign
+        else:
+            self.replacements[code] = self.replacements.get(code, 0) + sign * (len(matches) - matches.count(None))
+
+    def distance(self, code):
+        distance = self.distances.get(code)
+        if distance is None:
+            source = self.sources[code]
+            distance = math.inf if source.lat is None or source.lon is None else haversine_distance(
+                self.user_lat, self.user_lon, source.lat, source.lon)
+            self.distances[code] = distance
+        return distance
+
+    def candidate(self, code):
+        """Candidate аптеки по всем столбцам корзины (товары в порядке корзины)."""
+        products = []
+        matches = []
+        for sku in self.items:
+            pharmacy, column_matches = self.columns[sku][code]
+            products.extend(pharmacy.products)
+            matches.extend(column_matches)
+        return Candidate(PharmacyRecord({"source": self.sources[code].raw, "products": products}), tuple(matches),
+                         self.replacements[code])
+
+    def shortlist(self):
+        """Отбор как в select_candidates: FULFILLMENT_LIMIT аптек с наименьшим числом замен (при равенстве -
+        ближайшие), из них CLOSEST_PHARMACIES_LIMIT ближайших. Кандидат должен вернуть в поиске все товары
+        корзины, собрать каждый и хотя бы один заменить. Возвращает (список Candidate, число кандидатов)."""
+        basket_size = len(self.items)
+        entries = [
+            (self.replacements.get(code, 0), self.distance(code), self.order[code], code)
+            for code, present in self.present.items()
+            if present == basket_size and not self.blocked.get(code) and self.replacements.get(code)
+        ]
+        fewest = heapq.nsmallest(FULFILLMENT_LIMIT, entries)
+        closest = heapq.nsmallest(CLOSEST_PHARMACIES_LIMIT, (entry for entry in fewest if entry[1] != math.inf),
+                                  key=lambda entry: (entry[1], entry[2]))
+        return [self.candidate(entry[3]) for entry in closest], len(entries)
+
+
+def split_search_columns(pharmacies, skus):
+    """Разбивает записи аптек ответа поиска на столбцы по товарам: {sku: [PharmacyRecord с товарами sku]}."""
+    columns = {sku: [] for sku in skus}
+    for pharmacy in pharmacies:
+        products_by_sku = defaultdict(list)
+        for product in pharmacy.products:
+            if product.get("sku") in columns:
+                products_by_sku[product["sku"]].append(product)
+        for sku, products in products_by_sku.items():
+            columns[sku].append(PharmacyRecord({"source": pharmacy.source.raw, "products": products}))
+    return columns
+
+
+async def search_basket(encoded_city, payload, deadline=None):
+    """Поиск корзины с учетом бюджета запроса: SearchResult или JSONResponse с ошибкой."""
+    search_timeout = budget_timeout(UPSTREAM_TIMEOUTS["search"], deadline)
+    with stage_timer("search"):
+        try:
+            return await asyncio.wait_for(find_medicines_in_pharmacies(encoded_city, payload, search_timeout, deadline),
+                                          remaining_budget(deadline))
+        except asyncio.TimeoutError:
+            return deadline_exceeded_response()
+
+
+async def create_basket_session(request_data, session_id=None, deadline=None):
+    """Новая сессия по телу запроса /best_analog: один поиск всей корзины, разбитый на столбцы.
+    Возвращает BasketSession или JSONResponse с ошибкой."""
+    basket = parse_basket_request(request_data)
+    if isinstance(basket, JSONResponse):
+        return basket
+    encoded_city, payload, user_lat, user_lon = basket
+    result = await search_basket(encoded_city, payload, deadline)
+    if isinstance(result, JSONResponse):
+        return result
+    session = BasketSession(session_id or uuid.uuid4().hex, encoded_city, user_lat, user_lon)
+    columns = split_search_columns(result.pharmacies, [item["sku"] for item in payload])
+    for item in payload:
+        session.set_column(item["sku"], item["count_desired"], columns[item["sku"]], result.fetched_at)
+    return session
+
+
+async def update_basket_session(session, changes, deadline=None):
+    """Применяет правки {sku: count_desired} (0 - удалить товар): по каждому измененному товару -
+    отдельный поиск только этого товара. Возвращает число запрошенных товаров или JSONResponse с ошибкой."""
+    searched = {sku: count for sku, count in changes.items() if count > 0 and session.items.get(sku) != count}
+    results = await asyncio.gather(*(search_basket(session.city, [{"sku": sku, "count_desired": count}], deadline)
+                                      for sku, count in searched.items()))
+    for result in results:
+        if isinstance(result, JSONResponse):
+            return result  # Корзина сессии не меняется, пока не получены все столбцы
+    for (sku, count), result in zip(searched.items(), results):
+        session.set_column(sku, count, split_search_columns(result.pharmacies, [sku])[sku], result.fetched_at)
+    for sku, count in changes.items():
+        if count == 0 and sku in session.items:
+            session.set_column(sku, 0, None)
+    await save_basket_session(session)
+    return len(searched)
+
+
+async def evaluate_basket_session(session, deadline=None):
+    """Шорт-лист, котировки и best_option для текущей корзины сессии. Котировки запрашиваются только для
+    аптек, которые вошли в шорт-лист (и, с SESSION_REQUOTE_CHANGED_ITEMS, у которых изменился состав
+    доставки); для остальных используются сохраненные варианты доставки с пересчитанной суммой."""
+    if not session.items:
+        return JSONResponse(content={"error": "Session basket is empty"}, status_code=400)
+    with stage_timer("session_shortlist"):
+        candidates, candidates_count = session.shortlist()
+    stage_items.observe(candidates_count, "filter_with_analogs")
+    if not candidates_count:
+        return JSONResponse(content={"error": "No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))"}, status_code=404)
+    shortlist = {pharmacy["source"]["code"]: pharmacy for pharmacy in candidates_json(candidates)}
+
+    # Котировки аптек, выпавших из шорт-листа, забываются: при возвращении они котируются заново
+    for code in list(session.quotes):
+        if code not in shortlist:
+            del session.quotes[code]
+    quote_keys = {code: quote_cache_key(code, build_delivery_items(pharmacy), session.user_lat, session.user_lon)
+                  for code, pharmacy in shortlist.items()}
+    to_quote = [pharmacy for code, pharmacy in shortlist.items()
+                if code not in session.quotes or (SESSION_REQUOTE_CHANGED_ITEMS and session.quotes[code][0] != quote_keys[code])]
+    session_quotes.inc("requested", amount=len(to_quote))
+    session_quotes.inc("reused", amount=len(shortlist) - len(to_quote))
+
+    quote_stats = {}
+    if to_quote:
+        with stage_timer("get_delivery_options"):
+            rows = await get_delivery_options({"list_pharmacies": to_quote}, session.user_lat, session.user_lon,
+                                              deadline=deadline, quote_stats=quote_stats)
+        if isinstance(rows, JSONResponse):
+            if len(to_quote) == len(shortlist):
+                return rows
+            rows = []  # Выбор делается по сохраненным котировкам остальных аптек
+            quote_stats["failed"] = len(to_quote)
+        options = defaultdict(list)
+        for row in rows:
+            options[row["pharmacy"]["source"]["code"]].append(row["delivery_option"])
+        for code, code_options in options.items():
+            session.quotes[code] = (quote_keys[code], code_options)
+
+    delivery_data = [
+        {"pharmacy": pharmacy, "total_price": pharmacy.get("total_sum", 0) + option["price"], "delivery_option": option}
+        for code, pharmacy in shortlist.items() if code in session.quotes
+        for option in session.quotes[code][1]
+    ]
+    with stage_timer("best_option"):
+        result = await best_option(delivery_data, encoded_city=session.city)
+    if isinstance(result, dict):
+        result["partial"] = bool(quote_stats.get("late") or quote_stats.get("failed"))
+        # Возраст самого старого столбца корзины, как data_age в /best_analog
+        result["data_age"] = round(max(0.0, time.time() - min(session.fetched_at.values())), 1)
+        result["stale"] = result["data_age"] > SEARCH_CACHE_TTL
+        result["session"] = {"id": session.id, "skus": len(session.items), "quoted": len(to_quote),
+                             "reused_quotes": len(shortlist) - len(to_quote)}
+    return result
+
+
+sessions = TTLCache("session", SESSION_TTL, SESSION_CACHE_MAX_BYTES, sizeof=lambda session: session.size())
+
+
+async def save_basket_session(session):
+    """Сохраняет правку сессии (и продлевает ее срок). При общем кэше описание корзины записывается туда
+    до ответа клиенту, чтобы следующую правку мог принять любой воркер."""
+    session.version += 1
+    sessions.set(session.id, session)
+    if shared_cache is not None:
+        entry = (f"session:{session.id}", dumps_bytes(session.spec()), time.time() + SESSION_TTL)
+        await asyncio.to_thread(shared_cache.set_many, [entry])
+
+
+async def load_basket_session(session_id, deadline=None):
+    """Сессия воркера, а при общем кэше - сверенная с описанием оттуда: если сессию правил или создал
+    другой воркер, она восстанавливается по описанию (поиск корзины обычно попадает в кэш).
+    Возвращает BasketSession, None (сессии нет) или JSONResponse с ошибкой восстановления."""
+    session = sessions.get(session_id)
+    if shared_cache is None:
+        return session
+    row = shared_cache.get(f"session:{session_id}")
+    if row is None or not row[0]:
+        sessions.remove(session_id)  # Удалена или истекла
+        return None
+    spec = loads_bytes(row[0])
+    if session is not None and session.version >= spec["version"]:
+        return session
+    session = await create_basket_session(spec, session_id, deadline)
+    if isinstance(session, BasketSession):
+        session.version = spec["version"]
+        sessions.set(session_id, session)
+    return session
+
+
+def session_response(session, result, compact=False):
+    response = render_result(result, compact)
+    response.headers[SESSION_ID_HEADER] = session.id
+    return response
+
+
+@app.post("/best_analog/session")
+async def create_session(request: Request):
+    """Создает сессию корзины (тело как у /best_analog) и возвращает первый результат; id сессии - в поле
+    session.id и заголовке X-Session-Id."""
+    try:
+        deadline = get_request_deadline(request)
+    except ValueError:
+        return JSONResponse(content={"error": f"Invalid {REQUEST_DEADLINE_HEADER} header"}, status_code=400)
+    try:
+        request_data = await request.json()
+    except json.JSONDecodeError:
+        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
+
+    try:
+        session = await create_basket_session(request_data, deadline=deadline)
+        if isinstance(session, JSONResponse):
+            return session
+        await save_basket_session(session)
+        async with session.lock:
+            result = await evaluate_basket_session(session, deadline)
+        return session_response(session, result, wants_compact(request))
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+
+
+@app.patch("/best_analog/session/{session_id}")
+async def update_session(session_id: str, request: Request):
+    """Правка корзины сессии: {"skus": [{"sku": ..., "count_desired": ...}], "address": {...}} - товары
+    добавляются или меняют количество, count_desired=0 удаляет товар; address необязателен."""
+    try:
+        deadline = get_request_deadline(request)
+    except ValueError:
+        return JSONResponse(content={"error": f"Invalid {REQUEST_DEADLINE_HEADER} header"}, status_code=400)
+    try:
+        request_data = await request.json()
+    except json.JSONDecodeError:
+        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
+
+    if not isinstance(request_data, dict) or not isinstance(request_data.get("skus", []), list):
+        return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
+    changes = {}
+    for item in request_data.get("skus", []):
+        if not isinstance(item, dict) or not isinstance(item.get("sku"), str) \
+                or not isinstance(item.get("count_desired"), int) or item["count_desired"] < 0:
+            return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
+        changes[item["sku"]] = item["count_desired"]
+    address = request_data.get("address")
+    if address is not None and (not isinstance(address, dict) or not isinstance(address.get("lat"), (int, float))
+                                or not isinstance(address.get("lng"), (int, float))):
+        return JSONResponse(content={"error": "Invalid data type for user coordinates"}, status_code=400)
+
+    try:
+        session = await load_basket_session(session_id, deadline)
+        if session is None:
+            return JSONResponse(content={"error": "Unknown or expired session"}, status_code=404)
+        if isinstance(session, JSONResponse):
+            return session
+        async with session.lock:
+            previous_address = None
+            if address is not None:
+                previous_address = session.set_address(address["lat"], address["lng"])
+
+            async def rollback_address():
+                # Новый адрес применяется, только если по нему получен результат; иначе сессия остается
+                # с прежним адресом и его котировками (правка товаров, если поиск прошел, сохраняется)
+                if previous_address is not None and session.restore_address(previous_address):
+                    await save_basket_session(session)
+
+            try:
+                searched = await update_basket_session(session, changes, deadline)
+                if isinstance(searched, JSONResponse):
+                    await rollback_address()
+                    return searched
+                result = await evaluate_basket_session(session, deadline)
+            except Exception:
+                await rollback_address()
+                raise
+            if isinstance(result, JSONResponse):
+                await rollback_address()
+        if isinstance(result, dict):
+            result["session"]["searched_skus"] = searched
+        return session_response(session, result, wants_compact(request))
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+
+
+@app.delete("/best_analog/session/{session_id}")
+async def delete_session(session_id: str):
+    sessions.remove(session_id)
+    if shared_cache is not None:
+        # Запись с истекшим сроком для общего кэша все равно что удаленная
+        await asyncio.to_thread(shared_cache.set_many, [(f"session:{session_id}", b"", time.time())])
+    return {"status": "ok"}
+
+
+async def find_medicines_in_pharmacies(encoded_city, payload, timeout=None, deadline=None):
+    if not SEARCH_CACHE_ENABLED:
+        return await fetch_search_results(encoded_city, payload, timeout, deadline)
+    key = search_cache_key(encoded_city, payload)
+    # Загрузка общая для всех ожидающих, поэтому идет с обычным таймаутом апстрима, а не с бюджетом
+    # первого запроса; каждый запрос ждет ее в пределах своего дедлайна
+    return await search_cache.get_or_load(key, lambda: fetch_search_results(encoded_city, payload))
+
+
+async def fetch_search_results(encoded_city, payload, timeout=None, deadline=None):
+    """Запрос к URL_SEARCH; timeout - таймаут вызова (по умолчанию таймаут клиента апстрима),
+    deadline - момент time.monotonic(), к которому нужен ответ (см. upstream_post)."""
+    kwargs = {} if timeout is None else {"timeout": httpx.Timeout(timeout, connect=min(timeout, HTTP_CONNECT_TIMEOUT))}
+    try:
+        response = await upstream_post("search", URL_SEARCH, deadline, params={"city": encoded_city}, json=payload,
+                                       **kwargs)
+        response.raise_for_status()
+        data = response.json()
+        # Проверка на наличие ожидаемых ключей в ответе
+        if not isinstance(data, dict) or "result" not in data:
+            return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
+        return search_result_from_data(encoded_city, data)
+    except ValueError as e:
+        # Тело ответа не JSON
+        logger.error(f"Invalid response from URL_SEARCH: {e}")
+        return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
+    except httpx.RequestError as e:
+        logger.error(f"Request error while accessing URL_SEARCH: {e}")
+        return JSONResponse(content={"error": "Request error while accessing search API"}, status_code=503)
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error while accessing URL_SEARCH: {e}")
+        return JSONResponse(content={"error": f"HTTP error {e.response.status_code}"},
+                            status_code=e.response.status_code)
+    except asyncio.TimeoutError:
+        logger.error("Timeout while accessing URL_SEARCH")
+        return JSONResponse(content={"error": "Timeout while accessing search API"}, status_code=504)
+
+
+class CatalogWarmer:
+    """Прогрев при старте и фоновое обновление ответов поиска. Отдельного источника данных об аптеках нет,
+    поэтому координаты и расписания по городам (индексы для выбора ближайших и фильтра по режиму работы)
+    набираются из ответов поиска для корзин из WARMUP_BASKETS_FILE, самых частых корзин этого воркера и
+    списка, сохраненного в общем кэше другими воркерами."""
+
+    # Каждый воркер хранит свой список под ключом с pid, чтобы списки не затирали друг друга;
+    # списки остановленных воркеров истекают через несколько интервалов обновления
+    SHARED_PREFIX = "warmup:baskets:"
+
+    def __init__(self):
+        self.ready = not WARMUP_ENABLED
+        self.popularity = defaultdict(int)  # ключ кэша поиска -> число запросов
+        self.baskets = {}  # ключ кэша поиска -> (город, payload)
+        self.records = 0
+        self.task = None
+        self.runs = 0
+        self.loaded = 0
+        self.failed = 0
+        self.last_duration = None
+        self.last_run_at = None
+
+    def record(self, encoded_city, payload):
+        key = search_cache_key(encoded_city, payload)
+        self.popularity[key] += 1
+        self.baskets[key] = (encoded_city, payload)
+        # Старые корзины постепенно забываются: раз в N запросов счетчики делятся пополам,
+        # так что проход по всем корзинам делится между N вызовами
+        self.records += 1
+        if self.records % max(1000, 10 * WARMUP_POPULAR_BASKETS) == 0:
+            for key in list(self.popularity):
+                self.popularity[key] //= 2
+                if not self.popularity[key]:
+                    del self.popularity[key]
+                    del self.baskets[key]
+
+    def popular_baskets(self):
+        keys = heapq.nlargest(WARMUP_POPULAR_BASKETS, self.popularity, key=self.popularity.get)
+        return [self.baskets[key] for key in keys]
+
+    def configured_baskets(self):
+        """Корзины из WARMUP_BASKETS_FILE и общего кэша: список (город, payload)."""
+        raw_baskets = []
+        if WARMUP_BASKETS_FILE:
+            try:
+                with open(WARMUP_BASKETS_FILE, encoding="utf-8") as file:
+                    raw_baskets.extend(json.load(file))
+            except (OSError, ValueError, TypeError) as e:
+                logger.error(f"Cannot read WARMUP_BASKETS_FILE {WARMUP_BASKETS_FILE}: {e}")
+        if shared_cache is not None:
+            for key, value in shared_cache.scan(self.SHARED_PREFIX):
+                try:
+                    raw_baskets.extend(loads_bytes(value))
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"Skipping unreadable warm-up list {key}: {e}")
+
+        baskets = {}
+        for basket in raw_baskets:
+            try:
+                encoded_city = basket["city"]
+                payload = [{"sku": item["sku"], "count_desired": item["count_desired"]} for item in basket["skus"]]
+            except (KeyError, TypeError):
+                logger.warning(f"Skipping invalid warm-up basket: {basket!r}")
+                continue
+            if encoded_city and payload:
+                baskets[search_cache_key(encoded_city, payload)] = (encoded_city, payload)
+        return list(baskets.values())
+
+    async def warm(self, baskets):
+        """Загружает ответы поиска для корзин в обход кэша и кладет их в кэш; индексы городов
+        обновляются в fetch_search_results."""
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+        unique = {search_cache_key(encoded_city, payload): (encoded_city, payload) for encoded_city, payload in baskets}
+
+        async def load(key, encoded_city, payload):
+            try:
+                async with semaphore:
+                    result = await fetch_search_results(encoded_city, payload)
+            except Exception as e:
+                # Ошибка одной корзины не должна прерывать прогрев остальных
+                logger.error(f"Warm-up failed for city {encoded_city}: {type(e).__name__}: {e}")
+                self.failed += 1
+                return
+            if isinstance(result, JSONResponse):
+                self.failed += 1
+                return
+            self.loaded += 1
+            if SEARCH_CACHE_ENABLED:
+                search_cache.set(key, result)
+
+        await asyncio.gather(*(load(key, *basket) for key, basket in unique.items()))
+        self.runs += 1
+        self.last_duration = time.monotonic() - started
+        self.last_run_at = time.time()
+        logger.info(f"Warm-up: {len(unique)} baskets in {self.last_duration:.2f} s")
+
+    async def run(self):
+        try:
+            await asyncio.wait_for(self.warm(self.configured_baskets()), WARMUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Warm-up did not finish in {WARMUP_TIMEOUT} s, reporting ready anyway")
+        except Exception as e:
+            logger.exception(f"Warm-up failed, reporting ready anyway: {e}")
+        finally:
+            self.ready = True
+        while WARMUP_REFRESH_INTERVAL > 0:
+            await asyncio.sleep(WARMUP_REFRESH_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.exception(f"Warm-up refresh failed: {e}")
+
+    async def refresh(self):
+        popular = self.popular_baskets()
+        if shared_cache is not None and popular:
+            baskets = [{"city": encoded_city, "skus": payload} for encoded_city, payload in popular]
+            expires_at = time.time() + 3 * WARMUP_REFRESH_INTERVAL
+            shared_cache.set_later([(f"{self.SHARED_PREFIX}{os.getpid()}", dumps_bytes(baskets), expires_at)])
+        await self.warm(self.configured_baskets() + popular)
+
+    def stats(self):
+        return {
+            "enabled": WARMUP_ENABLED,
+            "ready": self.ready,
+            "runs": self.runs,
+            "loaded": self.loaded,
+            "failed": self.failed,
+            "last_duration_s": None if self.last_duration is None else round(self.last_duration, 3),
+            "last_run_seconds_ago": None if self.last_run_at is None else round(time.time() - self.last_run_at, 1),
+            "tracked_baskets": len(self.popularity),
+            # Сколько аптек с координатами и расписаниями известно по каждому городу без запроса к апстриму
+            "cities": {
+                city: {"locations": len(city_spatial_indexes[city].locations) if city in city_spatial_indexes else 0,
+                       "schedules": len(city_schedule_indexes.get(city, {}))}
+                for city in city_spatial_indexes.keys() | city_schedule_indexes.keys()
+            },
+        }
+
+
+catalog_warmer = CatalogWarmer()
+
+
+@app.on_event("startup")
+async def start_catalog_warmer():
+    if WARMUP_ENABLED:
+        catalog_warmer.task = asyncio.create_task(catalog_warmer.run())
+
+
+@app.on_event("shutdown")
+async def stop_catalog_warmer():
+    if catalog_warmer.task is not None:
+        catalog_warmer.task.cancel()
+
+
+@app.get("/ready")
+async def readiness():
+    """Готовность к трафику: 503, пока идет прогрев (WARMUP_ENABLED)."""
+    return JSONResponse(content=catalog_warmer.stats(), status_code=200 if catalog_warmer.ready else 503)
+
+
+# QUANTITY_ADJUSTMENT = 1  # Количество продуктов, которое будет добавлено к каждому продукту в списке продуктов аптеки
+#
+# async def find_medicines_in_pharmacies(encoded_city, payload):
+#
+#     if isinstance(payload, list):
+#         # Увеличиваем count_desired на QUANTITY_ADJUSTMENT для каждого элемента в списке
+#         print(f"payload before adjustment: {payload}")
+#         for sku in payload:
+#             if isinstance(sku, dict) and "count_desired" in sku:
+#                 sku["count_desired"] += QUANTITY_ADJUSTMENT
+#         print(f"payload after adjustment: {payload}")
+#     else:
+#         # Логирование ошибки структуры payload
+#         logger.error("Payload должен быть списком словарей с ключом 'count_desired'.")
+#
+#     async with httpx.AsyncClient() as client:
+#         try:
+#             response = await client.post(URL_SEARCH, params={"city": encoded_city}, json=payload)
+#             response.raise_for_status()
+#             data = response.json()
+#             save_response_to_file(data, file_name='data_pharmacies.json')
+#
+#             # Проверка корректности данных от API
+#             if not isinstance(data, dict) or "result" not in data:
+#                 return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
+#
+#             # Применяем корректировку после получения данных
+#             for pharmacy in data.get("result", []):
+#                 # Проверка, что source_tags - это список
+#                 source_tags = pharmacy.get("source", {}).get("source_tags", [])
+#                 has_stock_tag = False
+#                 stock_meta_value = None
+#
+#                 if isinstance(source_tags, list):
+#                     for tag in source_tags:
+#                         if isinstance(tag, dict) and tag.get("id") == 1080:
+#                             has_stock_tag = True
+#                             stock_meta_value = tag.get("meta")
+#                             break
+#
+#                 # Корректируем каждый товар и его аналоги в зависимости от правил
+#                 for product in pharmacy.get("products", []):
+#                     if not isinstance(product, dict):
+#                         continue  # Пропустить, если структура продукта некорректна
+#
+#                     # Корректировка основного продукта
+#                     original_count_desired = product.get("count_desired", 0)
+#                     original_quantity = product.get("quantity", 0)
+#
+#                     if has_stock_tag and stock_meta_value == "0":
+#                         if original_count_desired == original_quantity:
+#                             product["count_desired"] = max(0, original_count_desired - QUANTITY_ADJUSTMENT)
+#                             product["quantity"] = max(0, original_quantity - QUANTITY_ADJUSTMENT)
+#                         else:
+#                             product["count_desired"] = max(0, original_count_desired - QUANTITY_ADJUSTMENT)
+#                     else:
+#                         product["count_desired"] = max(0, original_count_desired - QUANTITY_ADJUSTMENT)
+#                         product["quantity"] = max(0, original_quantity - QUANTITY_ADJUSTMENT)
+#
+#                     # Корректировка аналогов, если они есть
+#                     if "analogs" in product and isinstance(product["analogs"], list):
+#                         for analog in product["analogs"]:
+#                             if isinstance(analog, dict):
+#                                 analog_original_count_desired = analog.get("quantity_desired", 0)
+#                                 analog_original_quantity = analog.get("quantity", 0)
+#
+#                                 if has_stock_tag and stock_meta_value == "0":
+#                                     if analog_original_count_desired == analog_original_quantity:
+#                                         analog["quantity_desired"] = max(0, analog_original_count_desired - QUANTITY_ADJUSTMENT)
+#                                         analog["quantity"] = max(0, analog_original_quantity - QUANTITY_ADJUSTMENT)
+#                                     else:
+#                                         analog["quantity_desired"] = max(0, analog_original_count_desired - QUANTITY_ADJUSTMENT)
+#                                 else:
+#                                     analog["quantity_desired"] = max(0, analog_original_count_desired - QUANTITY_ADJUSTMENT)
+#                                     analog["quantity"] = max(0, analog_original_quantity - QUANTITY_ADJUSTMENT)
+#
+#             return data
+#
+#         except httpx.RequestError as e:
+#             logger.error(f"Request error while accessing URL_SEARCH: {e}")
+#             return JSONResponse(content={"error": "Request error while accessing search API"}, status_code=503)
+#         except httpx.HTTPStatusError as e:
+#             logger.error(f"HTTP error while accessing URL_SEARCH: {e}")
+#             return JSONResponse(content={"error": f"HTTP error {e.response.status_code}"}, status_code=e.response.status_code)
+
+
+
+
+# мок для тестирования локальных результатов поиска
+# async def find_medicines_in_pharmacies(encoded_city, payload):
+#     async with httpx.AsyncClient() as client:
+#         response = await client.get("http://localhost:8002/search_medicines")
+#         response.raise_for_status()  # Проверка на ошибки
+#         data = response.json()  # Получаем JSON
+#         save_response_to_file(data, file_name='data1_found_all.json')
+#         return data  # Возвращаем JSON данные
+
+
+# Внутреннее представление ответа поиска. Записи создаются один раз при разборе ответа URL_SEARCH
+# (и живут в кэше вместе с ним), содержат только нужные конвейеру поля и ссылку на исходный dict (raw),
+# из которого публичный JSON собирается уже для итогового шорт-листа. Товары хранятся колонками внутри
+# PharmacyRecord: отдельный объект на каждый товар заметно нагружает сборщик мусора при разборе.
+def coordinate(value):
+    """Координата из ответа поиска; не число - то же, что отсутствующая координата."""
+    return value if isinstance(value, (int, float)) else None
+
+
+class SourceRecord:
+    __slots__ = ("code", "lat", "lon", "raw")
+
+    def __init__(self, raw):
+        self.code = raw.get("code")
+        self.lat = coordinate(raw.get("lat"))
+        self.lon = coordinate(raw.get("lon"))
+        self.raw = raw
+
+
+class AnalogRecord:
+    __slots__ = ("sku", "quantity", "base_price", "raw")
+
+    def __init__(self, raw):
+        self.sku = raw["sku"]
+        self.quantity = raw["quantity"]
+        self.base_price = raw["base_price"]
+        self.raw = raw
+
+
+def parse_analogs(analogs):
+    """AnalogRecord для аналогов товара; аналог без sku, остатка или цены не может стать заменой и пропускается."""
+    try:
+        return tuple(map(AnalogRecord, analogs or ()))
+    except KeyError:
+        return tuple(AnalogRecord(analog) for analog in analogs
+                     if "sku" in analog and "quantity" in analog and "base_price" in analog)
+
+
+class PharmacyRecord:
+    """Аптека из ответа поиска; i-й товар - products[i] (исходный dict), quantities[i],
+    quantities_desired[i] и analogs[i] (AnalogRecord). Товар без quantity или quantity_desired
+    аптека собрать не может: желаемое количество для него - бесконечность, так что оба движка подбора
+    отбрасывают такую аптеку одинаково."""
+    __slots__ = ("source", "products", "quantities", "quantities_desired", "analogs")
+
+    def __init__(self, raw):
+        products = raw.get("products", [])
+        self.source = SourceRecord(raw.get("source", {}))
+        self.products = products
+        try:
+            self.quantities = tuple(map(itemgetter("quantity"), products))
+            self.quantities_desired = tuple(map(itemgetter("quantity_desired"), products))
+        except KeyError:
+            complete = ["quantity" in product and "quantity_desired" in product for product in products]
+            self.quantities = tuple(product["quantity"] if ok else 0 for product, ok in zip(products, complete))
+            self.quantities_desired = tuple(product["quantity_desired"] if ok else math.inf
+                                            for product, ok in zip(products, complete))
+        # Аналоги участвуют в подборе только для товаров, которых не хватает, - только для них и разбираются
+        self.analogs = tuple(
+            parse_analogs(product.get("analogs")) if quantity < quantity_desired else ()
+            for product, quantity, quantity_desired in zip(products, self.quantities, self.quantities_desired)
+        )
+
+
+class Candidate:
+    """Аптека, собравшая корзину: для каждого товара - None (товар в наличии) или аналог-замена."""
+    __slots__ = ("pharmacy", "matches", "replacements_needed", "_total_sum")
+
+    def __init__(self, pharmacy, matches, replacements_needed):
+        self.pharmacy = pharmacy
+        self.matches = matches
+        self.replacements_needed = replacements_needed
+        self._total_sum = None  # Считается при первом обращении: нужна только кандидатам шорт-листа
+
+    @property
+    def source(self):
+        return self.pharmacy.source
+
+    def updated_products(self):
+        """Товары в публичном формате: у замененного товара в "analogs" только выбранная замена."""
+        return [
+            product if analog is None
+            # Исходный ответ поиска не меняем, он лежит в кэше
+            else {**product, "analogs": [build_replacement_product(product, analog.raw)]}
+            for product, analog in zip(self.pharmacy.products, self.matches)
+        ]
+
+    @property
+    def total_sum(self):
+        if self._total_sum is None:
+            self._total_sum = basket_total_sum(self.updated_products())
+        return self._total_sum
+
+    def to_json(self):
+        """Запись аптеки-кандидата в публичном формате (как pharmacy в ответе filter_with_analogs)."""
+        updated_products = self.updated_products()
+        if self._total_sum is None:
+            self._total_sum = basket_total_sum(updated_products)
+        return {
+            "source": self.pharmacy.source.raw,  # Only include the pharmacy source info here
+            "products": updated_products,  # Keep the updated products with analogs
+            "total_sum": self._total_sum,  # Include total price of the pharmacy
+            "replacements_needed": self.replacements_needed,  # Track the number of replacements
+            # Store the SKUs of original and replacements
+            "replaced_skus": [
+                {"original_sku": product["sku"], "replacement_sku": analog.sku}
+                for product, analog in zip(self.pharmacy.products, self.matches) if analog is not None
+            ],
+        }
+
+
+def search_result_from_data(encoded_city, data, fetched_at=None):
+    """SearchResult из ответа URL_SEARCH (своего или из общего кэша) с обновлением индексов города."""
+    result = SearchResult(data, fetched_at)
+    update_city_spatial_index(encoded_city, result.pharmacies)
+    update_city_schedule_index(encoded_city, result.pharmacies)
+    return result
+
+
+class SearchResult:
+    """Ответ URL_SEARCH: исходный JSON (для дампов), разобранные записи аптек, их колонки для движка
+    columnar (None для других движков) и время получения от апстрима."""
+    __slots__ = ("raw", "pharmacies", "columns", "fetched_at")
+
+    def __init__(self, raw, fetched_at=None):
+        self.raw = raw
+        self.pharmacies = parse_search_response(raw)
+        # Колонки строятся один раз при разборе, а не в каждом запросе с этим ответом из кэша
+        self.columns = AnalogColumns(self.pharmacies) if ANALOG_ENGINE == "columnar" else None
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+
+def parse_search_response(data):
+    """Записи аптек из ответа URL_SEARCH. Аптеки с некорректными данными (source не объект, товар без
+    quantity/quantity_desired, аналог без sku/quantity/base_price) пропускаются с предупреждением в логе."""
+    pharmacies = data.get("result") or []
+    try:
+        return list(map(PharmacyRecord, pharmacies))
+    except (AttributeError, KeyError, TypeError):
+        pass
+    records = []
+    skipped = 0
+    for raw in pharmacies:
+        try:
+            records.append(PharmacyRecord(raw))
+        except (AttributeError, KeyError, TypeError) as e:
+            if not skipped:
+                logger.warning(f"Malformed pharmacy in search response: {e!r}")
+            skipped += 1
+    logger.warning(f"Skipped {skipped} of {len(pharmacies)} malformed pharmacies in search response")
+    return records
+
+
+def search_result_size(result):
+    """Размер ответа поиска для кэша: JSON, примерная стоимость записей (~100 байт на запись) и колонки."""
+    records = sum(len(analogs) for pharmacy in result.pharmacies for analogs in pharmacy.analogs)
+    columns = result.columns.nbytes if result.columns is not None else 0
+    return estimate_size(result.raw) + 100 * (records + len(result.pharmacies)) + columns
+
+
+def basket_total_sum(updated_products):
+    """Стоимость корзины аптеки по товарам в публичном формате."""
+    return sum(
+        # Если у продукта есть аналог с достаточным количеством, используем его для подсчета суммы
+        (product["analogs"][0]["base_price"] * product["analogs"][0]["quantity_desired"]
+         if product.get("analogs") and product["analogs"][0]["quantity"] >= product["quantity_desired"]
+         # Иначе считаем только основной продукт, если его количество соответствует желаемому
+         else product["base_price"] * product["quantity_desired"] if product["quantity"] >= product[
+            "quantity_desired"] else 0)
+        for product in updated_products
+    )
+
+
+def candidates_json(candidates):
+    return [candidate.to_json() for candidate in candidates]
+
+
+# Фильтр аптек с анадлами
+def build_replacement_product(product, cheapest_analog):
+    """Запись для замены продукта его аналогом."""
+    return {
+        "source_code": cheapest_analog["source_code"],
+        "sku": cheapest_analog["sku"],
+        "name": cheapest_analog["name"],
+        "base_price": cheapest_analog["base_price"],
+        "price_with_warehouse_discount": cheapest_analog["price_with_warehouse_discount"],
+        "warehouse_discount": cheapest_analog["warehouse_discount"],
+        "quantity": cheapest_analog["quantity"],
+        "quantity_desired": product["quantity_desired"],
+        "pp_packing": cheapest_analog.get("pp_packing", ""),
+        "manufacturer_id": cheapest_analog.get("manufacturer_id", ""),
+        "recipe_needed": cheapest_analog.get("recipe_needed", False),
+        "strong_recipe": cheapest_analog.get("strong_recipe", False),
+    }
+
+
+async def filter_with_analogs(pharmacies, columns=None):
+    """Аптеки (список PharmacyRecord), собравшие корзину хотя бы с одной заменой: {"filtered_pharmacies": [Candidate]}.
+    columns - AnalogColumns ответа поиска, из которого взяты аптеки (SearchResult.columns)."""
+    if ANALOG_ENGINE == "columnar":
+        return filter_with_analogs_columnar(pharmacies, columns)
+
+    # Save only pharmacies where at least one replacement was made
+    return {"filtered_pharmacies": list(iter_matched_pharmacies(pharmacies))}
+
+
+def match_pharmacy_products(pharmacy):
+    """Подбирает для каждого товара аптеки сам товар или самый дешевый аналог.
+    Возвращает кортеж (None - товар в наличии, иначе аналог) по товарам аптеки
+    или None, если аптека не может собрать корзину."""
+    matches = []
+
+    # Check all products in the pharmacy
+    for quantity, quantity_desired, analogs in zip(pharmacy.quantities, pharmacy.quantities_desired, pharmacy.analogs):
+        if quantity >= quantity_desired:
+            # Product has sufficient stock, add it as is
+            matches.append(None)
+        elif analogs:
+            # Фильтруем аналоги, у которых количество больше или равно желаемому
+            available_analogs = [analog for analog in analogs if analog.quantity >= quantity_desired]
+
+            # Проверяем, что у нас есть аналоги с достаточным количеством
+            if not available_analogs:
+                # Если нет аналога с достаточным количеством, аптека не подходит
+                return None
+
+            # Находим самый дешевый среди доступных аналогов
+            matches.append(min(available_analogs, key=attrgetter("base_price")))
+        else:
+            # Если нет достаточного количества оригинала и аналогов, аптека не подходит
+            return None
+
+    return tuple(matches)
+
+
+def match_candidate(pharmacy):
+    """Candidate для аптеки, собравшей корзину хотя бы с одной заменой, иначе None."""
+    matches = match_pharmacy_products(pharmacy)
+    if matches is None:
+        return None
+    replacements_needed = len(matches) - matches.count(None)
+    if replacements_needed > 0:
+        return Candidate(pharmacy, matches, replacements_needed)
+    return None
+
+
+def iter_matched_pharmacies(pharmacies):
+    """Генератор кандидатов (Candidate): аптеки, собравшие корзину хотя бы с одной заменой."""
+    for pharmacy in pharmacies:
+        candidate = match_candidate(pharmacy)
+        if candidate is not None:
+            yield candidate
+
+
+def candidate_distance(candidate, user_lat, user_lon):
+    source = candidate.source
+    if source.lat is None or source.lon is None:
+        return math.inf  # Без координат аптека не попадет в ближайшие
+    return haversine_distance(user_lat, user_lon, source.lat, source.lon)
+
+
+def push_shortlist_entry(shortlist, entry, limit):
+    """Добавляет запись в ограниченную max-кучу шорт-листа. Возвращает True, если запись в него попала."""
+    if len(shortlist) < limit:
+        heapq.heappush(shortlist, entry)
+        return True
+    if entry[0] > shortlist[0][0]:
+        heapq.heapreplace(shortlist, entry)
+        return True
+    return False
+
+
+def closest_shortlist_candidates(shortlist, closest_limit):
+    """closest_limit ближайших кандидатов кучи шорт-листа (аптеки без координат не берутся)."""
+    closest = heapq.nsmallest(
+        closest_limit,
+        (entry for entry in shortlist if entry[1] != math.inf),
+        key=lambda entry: (entry[1], entry[2])
+    )
+    return [entry[3] for entry in closest]
+
+
+def shortlist_settled(shortlist, limit, distance):
+    """True, если аптеки на расстоянии больше distance уже не попадут в заполненный шорт-лист:
+    во всех его записях одна замена (меньше не бывает) и все они ближе."""
+    if not limit or len(shortlist) < limit:
+        return False
+    worst_key = shortlist[0][0]
+    return worst_key[0] == -1 and -worst_key[1] < distance
+
+
+def nearest_first_order(pharmacies, user_lat, user_lon, encoded_city):
+    """Пары (расстояние_км, позиция в ответе поиска) от ближайших аптек к дальним по пространственному
+    индексу города, аптеки без координат - в конце. None, если индекс не подходит: аптек меньше
+    SPATIAL_INDEX_MIN_CANDIDATES, индекса нет или координаты в нем расходятся с ответом поиска."""
+    city_index = city_spatial_indexes.get(encoded_city) if SPATIAL_INDEX_ENABLED and encoded_city else None
+    if city_index is None or len(pharmacies) < SPATIAL_INDEX_MIN_CANDIDATES:
+        return None
+    positions = defaultdict(list)  # code -> позиции аптек в ответе поиска
+    without_location = []
+    for seq, pharmacy in enumerate(pharmacies):
+        source = pharmacy.source
+        if source.lat is None or source.lon is None:
+            without_location.append((math.inf, seq))
+        elif city_index.location(source.code) == (source.lat, source.lon):
+            positions[source.code].append(seq)
+        else:
+            return None
+    nearest = ((distance, seq) for distance, code in city_index.iter_nearest(user_lat, user_lon, allowed=positions)
+               for seq in positions[code])
+    return chain(nearest, without_location)
+
+
+def select_candidates(pharmacies, user_lat, user_lon, fulfillment_limit=None, closest_limit=None, encoded_city=None):
+    """Однопроходный отбор аптек: filter_with_analogs, sort_pharmacies_by_fulfillment и
+    get_top_closest_pharmacies в одном проходе. Каждая аптека оценивается один раз, в памяти держится
+    только ограниченная куча лучших по (replacements_needed, distance).
+    Для больших городов аптеки просматриваются по индексу от ближайших, и отбор останавливается, как только
+    дальние аптеки уже не могут попасть в шорт-лист; candidates_count тогда - число просмотренных кандидатов."""
+    fulfillment_limit = FULFILLMENT_LIMIT if fulfillment_limit is None else fulfillment_limit
+    closest_limit = CLOSEST_PHARMACIES_LIMIT if closest_limit is None else closest_limit
+
+    shortlist = []  # max-heap через отрицание ключа: худший кандидат на вершине
+    candidates_count = 0
+    order = nearest_first_order(pharmacies, user_lat, user_lon, encoded_city)
+    if order is None:
+        for seq, candidate in enumerate(iter_matched_pharmacies(pharmacies)):
+            candidates_count += 1
+            distance = candidate_distance(candidate, user_lat, user_lon)
+            entry = ((-candidate.replacements_needed, -distance, -seq), distance, seq, candidate)
+            push_shortlist_entry(shortlist, entry, fulfillment_limit)
+    else:
+        for distance, seq in order:
+            if shortlist_settled(shortlist, fulfillment_limit, distance):
+                break
+            candidate = match_candidate(pharmacies[seq])
+            if candidate is None:
+                continue
+            candidates_count += 1
+            entry = ((-candidate.replacements_needed, -distance, -seq), distance, seq, candidate)
+            push_shortlist_entry(shortlist, entry, fulfillment_limit)
+
+    return {"list_pharmacies": closest_shortlist_candidates(shortlist, closest_limit),
+            "candidates_count": candidates_count}
+
+
+async def select_candidates_pipelined(pharmacies, user_lat, user_lon, prefetcher, fulfillment_limit=None,
+                                      closest_limit=None, encoded_city=None):
+    """Отбор как в select_candidates (с тем же результатом), но аптеки просматриваются от ближайших
+    к дальним, и при каждом изменении предварительного шорт-листа prefetcher запрашивает котировки
+    для его аптек, не дожидаясь конца отбора. Отбор периодически отдает управление циклу событий,
+    чтобы запросы котировок уходили в сеть параллельно с вычислениями."""
+    fulfillment_limit = FULFILLMENT_LIMIT if fulfillment_limit is None else fulfillment_limit
+    closest_limit = CLOSEST_PHARMACIES_LIMIT if closest_limit is None else closest_limit
+
+    # Ближние аптеки первыми: предварительный шорт-лист почти сразу совпадает с итоговым.
+    # По индексу города расстояния точно те же, что в candidate_distance, поэтому отбор можно остановить досрочно
+    order = nearest_first_order(pharmacies, user_lat, user_lon, encoded_city)
+    settle = order is not None
+    if order is None:
+        coordinates = np.array(
+            [(pharmacy.source.lat, pharmacy.source.lon)
+             if pharmacy.source.lat is not None and pharmacy.source.lon is not None else (np.nan, np.nan)
+             for pharmacy in pharmacies],
+            dtype=float,
+        ).reshape(-1, 2)
+        distances = haversine_distances(user_lat, user_lon, coordinates[:, 0], coordinates[:, 1])
+        order = ((None, seq) for seq in np.argsort(distances, kind="stable").tolist())
+
+    shortlist = []
+    candidates_count = 0
+    for position, (distance, seq) in enumerate(order):
+        if position and position % QUOTE_PREFETCH_YIELD_EVERY == 0:
+            await asyncio.sleep(0)
+        if settle and shortlist_settled(shortlist, fulfillment_limit, distance):
+            break
+        candidate = match_candidate(pharmacies[seq])
+        if candidate is None:
+            continue
+        candidates_count += 1
+        distance = candidate_distance(candidate, user_lat, user_lon)
+        # seq - позиция аптеки в ответе поиска: при равенстве ключей порядок тот же, что в select_candidates
+        entry = ((-candidate.replacements_needed, -distance, -seq), distance, seq, candidate)
+        if push_shortlist_entry(shortlist, entry, fulfillment_limit):
+            if prefetcher.update(closest_shortlist_candidates(shortlist, closest_limit)):
+                await asyncio.sleep(0)  # Даем новым запросам котировок уйти в сеть
+
+    return {"list_pharmacies": closest_shortlist_candidates(shortlist, closest_limit),
+            "candidates_count": candidates_count}
+
+
+class AnalogColumns:
+    """Записи аптек ответа поиска, развернутые в массивы для движка columnar: по товарам (аптека x товар)
+    и по аналогам товаров, которых не хватает. Строится один раз при разборе ответа (SearchResult.columns)."""
+    __slots__ = ("pharmacies", "pharmacy_offsets", "product_pharmacy", "in_stock", "quantity_desired",
+                 "analogs", "analog_product", "analog_quantity", "analog_price", "_positions")
+
+    def __init__(self, pharmacies):
+        pharmacy_count = len(pharmacies)
+        self.pharmacies = pharmacies
+
+        # Колонки по товарам
+        product_counts = np.fromiter((len(pharmacy.quantities) for pharmacy in pharmacies), dtype=np.int64,
+                                     count=pharmacy_count)
+        product_count = int(product_counts.sum())
+        self.pharmacy_offsets = np.concatenate(([0], np.cumsum(product_counts))).tolist()
+        self.product_pharmacy = np.repeat(np.arange(pharmacy_count), product_counts)
+        quantity = np.fromiter(chain.from_iterable(pharmacy.quantities for pharmacy in pharmacies), dtype=float,
+                               count=product_count)
+        self.quantity_desired = np.fromiter(chain.from_iterable(pharmacy.quantities_desired for pharmacy in pharmacies),
+                                            dtype=float, count=product_count)
+        self.in_stock = quantity >= self.quantity_desired
+
+        # Колонки по аналогам товаров, которых не хватает
+        missing = np.nonzero(~self.in_stock)[0]
+        flat_product_analogs = list(chain.from_iterable(pharmacy.analogs for pharmacy in pharmacies))
+        analogs_per_product = [flat_product_analogs[i] for i in missing.tolist()]
+        analog_counts = np.fromiter(map(len, analogs_per_product), dtype=np.int64, count=len(missing))
+        self.analogs = list(chain.from_iterable(analogs_per_product))
+        self.analog_product = np.repeat(missing, analog_counts)
+        self.analog_quantity = np.fromiter(map(attrgetter("quantity"), self.analogs), dtype=float,
+                                           count=len(self.analogs))
+        self.analog_price = np.fromiter(map(attrgetter("base_price"), self.analogs), dtype=float,
+                                        count=len(self.analogs))
+        self._positions = None  # id(PharmacyRecord) -> позиция, строится при первом отборе по части аптек
+
+    @property
+    def nbytes(self):
+        return (self.product_pharmacy.nbytes + self.in_stock.nbytes + self.quantity_desired.nbytes
+                + self.analog_product.nbytes + self.analog_quantity.nbytes + self.analog_price.nbytes
+                + 8 * (len(self.pharmacy_offsets) + len(self.analogs)))
+
+    def mask(self, pharmacies):
+        """Маска аптек ответа, входящих в pharmacies (например, после prefilter_open_pharmacies)."""
+        if self._positions is None:
+            self._positions = {id(pharmacy): position for position, pharmacy in enumerate(self.pharmacies)}
+        mask = np.zeros(len(self.pharmacies), dtype=bool)
+        mask[[self._positions[id(pharmacy)] for pharmacy in pharmacies]] = True
+        return mask
+
+
+def filter_with_analogs_columnar(pharmacies, columns=None):
+    """Колоночный вариант filter_with_analogs с тем же результатом.
+    Проверка остатков, выбор самого дешевого аналога и подсчет замен выполняются пакетно в NumPy по колонкам
+    ответа поиска (AnalogColumns). pharmacies - аптеки этого ответа или их часть; без columns колонки
+    строятся по pharmacies на месте."""
+    if columns is None:
+        columns = AnalogColumns(pharmacies)
+    if not len(columns.in_stock):
+        return {"filtered_pharmacies": []}
+    pharmacy_count = len(columns.pharmacies)
+    in_stock = columns.in_stock
+    analog_product = columns.analog_product
+    analog_price = columns.analog_price
+
+    # Самый дешевый аналог с достаточным остатком для каждого товара (при равной цене - первый по списку)
+    cheapest_analog = np.full(len(in_stock), -1, dtype=np.int64)
+    available = np.nonzero(columns.analog_quantity >= columns.quantity_desired[analog_product])[0]
+    order = available[np.lexsort((available, analog_price[available], analog_product[available]))]
+    products_with_analog, first_positions = np.unique(analog_product[order], return_index=True)
+    cheapest_analog[products_with_analog] = order[first_positions]
+
+    replaced = ~in_stock & (cheapest_analog >= 0)
+    unavailable = ~in_stock & ~replaced
+    replacements_needed = np.bincount(columns.product_pharmacy, weights=replaced, minlength=pharmacy_count)
+    pharmacy_is_valid = np.bincount(columns.product_pharmacy, weights=unavailable, minlength=pharmacy_count) == 0
+    if pharmacies is not columns.pharmacies:
+        pharmacy_is_valid &= columns.mask(pharmacies)
+    selected = np.nonzero(pharmacy_is_valid & (replacements_needed > 0))[0].tolist()
+
+    # Замены раскладываются в общий список по товарам, совпадения аптеки - его срез
+    matches = [None] * len(in_stock)
+    replaced_products = np.nonzero(replaced)[0]
+    for product_index, analog_index in zip(replaced_products.tolist(), cheapest_analog[replaced_products].tolist()):
+        matches[product_index] = columns.analogs[analog_index]
+    offsets = columns.pharmacy_offsets
+    replacements_list = replacements_needed.tolist()
+    return {"filtered_pharmacies": [
+        Candidate(columns.pharmacies[index], tuple(matches[offsets[index]:offsets[index + 1]]),
+                  int(replacements_list[index]))
+        for index in selected
+    ]}
+
+
+async def sort_pharmacies_by_fulfillment(pharmacies_with_replacements, limit=None):
+    # Sort pharmacies by the number of replacements (ascending)
+    sorted_pharmacies = sorted(
+        pharmacies_with_replacements.get("filtered_pharmacies", []),
+        key=attrgetter("replacements_needed")
+    )
+
+    fewest_analogs = sorted_pharmacies[:FULFILLMENT_LIMIT if limit is None else limit]
+    return {"list_pharmacies": fewest_analogs}
+
+
+#Find pharmacies with cheapest "total_sum" fro sku's
+async def get_top_cheapest_pharmacies(pharmacies):
+    # Access the list of pharmacies from the "list_pharmacies" key
+    pharmacies_list = pharmacies.get("list_pharmacies", [])
+
+    # Sort pharmacies by 'total_sum' in ascending order
+    sorted_pharmacies = sorted(pharmacies_list, key=attrgetter("total_sum"))
+
+    # Get the top 1 pharmacy with the lowest 'total_sum'
+    cheapest_pharmacies = sorted_pharmacies  # Adjust slice if you want more than one
+
+    return {"list_pharmacies": cheapest_pharmacies}
+
+
+async def get_top_closest_pharmacies(pharmacies, user_lat, user_lon, limit=None):
+    limit = CLOSEST_PHARMACIES_LIMIT if limit is None else limit
+    # Собираем аптеки с координатами
+    candidates = []
+    for candidate in pharmacies.get("list_pharmacies", []):
+        # Check if lat/lon exist before calculating the distance
+        if candidate.source.lat is None or candidate.source.lon is None:
+            continue  # Skip if lat/lon is missing
+        candidates.append(candidate)
+
+    # Векторный расчет расстояний по всем кандидатам и выбор top-k без полной сортировки
+    lats = np.fromiter((candidate.source.lat for candidate in candidates), dtype=float, count=len(candidates))
+    lons = np.fromiter((candidate.source.lon for candidate in candidates), dtype=float, count=len(candidates))
+    distances = haversine_distances(user_lat, user_lon, lats, lons)
+    closest_pharmacies = [candidates[i] for i in top_k_indices(distances, limit)]
+
+    return {"list_pharmacies": closest_pharmacies}
+
+
+def top_k_indices(values, k):
+    """Индексы k наименьших значений по возрастанию (при равенстве сохраняется исходный порядок)."""
+    if k <= 0 or len(values) == 0:
+        return []
+    if k < len(values):
+        indices = np.argpartition(values, k - 1)[:k]
+    else:
+        indices = np.arange(len(values))
+    return indices[np.lexsort((indices, values[indices]))].tolist()
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+# Расстояние по большому кругу (км) между двумя точками
+def haversine_distance(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def haversine_distances(lat, lon, lats, lons):
+    """Векторный вариант haversine_distance: расстояния (км) от точки до массивов координат."""
+    lat = math.radians(lat)
+    lats = np.radians(lats)
+    dlat = lats - lat
+    dlon = np.radians(lons) - math.radians(lon)
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class PharmacyGridIndex:
+    """Пространственный индекс аптек города на равномерной сетке по широте/долготе.
+    Аптеки от ближайших к дальним выдаются обходом колец ячеек вокруг пользователя: после каждого кольца
+    отдаются найденные аптеки, которые гарантированно ближе любой аптеки за его пределами."""
+
+    def __init__(self, cell_deg):
+        self.cell_deg = cell_deg
+        self.cells = defaultdict(dict)  # (row, col) -> {code: (lat, lon)}
+        self.locations = {}  # code -> (row, col)
+        self.max_abs_lat = 0.0
+        # Границы занятых ячеек ведутся при добавлении, чтобы поиск не перебирал все аптеки;
+        # после переноса аптеки они могут остаться шире фактических - это только лишние пустые кольца
+        self.min_row = self.max_row = self.min_col = self.max_col = None
+        self.updated_at = time.monotonic()
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def add(self, code, lat, lon):
+        cell = self._cell(lat, lon)
+        old_cell = self.locations.get(code)
+        if old_cell is not None and old_cell != cell:
+            self.remove(code)
+        self.cells[cell][code] = (lat, lon)
+        self.locations[code] = cell
+        self.max_abs_lat = max(self.max_abs_lat, abs(lat))
+        row, col = cell
+        if self.min_row is None:
+            self.min_row = self.max_row = row
+            self.min_col = self.max_col = col
+        else:
+            self.min_row, self.max_row = min(self.min_row, row), max(self.max_row, row)
+            self.min_col, self.max_col = min(self.min_col, col), max(self.max_col, col)
+        self.updated_at = time.monotonic()
+
+    def remove(self, code):
+        cell = self.locations.pop(code, None)
+        if cell is None:
+            return
+        self.cells[cell].pop(code, None)
+        if not self.cells[cell]:
+            del self.cells[cell]
+        if not self.locations:
+            self.min_row = self.max_row = self.min_col = self.max_col = None
+        self.updated_at = time.monotonic()
+
+    def location(self, code):
+        """(lat, lon) аптеки в индексе или None."""
+        cell = self.locations.get(code)
+        return None if cell is None else self.cells[cell][code]
+
+    def iter_nearest(self, lat, lon, allowed=None):
+        """Генератор пар (расстояние_км, code) по возрастанию расстояния, опционально только для кодов из allowed."""
+        if not self.locations:
+            return
+        center_row, center_col = self._cell(lat, lon)
+        max_ring = max(abs(center_row - self.min_row), abs(center_row - self.max_row),
+                       abs(center_col - self.min_col), abs(center_col - self.max_col))
+        # Минимальная ширина ячейки в км (по долготе ячейки сужаются к полюсам)
+        max_abs_lat = min(max(self.max_abs_lat, abs(lat)), 89.0)
+        cell_km = self.cell_deg * math.pi / 180 * EARTH_RADIUS_KM * math.cos(math.radians(max_abs_lat))
+
+        pending = []  # min-heap найденных, но еще не отданных аптек
+        for ring in range(max_ring + 1):
+            for row in range(center_row - ring, center_row + ring + 1):
+                step = 1 if row in (center_row - ring, center_row + ring) else 2 * ring
+                for col in range(center_col - ring, center_col + ring + 1, max(step, 1)):
+                    for code, (p_lat, p_lon) in self.cells.get((row, col), {}).items():
+                        if allowed is not None and code not in allowed:
+                            continue
+                        heapq.heappush(pending, (haversine_distance(lat, lon, p_lat, p_lon), code))
+            # Любая точка за пределами кольца ring дальше, чем ring * cell_km; запас в 1% покрывает
+            # отличие расстояния по большому кругу от расстояния вдоль параллели
+            bound = ring * cell_km * 0.99
+            while pending and pending[0][0] <= bound:
+                yield heapq.heappop(pending)
+        while pending:
+            yield heapq.heappop(pending)
+
+
+city_spatial_indexes = {}
+
+
+def update_city_spatial_index(encoded_city, pharmacies):
+    """Дополняет индекс города координатами аптек (PharmacyRecord) из ответа поиска."""
+    if not SPATIAL_INDEX_ENABLED:
+        return
+    city_index = city_spatial_indexes.get(encoded_city)
+    if city_index is None:
+        city_index = city_spatial_indexes[encoded_city] = PharmacyGridIndex(SPATIAL_INDEX_CELL_DEG)
+    for pharmacy in pharmacies:
+        source = pharmacy.source
+        if source.code and source.lat is not None and source.lon is not None:
+            city_index.add(source.code, source.lat, source.lon)
+
+
+ROUND_THE_CLOCK = "Круглосуточно"
+ALMATY_TZ = pytz.timezone('Asia/Almaty')
+
 
-# Define the payload
-payload = []
+def parse_upstream_time(value):
+    """Разбирает время апстрима вида 2024-10-21T19:00:00Z в aware datetime (UTC)."""
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-@app.post("/best_analog")
-async def main_process(request: Request):
+def pharmacy_opening_status(closes_at, opens_at, opening_hours, current_time):
+    """Возвращает (закрыта сейчас, закроется в течение часа) для аптеки на момент current_time."""
+    # Круглосуточная аптека не закрыта и не закроется скоро
+    if opening_hours == ROUND_THE_CLOCK:
+        return False, False
 
     try:
-        # Receive the front end data (city hash, sku's, user address)
-        request_data = await request.json()
-        encoded_city = request_data.get("city")  # Encoded city hash
-        sku_data = request_data.get("skus", [])  # List of SKU items
-        address = request_data.get("address", {})  # User address
+        # Конвертация времени открытия и закрытия
+        closes_time = parse_upstream_time(closes_at)
+        opens_time = parse_upstream_time(opens_at)
+    except (TypeError, ValueError) as e:
+        logger.error(f"Time opens\\closes parsing error: {e}")
+        return True, True  # Если ошибка, считаем, что аптека закрыта для избежания ошибок
 
+    # Закрыта, если еще не открылась или уже закрылась
+    closed = not (opens_time <= current_time < closes_time)
+    # Если аптека еще не открылась, она не закроется скоро
+    closes_soon = current_time >= opens_time and timedelta(0) <= closes_time - current_time <= timedelta(hours=1)
+    return closed, closes_soon
 
-        #Save the latitude and longitude of user
-        user_lat = request_data.get("address", {}).get("lat")
-        user_lon = request_data.get("address", {}).get("lng")
 
-        # Validate the incoming data
-        if not encoded_city or not sku_data or user_lat is None or user_lon is None:
-            return JSONResponse(content={"error": "City, SKU data, and user coordinates are required"}, status_code=400)
+def is_pharmacy_open_soon(closes_at, opens_at, opening_hours, current_time=None):
+    """Проверяет, закроется ли аптека через 1 час или если аптека работает круглосуточно."""
+    current_time = current_time or datetime.now(ALMATY_TZ)
+    return pharmacy_opening_status(closes_at, opens_at, opening_hours, current_time)[1]
 
-        if not isinstance(user_lat, (int, float)) or not isinstance(user_lon, (int, float)):
-            return JSONResponse(content={"error": "Invalid data type for user coordinates"}, status_code=400)
 
-        for item in sku_data:
-            if not isinstance(item.get("sku"), str) or not isinstance(item.get("count_desired"), int):
-                return JSONResponse(content={"error": "Invalid SKU format or count type"}, status_code=400)
+def is_pharmacy_closed(closes_at, opens_at, opening_hours, current_time=None):
+    """Проверяет, закрыта ли аптека на момент запроса, учитывая расписание."""
+    current_time = current_time or datetime.now(ALMATY_TZ)
+    return pharmacy_opening_status(closes_at, opens_at, opening_hours, current_time)[0]
 
-        # Build the payload
-        payload = [{"sku": item["sku"], "count_desired": item["count_desired"]} for item in sku_data]
 
-        # Perform the search for medicines in pharmacies
-        pharmacies = await find_medicines_in_pharmacies(encoded_city, payload)
-        if not pharmacies.get("result"):
-            logger.error("No pharmacies found with the provided SKU data")
-            return JSONResponse(content={"error": "No pharmacies found with the provided SKU data"}, status_code=404)
-        save_response_to_file(pharmacies, file_name='data1_found_all.json')
+WEEKDAYS = {"пн": 0, "вт": 1, "ср": 2, "чт": 3, "пт": 4, "сб": 5, "вс": 6}
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+SCHEDULE_GROUP_RE = re.compile(
+    r"([А-Яа-яЁё,\s-]+?)\s*:\s*((?:\d{1,2}:\d{2}\s*-\s*\d{1,2}:\d{2}[,\s]*)+|круглосуточно|выходн(?:ой|ые))",
+    re.IGNORECASE)
+SCHEDULE_SEPARATORS = " ,;.\t\r\n"
+SCHEDULE_TIME_RE = re.compile(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})")
 
-        #Save only pharmacies with all sku's in stock
-        #filtered_pharmacies = await filter_pharmacies(pharmacies)
 
-        #Save pharmacies with analogs
-        analog_pharmacies = await filter_with_analogs(pharmacies)
-        if not analog_pharmacies.get("filtered_pharmacies"):
-            logger.error("No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))")
-            return JSONResponse(content={"error": "No pharmacies found matching the request (either due to requested medication quantities or invalid SKU(s))"}, status_code=404)
-        save_response_to_file(analog_pharmacies, file_name='data2_with_analogs.json')
+def parse_schedule_days(text):
+    """Разбирает дни вида "Пн-Пт", "Сб,Вс", "Ежедневно" в список номеров дней недели."""
+    text = text.strip().lower()
+    if text in ("ежедневно", "без выходных"):
+        return list(range(7))
+    days = []
+    for part in text.split(","):
+        bounds = [bound.strip()[:2] for bound in part.split("-")]
+        if not all(bound in WEEKDAYS for bound in bounds) or len(bounds) > 2:
+            return None
+        first, last = WEEKDAYS[bounds[0]], WEEKDAYS[bounds[-1]]
+        days.extend((first + offset) % 7 for offset in range((last - first) % 7 + 1))
+    return days
 
-        top_pharmacies = await sort_pharmacies_by_fulfillment(analog_pharmacies)
-        save_response_to_file(top_pharmacies, file_name='data3_top_pharmacies.json')
 
-        closest_pharmacies = await get_top_closest_pharmacies(top_pharmacies, user_lat, user_lon)
-        save_response_to_file(closest_pharmacies, file_name='data4_closest_pharmacies.json')
+def parse_opening_hours(opening_hours):
+    """Разбирает строку режима работы ("Пн-Вс: 08:00-00:00", "Пн-Пт: 09:00-21:00, Сб-Вс: 10:00-18:00",
+    "Круглосуточно") в список интервалов (начало, конец) в минутах от начала недели (Пн 00:00).
+    Возвращает None, если строку разобрать не удалось."""
+    if not isinstance(opening_hours, str):
+        return None
+    text = opening_hours.strip()
+    if text.lower() == ROUND_THE_CLOCK.lower():
+        return [(0, MINUTES_PER_WEEK)]
 
-        # Получение всех опций доставки
-        delivery_options = await get_delivery_options(closest_pharmacies, user_lat, user_lon)
-        if isinstance(delivery_options, JSONResponse):
-            return delivery_options  # Возвращаем JSONResponse сразу, если это ошибка
-        save_response_to_file(delivery_options, file_name='data5_delivery_options.json')
+    intervals = []
+    parsed_until = 0
+    for group in SCHEDULE_GROUP_RE.finditer(text):
+        days_text, times_text = group.groups()
+        # Текст между группами, который не удалось разобрать: вместо части расписания берется
+        # время открытия/закрытия апстрима для всей строки
+        if text[parsed_until:group.start()].strip(SCHEDULE_SEPARATORS):
+            break
+        parsed_until = group.end()
+        days = parse_schedule_days(days_text.strip(" ,;"))
+        if not days:
+            return None
+        if times_text.lower() == ROUND_THE_CLOCK.lower():
+            ranges = [(0, MINUTES_PER_DAY)]
+        elif times_text.lower().startswith("выходн"):
+            ranges = []
+        else:
+            ranges = []
+            for open_h, open_m, close_h, close_m in SCHEDULE_TIME_RE.findall(times_text):
+                opens = int(open_h) * 60 + int(open_m)
+                closes = int(close_h) * 60 + int(close_m)
+                if closes <= opens:
+                    closes += MINUTES_PER_DAY  # 00:00 - полночь, меньшее время - работа через полночь
+                ranges.append((opens, closes))
+        intervals.extend((day * MINUTES_PER_DAY + opens, day * MINUTES_PER_DAY + closes)
+                         for day in days for opens, closes in ranges)
+    if text[parsed_until:].strip(SCHEDULE_SEPARATORS):
+        logger.warning(f"Cannot parse opening hours {opening_hours!r}, using opens_at/closes_at")
+        return None
+    return intervals or None
 
-        # Выбор самой дешевой и самой быстрой аптеки
-        result = await best_option(delivery_options)
-        save_response_to_file(result, file_name='data6_best_delivery_options.json')
 
-        return result
+class PharmacySchedule:
+    """Скомпилированный недельный режим работы аптеки (местное время Asia/Almaty).
+    Интервалы развернуты на две недели, для каждого часа недели заранее известен индекс первого
+    интервала, который еще не закончился, поэтому ответы "открыта ли / через сколько закроется /
+    когда откроется" не зависят от длины расписания."""
 
-    except json.JSONDecodeError:
-        return JSONResponse(content={"error": "Invalid JSON format"}, status_code=400)
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return JSONResponse(content={"error": "An unexpected error occurred"}, status_code=500)
+    __slots__ = ("signature", "intervals", "hour_index")
 
+    def __init__(self, intervals, signature=None):
+        self.signature = signature
+        merged = []
+        # Интервалы, выходящие за конец недели, переносим в ее начало
+        for start, end in sorted(intervals + [(start - MINUTES_PER_WEEK, end - MINUTES_PER_WEEK)
+                                              for start, end in intervals if end > MINUTES_PER_WEEK]):
+            start, end = max(start, 0), min(end, MINUTES_PER_WEEK)
+            if start >= end:
+                continue
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        # Соседние недели склеиваются, чтобы работа через полночь воскресенья считалась одним интервалом
+        two_weeks = []
+        for start, end in merged + [(start + MINUTES_PER_WEEK, end + MINUTES_PER_WEEK) for start, end in merged]:
+            if two_weeks and start <= two_weeks[-1][1]:
+                two_weeks[-1] = (two_weeks[-1][0], end)
+            else:
+                two_weeks.append((start, end))
+        self.intervals = two_weeks
 
-async def find_medicines_in_pharmacies(encoded_city, payload):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(URL_SEARCH, params={"city": encoded_city}, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            # Проверка на наличие ожидаемых ключей в ответе
-            if not isinstance(data, dict) or "result" not in data:
-                return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
-            return data
-        except httpx.RequestError as e:
-            logger.error(f"Request error while accessing URL_SEARCH: {e}")
-            return JSONResponse(content={"error": "Request error while accessing search API"}, status_code=503)
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error while accessing URL_SEARCH: {e}")
-            return JSONResponse(content={"error": f"HTTP error {e.response.status_code}"},
-                                status_code=e.response.status_code)
+        self.hour_index = []
+        position = 0
+        for hour in range(7 * 24):
+            while position < len(two_weeks) and two_weeks[position][1] <= hour * 60:
+                position += 1
+            self.hour_index.append(position)
 
+    def status(self, when):
+        """Возвращает (открыта, минут до закрытия или None, минут до открытия или None) на момент when."""
+        local = when.astimezone(ALMATY_TZ)
+        minute = local.weekday() * MINUTES_PER_DAY + local.hour * 60 + local.minute
+        position = self.hour_index[minute // 60]
+        while position < len(self.intervals) and self.intervals[position][1] <= minute:
+            position += 1
+        if position == len(self.intervals):
+            return False, None, None  # Аптека не работает ни в один день
+        start, end = self.intervals[position]
+        if start <= minute:
+            return True, end - minute, None
+        return False, None, start - minute
 
-# QUANTITY_ADJUSTMENT = 1  # Количество продуктов, которое будет добавлено к каждому продукту в списке продуктов аптеки
-#
-# async def find_medicines_in_pharmacies(encoded_city, payload):
-#
-#     if isinstance(payload, list):
-#         # Увеличиваем count_desired на QUANTITY_ADJUSTMENT для каждого элемента в списке
-#         print(f"payload before adjustment: {payload}")
-#         for sku in payload:
-#             if isinstance(sku, dict) and "count_desired" in sku:
-#                 sku["count_desired"] += QUANTITY_ADJUSTMENT
-#         print(f"payload after adjustment: {payload}")
-#     else:
-#         # Логирование ошибки структуры payload
-#         logger.error("Payload должен быть списком словарей с ключом 'count_desired'.")
-#
-#     async with httpx.AsyncClient() as client:
-#         try:
-#             response = await client.post(URL_SEARCH, params={"city": encoded_city}, json=payload)
-#             response.raise_for_status()
-#             data = response.json()
-#             save_response_to_file(data, file_name='data_pharmacies.json')
-#
-#             # Проверка корректности данных от API
-#             if not isinstance(data, dict) or "result" not in data:
-#                 return JSONResponse(content={"error": "Invalid response format from search API"}, status_code=502)
-#
-#             # Применяем корректировку после получения данных
-#             for pharmacy in data.get("result", []):
-#                 # Проверка, что source_tags - это список
-#                 source_tags = pharmacy.get("source", {}).get("source_tags", [])
-#                 has_stock_tag = False
-#                 stock_meta_value = None
-#
-#                 if isinstance(source_tags, list):
-#                     for tag in source_tags:
-#                         if isinstance(tag, dict) and tag.get("id") == 1080:
-#                             has_stock_tag = True
-#                             stock_meta_value = tag.get("meta")
-#                             break
-#
-#                 # Корректируем каждый товар и его аналоги в зависимости от правил
-#                 for product in pharmacy.get("products", []):
-#                     if not isinstance(product, dict):
-#                         continue  # Пропустить, если структура продукта некорректна
-#
-#                     # Корректировка основного продукта
-#                     original_count_desired = product.get("count_desired", 0)
-#                     original_quantity = product.get("quantity", 0)
-#
-#                     if has_stock_tag and stock_meta_value == "0":
-#                         if original_count_desired == original_quantity:
-#                             product["count_desired"] = max(0, original_count_desired - QUANTITY_ADJUSTMENT)
-#                             product["quantity"] = max(0, original_quantity - QUANTITY_ADJUSTMENT)
-#                         else:
-#                             product["count_desired"] = max(0, original_count_desired - QUANTITY_ADJUSTMENT)
-#                     else:
-#                         product["count_desired"] = max(0, original_count_desired - QUANTITY_ADJUSTMENT)
-#                         product["quantity"] = max(0, original_quantity - QUANTITY_ADJUSTMENT)
-#
-#                     # Корректировка аналогов, если они есть
-#                     if "analogs" in product and isinstance(product["analogs"], list):
-#                         for analog in product["analogs"]:
-#                             if isinstance(analog, dict):
-#                                 analog_original_count_desired = analog.get("quantity_desired", 0)
-#                                 analog_original_quantity = analog.get("quantity", 0)
-#
-#                                 if has_stock_tag and stock_meta_value == "0":
-#                                     if analog_original_count_desired == analog_original_quantity:
-#                                         analog["quantity_desired"] = max(0, analog_original_count_desired - QUANTITY_ADJUSTMENT)
-#                                         analog["quantity"] = max(0, analog_original_quantity - QUANTITY_ADJUSTMENT)
-#                                     else:
-#                                         analog["quantity_desired"] = max(0, analog_original_count_desired - QUANTITY_ADJUSTMENT)
-#                                 else:
-#                                     analog["quantity_desired"] = max(0, analog_original_count_desired - QUANTITY_ADJUSTMENT)
-#                                     analog["quantity"] = max(0, analog_original_quantity - QUANTITY_ADJUSTMENT)
-#
-#             return data
-#
-#         except httpx.RequestError as e:
-#             logger.error(f"Request error while accessing URL_SEARCH: {e}")
-#             return JSONResponse(content={"error": "Request error while accessing search API"}, status_code=503)
-#         except httpx.HTTPStatusError as e:
-#             logger.error(f"HTTP error while accessing URL_SEARCH: {e}")
-#             return JSONResponse(content={"error": f"HTTP error {e.response.status_code}"}, status_code=e.response.status_code)
+    def is_open(self, when):
+        return self.status(when)[0]
 
+    def closes_within(self, when, minutes):
+        is_open, minutes_to_close, _ = self.status(when)
+        return is_open and minutes_to_close <= minutes
 
+    def next_opening(self, when):
+        is_open, _, minutes_to_open = self.status(when)
+        if is_open:
+            return when
+        if minutes_to_open is None:
+            return None
+        return when.replace(second=0, microsecond=0) + timedelta(minutes=minutes_to_open)
 
 
-# мок для тестирования локальных результатов поиска
-# async def find_medicines_in_pharmacies(encoded_city, payload):
-#     async with httpx.AsyncClient() as client:
-#         response = await client.get("http://localhost:8002/search_medicines")
-#         response.raise_for_status()  # Проверка на ошибки
-#         data = response.json()  # Получаем JSON
-#         save_response_to_file(data, file_name='data1_found_all.json')
-#         return data  # Возвращаем JSON данные
+def compile_pharmacy_schedule(source):
+    """Компилирует расписание из opening_hours, а если строку разобрать нельзя -
+    из времени открытия/закрытия апстрима (повторяя его каждый день)."""
+    signature = (source.get("opening_hours"), source.get("opens_at"), source.get("closes_at"))
+    intervals = parse_opening_hours(source.get("opening_hours"))
+    if intervals is None:
+        try:
+            opens = parse_upstream_time(source.get("opens_at")).astimezone(ALMATY_TZ)
+            closes = parse_upstream_time(source.get("closes_at")).astimezone(ALMATY_TZ)
+        except (TypeError, ValueError):
+            return None
+        opens_minute = opens.hour * 60 + opens.minute
+        closes_minute = opens_minute + int((closes - opens).total_seconds() // 60)
+        if closes_minute <= opens_minute:
+            return None
+        intervals = [(day * MINUTES_PER_DAY + opens_minute, day * MINUTES_PER_DAY + closes_minute) for day in range(7)]
+    return PharmacySchedule(intervals, signature)
 
 
-# Фильтр аптек с анадлами
-async def filter_with_analogs(pharmacies):
-    pharmacies_with_replacements = []
-
-    for pharmacy in pharmacies.get("result", []):
-        products = pharmacy.get("products", [])
-        updated_products = []  # This will hold products in stock and the cheapest analog
-        replacements_needed = 0  # Track how many replacements were made
-        replaced_skus = []  # To store original and replacement SKU pairs
-        pharmacy_is_valid = True  # Флаг для определения валидности аптеки по наличию нужного количества
-
-        # Check all products in the pharmacy
-        for product in products:
-            if product["quantity"] >= product["quantity_desired"]:
-                # Product has sufficient stock, add it as is
-                updated_products.append(product)
-            elif "analogs" in product and product["analogs"]:
-                # Фильтруем аналоги, у которых количество больше или равно желаемому
-                available_analogs = [analog for analog in product["analogs"] if
-                                     analog["quantity"] >= product["quantity_desired"]]
-
-                # Проверяем, что у нас есть аналоги с достаточным количеством
-                if available_analogs:
-                    # Находим самый дешевый среди доступных аналогов
-                    cheapest_analog = min(available_analogs, key=lambda analog: analog["base_price"])
-
-                    # Создаем запись для замены продукта аналогом
-                    replacement_product = {
-                        "source_code": cheapest_analog["source_code"],
-                        "sku": cheapest_analog["sku"],
-                        "name": cheapest_analog["name"],
-                        "base_price": cheapest_analog["base_price"],
-                        "price_with_warehouse_discount": cheapest_analog["price_with_warehouse_discount"],
-                        "warehouse_discount": cheapest_analog["warehouse_discount"],
-                        "quantity": cheapest_analog["quantity"],
-                        "quantity_desired": product["quantity_desired"],
-                        "pp_packing": cheapest_analog.get("pp_packing", ""),
-                        "manufacturer_id": cheapest_analog.get("manufacturer_id", ""),
-                        "recipe_needed": cheapest_analog.get("recipe_needed", False),
-                        "strong_recipe": cheapest_analog.get("strong_recipe", False),
-                    }
+# Расписания аптек по городам, переживают запросы и обновляются при изменении данных аптеки
+city_schedule_indexes = {}
 
-                    # Добавляем replacement_product как аналог в список "analogs" оригинального продукта
-                    product["analogs"] = [replacement_product]
-                    updated_products.append(product)
-
-                    # Увеличиваем replacements_needed только если аналог был найден с достаточным количеством
-                    replacements_needed += 1
-                    replaced_skus.append({
-                        "original_sku": product["sku"],
-                        "replacement_sku": cheapest_analog["sku"]
-                    })
-                else:
-                    # Если нет аналога с достаточным количеством, помечаем аптеку как неподходящую
-                    pharmacy_is_valid = False
-                    break
-            else:
-                # Если нет достаточного количества оригинала и аналогов, помечаем аптеку как неподходящую
-                pharmacy_is_valid = False
-                break
 
-        if pharmacy_is_valid:
-            # Подсчет total_sum после добавления всех продуктов и аналогов
-            total_sum = sum(
-                # Если у продукта есть аналог с достаточным количеством, используем его для подсчета суммы
-                (product["analogs"][0]["base_price"] * product["analogs"][0]["quantity_desired"]
-                 if product.get("analogs") and product["analogs"][0]["quantity"] >= product["quantity_desired"]
-                 # Иначе считаем только основной продукт, если его количество соответствует желаемому
-                 else product["base_price"] * product["quantity_desired"] if product["quantity"] >= product[
-                    "quantity_desired"] else 0)
-                for product in updated_products
-            )
+def update_city_schedule_index(encoded_city, pharmacies):
+    schedules = city_schedule_indexes.setdefault(encoded_city, {})
+    changed = []
+    for pharmacy in pharmacies:
+        source = pharmacy.source.raw
+        code = pharmacy.source.code
+        if not code:
+            continue
+        signature = (source.get("opening_hours"), source.get("opens_at"), source.get("closes_at"))
+        schedule = schedules.get(code)
+        if schedule is None or schedule.signature != signature:
+            schedule = compile_pharmacy_schedule(source)
+            if schedule is not None:
+                schedules[code] = schedule
+                changed.append((code, signature))
+    if changed and shared_cache is not None:
+        expires_at = time.time() + SHARED_SCHEDULE_TTL
+        shared_cache.set_later([(shared_schedule_key(encoded_city, code), dumps_bytes(signature), expires_at)
+                                for code, signature in changed])
 
-            # Save only pharmacies where at least one replacement was made
-            if replacements_needed > 0:
-                pharmacies_with_replacements.append({
-                    "pharmacy": {
-                        "source": pharmacy["source"],  # Only include the pharmacy source info here
-                        "products": updated_products,  # Keep the updated products with analogs
-                        "total_sum": total_sum,  # Include total price of the pharmacy
-                        "replacements_needed": replacements_needed,  # Track the number of replacements
-                        "replaced_skus": replaced_skus  # Store the SKUs of original and replacements
-                    }
-                })
 
-    # Return pharmacies with replacements and their updated product lists
-    return {"filtered_pharmacies": pharmacies_with_replacements}
+def shared_schedule_key(encoded_city, code):
+    return f"schedule:{json.dumps([encoded_city, code], ensure_ascii=False, separators=(',', ':'))}"
 
 
+def load_shared_schedules():
+    """Заполняет city_schedule_indexes расписаниями из общего кэша (при старте воркера).
+    Возвращает число загруженных расписаний."""
+    loaded = 0
+    for key, value in shared_cache.scan("schedule:"):
+        encoded_city, code = json.loads(key[len("schedule:"):])
+        opening_hours, opens_at, closes_at = loads_bytes(value)
+        schedule = compile_pharmacy_schedule({"opening_hours": opening_hours, "opens_at": opens_at,
+                                              "closes_at": closes_at})
+        if schedule is not None:
+            city_schedule_indexes.setdefault(encoded_city, {})[code] = schedule
+            loaded += 1
+    return loaded
 
-async def sort_pharmacies_by_fulfillment(pharmacies_with_replacements):
-    # Sort pharmacies by the number of replacements (ascending)
-    sorted_pharmacies = sorted(
-        pharmacies_with_replacements.get("filtered_pharmacies", []),
-        key=lambda x: x["pharmacy"]["replacements_needed"]
-    )
 
-    fewest_analogs = sorted_pharmacies[:7]
-    return {"list_pharmacies": fewest_analogs}
+def get_pharmacy_schedule(code, encoded_city=None):
+    if encoded_city is not None:
+        return city_schedule_indexes.get(encoded_city, {}).get(code)
+    for schedules in city_schedule_indexes.values():
+        if code in schedules:
+            return schedules[code]
+    return None
 
 
-#Find pharmacies with cheapest "total_sum" fro sku's
-async def get_top_cheapest_pharmacies(pharmacies):
-    # Access the list of pharmacies from the "list_pharmacies" key
-    pharmacies_list = pharmacies.get("list_pharmacies", [])
+def pharmacy_status(source, now, encoded_city=None):
+    """(закрыта, закроется в течение часа) для source аптеки на момент now. Единственный источник статуса
+    для prefilter_open_pharmacies, QuoteEstimator.choose и best_option: скомпилированное расписание аптеки
+    (оно само собрано из opening_hours или opens_at/closes_at), а если его нет - время открытия/закрытия апстрима."""
+    schedule = get_pharmacy_schedule(source.get("code"), encoded_city)
+    if schedule is not None:
+        return not schedule.is_open(now), schedule.closes_within(now, 60)
+    return pharmacy_opening_status(source.get("closes_at"), source.get("opens_at"), source.get("opening_hours", ""), now)
 
-    # Sort pharmacies by 'total_sum' in ascending order
-    sorted_pharmacies = sorted(pharmacies_list, key=lambda x: x["pharmacy"]["total_sum"])
 
-    # Get the top 1 pharmacy with the lowest 'total_sum'
-    cheapest_pharmacies = sorted_pharmacies  # Adjust slice if you want more than one
+def prefilter_open_pharmacies(pharmacies, encoded_city, now=None):
+    """Убирает из списка записей аптек закрытые по pharmacy_status, так что отброшенная здесь аптека
+    не могла бы оказаться открытой в best_option, и наоборот. Исходный список не меняется."""
+    now = now or datetime.now(ALMATY_TZ)
+    return [pharmacy for pharmacy in pharmacies if not pharmacy_status(pharmacy.source.raw, now, encoded_city)[0]]
 
-    return {"list_pharmacies": cheapest_pharmacies}
 
+def build_delivery_items(pharmacy):
+    """Формирует список товаров для расчета доставки с учетом аналогов."""
+    items = []
+    for product in pharmacy.get("products", []):
+        if product["quantity"] >= product["quantity_desired"]:
+            items.append({"sku": product["sku"], "quantity": product["quantity_desired"]})
+        elif "analogs" in product and product["analogs"]:
+            cheapest_analog = min(product["analogs"], key=lambda analog: analog["base_price"])
+            items.append({"sku": cheapest_analog["sku"], "quantity": product["quantity_desired"]})
+    return items
 
-async def get_top_closest_pharmacies(pharmacies, user_lat, user_lon):
-    # Create a list of pharmacies with their distance from the user
-    pharmacies_with_distance = []
-    
-    for item in pharmacies.get("list_pharmacies", []):
-        # Access the 'pharmacy' and 'source' dictionaries safely
-        pharmacy = item.get("pharmacy", {})
-        source = pharmacy.get("source", {})
-        pharmacy_lat = source.get("lat")
-        pharmacy_lon = source.get("lon")
-        
-        # Check if lat/lon exist before calculating the distance
-        if pharmacy_lat is None or pharmacy_lon is None:
-            continue  # Skip if lat/lon is missing
 
-        # Calculate Euclidean distance
-        distance = haversine_distance(user_lat, user_lon, pharmacy_lat, pharmacy_lon)
-        
-        # Add the pharmacy and its distance to the list
-        pharmacies_with_distance.append({"pharmacy": pharmacy, "distance": distance})
-    
-    # Sort pharmacies by distance
-    sorted_pharmacies = sorted(pharmacies_with_distance, key=lambda x: x["distance"])
-    
-    # Get the top 2 closest pharmacies
-    closest_pharmacies = [item["pharmacy"] for item in sorted_pharmacies[:3]]
-    
-    return {"list_pharmacies": closest_pharmacies}
+async def fetch_delivery_quote(pharmacy, user_lat, user_lon, semaphore, shared_quotes=None, deadline=None):
+    """Запрашивает варианты доставки для одной аптеки. Возвращает список опций или JSONResponse с ошибкой."""
+    source = pharmacy.get("source", {})
+    if "code" not in source:
+        return []
 
+    pharmacy_total_sum = pharmacy.get("total_sum", 0)
+    items = build_delivery_items(pharmacy)
+    if not items:
+        return []
 
-#Algorithm to determine distance in 2 dimensions
-def haversine_distance(lat1, lon1, lat2, lon2):
-    distance = math.sqrt((lat2 - lat1) ** 2 + (lon2 - lon1) ** 2)
-    return distance
+    logger.debug("Delivery items for %s: %s", source["code"], items)
+    key = quote_cache_key(source["code"], items, user_lat, user_lon)
 
+    async def request_quote(quote_deadline):
+        delivery_options = await request_delivery_quote(source["code"], items, user_lat, user_lon, semaphore,
+                                                        quote_deadline)
+        if QUOTE_ESTIMATOR_ENABLED and not isinstance(delivery_options, JSONResponse):
+            quote_estimator.observe(source, user_lat, user_lon, len(items), delivery_options)
+        return delivery_options
+
+    async def load_quote():
+        if QUOTE_CACHE_ENABLED:
+            # Общая загрузка ограничена только PRICE_QUOTE_TIMEOUT: запрос с большим бюджетом не должен
+            # получить таймаут из-за дедлайна первого ожидающего. Свой дедлайн соблюдает get_delivery_options
+            return await quote_cache.get_or_load(key, lambda: request_quote(None))
+        return await request_quote(deadline)
+
+    # Внутри батча одинаковые котировки запрашиваются один раз
+    delivery_options = await shared_call(shared_quotes, key, load_quote)
+
+    if isinstance(delivery_options, JSONResponse):
+        delivery_options = quote_fallback(key, delivery_options)
+        if isinstance(delivery_options, JSONResponse):
+            return delivery_options
+    elif "cache" in PRICE_FALLBACKS:
+        quote_fallback_cache.set(key, delivery_options)
+
+    return [
+        {
+            "pharmacy": pharmacy,
+            "total_price": pharmacy_total_sum + option["price"],
+            "delivery_option": option
+        }
+        for option in delivery_options
+    ]
 
-def is_pharmacy_open_soon(closes_at, opens_at, opening_hours):
-    """Проверяет, закроется ли аптека через 1 час или если аптека работает круглосуточно."""
-    almaty_tz = pytz.timezone('Asia/Almaty')
-    current_time = datetime.now(almaty_tz)
 
-    # Мок для тестов (замените на текущую дату при работе в продакшн)
-    # current_time = almaty_tz.localize(datetime(2024, 10, 22, 2, 30, 0))
+def quote_fallback(key, error):
+    """Замена неудавшейся котировки согласно PRICE_FALLBACK: сохраненная котировка, пустой список
+    (аптека исключается) или исходная ошибка."""
+    for fallback in PRICE_FALLBACKS:
+        if fallback == "cache":
+            cached = quote_fallback_cache.get(key)
+            if cached is not None:
+                price_fallbacks.inc("cache")
+                return cached
+        elif fallback == "drop":
+            price_fallbacks.inc("drop")
+            return []
+    return error
 
-    # Проверка для круглосуточных аптек
-    if opening_hours == "Круглосуточно":
-        return False  # Круглосуточная аптека не закроется скоро
+
+async def request_delivery_quote(source_code, items, user_lat, user_lon, semaphore, deadline=None):
+    """Запрос к URL_PRICE. Возвращает список вариантов доставки или JSONResponse с ошибкой.
+    Таймауты вызова ограничены оставшимся бюджетом запроса (deadline)."""
+    # Формируем запрос для расчета доставки
+    payload = {
+        "items": items,
+        "dst": {
+            "lat": user_lat,
+            "lng": user_lon
+        },
+        "source_code": source_code
+    }
 
     try:
-        # Конвертация времени открытия и закрытия
-        closes_time = datetime.strptime(closes_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
-        opens_time = datetime.strptime(opens_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
-    except ValueError as e:
-        logger.error(f"Time opens\closes parsing error: {e}")
-        return True  # Если ошибка, считаем, что аптека закрыта для избежания ошибок
+        async with semaphore:
+            # Бюджет проверяется после ожидания слота: время в очереди тоже расходует бюджет
+            quote_deadline = time.monotonic() + PRICE_QUOTE_TIMEOUT
+            if deadline is not None:
+                quote_deadline = min(quote_deadline, deadline)
+            if remaining_budget(quote_deadline) == 0:
+                raise asyncio.TimeoutError
+            call_timeout = budget_timeout(UPSTREAM_TIMEOUTS["price"], deadline)
+            response = await hedged_upstream_post(
+                "price", URL_PRICE, quote_deadline, json=payload,
+                timeout=httpx.Timeout(call_timeout, connect=min(call_timeout, HTTP_CONNECT_TIMEOUT)),
+            )
+        response.raise_for_status()
+        delivery_data = response.json()
 
-    # Проверяем, если аптека еще не открылась
-    if current_time < opens_time:
-        return False  # Если аптека еще не открылась, она не закроется скоро
+        logger.debug("Response from URL_PRICE: %s", delivery_data)
 
-    # Проверка, закроется ли аптека через 1 час или меньше
-    return timedelta(0) <= closes_time - current_time <= timedelta(hours=1)
+        if delivery_data.get("status") != "success":
+            logger.error(f"Unexpected response format from URL_PRICE API: {delivery_data}")
+            return JSONResponse(
+                content={"error": "Unexpected response format from URL_PRICE API", "details": delivery_data},
+                status_code=502
+            )
 
+        return delivery_data["result"]["delivery"]
 
-def is_pharmacy_closed(closes_at, opens_at, opening_hours):
-    """Проверяет, закрыта ли аптека на момент запроса, учитывая расписание."""
-    almaty_tz = pytz.timezone('Asia/Almaty')
-    current_time = datetime.now(almaty_tz)
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout while accessing URL_PRICE for pharmacy {source_code}")
+        return JSONResponse(content={"error": "Timeout while accessing URL_PRICE"}, status_code=504)
 
-    # Мок для тестов (замените на текущую дату при работе в продакшн)
-    # current_time = almaty_tz.localize(datetime(2024, 10, 22, 2, 30, 0))
+    except CircuitOpenError:
+        return JSONResponse(content={"error": "URL_PRICE is temporarily unavailable (circuit breaker open)"},
+                            status_code=503)
 
-    # Проверка, если аптека круглосуточная
-    if opening_hours == "Круглосуточно":
-        return False
+    except httpx.RequestError as e:
+        logger.error(f"Request error while accessing URL_PRICE: {e}")
+        return JSONResponse(content={"error": "Request error while accessing URL_PRICE", "details": str(e)},
+                            status_code=502)
 
-    try:
-        # Конвертация времени открытия и закрытия
-        closes_time = datetime.strptime(closes_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
-        opens_time = datetime.strptime(opens_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC).astimezone(almaty_tz)
-    except ValueError as e:
-        logger.error(f"Time opens\closes parsing error: {e}")
-        return True  # Если ошибка, считаем, что аптека закрыта для избежания ошибок
+    except httpx.HTTPStatusError as e:
+        error_details = e.response.json() if e.response.content else {"error": str(e)}
+        logger.error(f"HTTP error while accessing URL_PRICE: {e}")
+        return JSONResponse(
+            content={
+                "error": f"HTTP error {e.response.status_code}",
+                "details": error_details
+            },
+            status_code=e.response.status_code
+        )
 
-    # Проверка если аптека закрыта сейчас и еще не открылась
-    if current_time < opens_time:
-        return True
 
-    # Проверка если аптека уже закрылась, но еще не наступило новое время открытия
-    if current_time >= closes_time and current_time < (opens_time + timedelta(days=1)):
-        return True
+def describe_quote(pharmacy, quote):
+    """Краткое описание котировки аптеки для потокового ответа (без полного объекта аптеки)."""
+    code = pharmacy.get("source", {}).get("code")
+    if isinstance(quote, JSONResponse):
+        return {"pharmacy_code": code, "status": quote.status_code, **json.loads(quote.body.decode("utf-8"))}
+    return {
+        "pharmacy_code": code,
+        "options": [{"total_price": option["total_price"], "delivery_option": option["delivery_option"]} for option in quote],
+    }
 
-    # Если текущее время находится в пределах открытия и закрытия
-    return not (opens_time <= current_time < closes_time)
 
+class QuoteEstimator:
+    """Оценка котировки URL_PRICE - самой низкой цены и самого короткого времени доставки среди
+    вариантов - по наблюдениям (код аптеки, расстояние, число товаров, час суток) -> (цена, время).
+    Модель - линейная регрессия по расстоянию, числу товаров и часу суток плюс поправка аптеки
+    (средний остаток, сжатый к нулю, пока наблюдений по аптеке мало). Переобучается в фоне раз в
+    QUOTE_ESTIMATOR_REFIT_INTERVAL секунд на последних QUOTE_ESTIMATOR_WINDOW наблюдениях."""
 
-async def get_delivery_options(pharmacies, user_lat, user_lon):
-    """Функция возвращает все данные о доставке для аптек без принятия решений."""
+    SHRINKAGE = 5  # при стольких наблюдениях поправка аптеки весит наполовину
+    RIDGE = 1e-3
 
-    # Проверка на наличие аптек
-    if not pharmacies.get("list_pharmacies"):
-        return JSONResponse(content={"error": "No pharmacies available for delivery options"}, status_code=404)
+    def __init__(self):
+        self.observations = deque(maxlen=QUOTE_ESTIMATOR_WINDOW)
+        self.new_observations = 0
+        self.model = None
+        self.fits = 0
+        self.fitted_at = None
+        self.refit_task = None
+        self.requests = 0
+        # Ошибка текущей модели на котировках, полученных после ее обучения
+        self.errors = {"price": 0.0, "eta": 0.0, "count": 0}
+        self.shadow = {"requests": 0, "cheapest_hits": 0, "fastest_hits": 0, "price_regret": 0.0, "eta_regret": 0.0}
 
-    results = []
+    @property
+    def ready(self):
+        return self.model is not None
 
-    for pharmacy in pharmacies["list_pharmacies"]:
-        source = pharmacy.get("source", {})
-        products = pharmacy.get("products", [])
+    @staticmethod
+    def features(distance, items, hour):
+        angle = 2 * math.pi * hour / 24
+        return 1.0, distance, items, math.sin(angle), math.cos(angle)
 
-        if "code" not in source:
-            continue
+    def observe(self, source, user_lat, user_lon, items, delivery_options, now=None):
+        """Записывает котировку, полученную от URL_PRICE."""
+        if not delivery_options or source.get("lat") is None or source.get("lon") is None:
+            return
+        distance = haversine_distance(user_lat, user_lon, source["lat"], source["lon"])
+        hour = (now or datetime.now(ALMATY_TZ)).hour
+        price = min(option["price"] for option in delivery_options)
+        eta = min(option["eta"] for option in delivery_options)
+        if self.model is not None:
+            predicted_price, predicted_eta = self.predict(source.get("code"), distance, items, hour)
+            self.errors["price"] += abs(predicted_price - price)
+            self.errors["eta"] += abs(predicted_eta - eta)
+            self.errors["count"] += 1
+        self.observations.append((source.get("code"), distance, items, hour, price, eta))
+        self.new_observations += 1
 
-        pharmacy_total_sum = pharmacy.get("total_sum", 0)
+    def fit(self, observations):
+        """Обучает модель на списке наблюдений (выполняется в отдельном потоке)."""
+        codes = [observation[0] for observation in observations]
+        X = np.array([self.features(*observation[1:4]) for observation in observations])
+        Y = np.array([observation[4:6] for observation in observations], dtype=float)
+        coefficients = np.linalg.solve(X.T @ X + self.RIDGE * np.eye(X.shape[1]), X.T @ Y)  # столбцы: цена, время
+        residuals = Y - X @ coefficients
+        sums = defaultdict(lambda: np.zeros(2))
+        counts = defaultdict(int)
+        for code, residual in zip(codes, residuals):
+            sums[code] += residual
+            counts[code] += 1
+        offsets = {code: sums[code] / (counts[code] + self.SHRINKAGE) for code in sums}
+        fitted = X @ coefficients + np.array([offsets[code] for code in codes])
+        return {"coefficients": coefficients, "offsets": offsets, "train_mae": np.abs(Y - fitted).mean(axis=0)}
 
-        # Формирование списка товаров с учетом аналогов
-        items = []
-        for product in products:
-            if product["quantity"] >= product["quantity_desired"]:
-                items.append({"sku": product["sku"], "quantity": product["quantity_desired"]})
-            elif "analogs" in product and product["analogs"]:
-                cheapest_analog = min(product["analogs"], key=lambda analog: analog["base_price"])
-                items.append({"sku": cheapest_analog["sku"], "quantity": product["quantity_desired"]})
+    def predict(self, code, distance, items, hour):
+        estimate = np.array(self.features(distance, items, hour)) @ self.model["coefficients"]
+        offset = self.model["offsets"].get(code)
+        if offset is not None:
+            estimate = estimate + offset
+        return float(estimate[0]), float(estimate[1])
 
-        if not items:
-            continue
+    def mae(self):
+        """Средняя ошибка (цена, время): на новых котировках, а пока их нет - на обучающих данных."""
+        count = self.errors["count"]
+        if count:
+            return self.errors["price"] / count, self.errors["eta"] / count
+        return tuple(float(value) for value in self.model["train_mae"])
+
+    def choose(self, candidates, user_lat, user_lon, now=None, encoded_city=None):
+        """Из ранжируемых кандидатов (Candidate) оставляет тех, кто по оценке может оказаться самым
+        дешевым (total_sum + доставка) или самым быстрым с запасом QUOTE_ESTIMATOR_MARGIN средних ошибок, -
+        не больше QUOTE_ESTIMATOR_MAX_QUOTES, в исходном порядке. Закрытые и закрывающиеся в течение часа
+        аптеки (как в best_option) не ранжируются, если есть другие."""
+        if not candidates:
+            return candidates
+        now = now or datetime.now(ALMATY_TZ)
+        hour = now.hour
+        lasting = [candidate for candidate in candidates
+                   if not any(pharmacy_status(candidate.source.raw, now, encoded_city))]
+        ranked_candidates = lasting or candidates
+        estimates = []
+        for candidate in ranked_candidates:
+            price, eta = self.predict(candidate.source.code, candidate_distance(candidate, user_lat, user_lon),
+                                      len(candidate.pharmacy.products), hour)
+            estimates.append((candidate.total_sum + price, eta))
+        best_total = min(total for total, _ in estimates)
+        best_eta = min(eta for _, eta in estimates)
+        price_tolerance, eta_tolerance = (max(QUOTE_ESTIMATOR_MARGIN * error, 1e-9) for error in self.mae())
+        # Отставание от лучшей оценки в долях допуска; правдоподобны кандидаты с отставанием не больше 1
+        slack = [min((total - best_total) / price_tolerance, (eta - best_eta) / eta_tolerance) for total, eta in estimates]
+        ranked = sorted(range(len(ranked_candidates)), key=slack.__getitem__)
+        chosen = {id(ranked_candidates[index]) for index in ranked[:QUOTE_ESTIMATOR_MAX_QUOTES] if slack[index] <= 1}
+
+        self.requests += 1
+        quote_estimator_decisions.inc("quoted", amount=len(chosen))
+        quote_estimator_decisions.inc("skipped", amount=len(candidates) - len(chosen))
+        return [candidate for candidate in candidates if id(candidate) in chosen]
+
+    def evaluate(self, delivery_options, chosen_codes):
+        """Теневая проверка: котировки получены для всех ранжированных аптек. Записывает, попали ли самая
+        дешевая и самая быстрая из них в выбор оценки и насколько выбор оценки хуже. Возвращает варианты
+        только выбранных аптек, чтобы ответ не отличался от обычного."""
+        if not delivery_options:
+            return delivery_options
+        chosen = [option for option in delivery_options if option["pharmacy"]["source"].get("code") in chosen_codes]
+        self.shadow["requests"] += 1
+        if not chosen:
+            return delivery_options  # Выбранные аптеки не ответили - отвечаем по всем
+        best_price = min(option["total_price"] for option in delivery_options)
+        best_eta = min(option["delivery_option"]["eta"] for option in delivery_options)
+        chosen_price = min(option["total_price"] for option in chosen)
+        chosen_eta = min(option["delivery_option"]["eta"] for option in chosen)
+        self.shadow["cheapest_hits"] += chosen_price <= best_price
+        self.shadow["fastest_hits"] += chosen_eta <= best_eta
+        self.shadow["price_regret"] += chosen_price - best_price
+        self.shadow["eta_regret"] += chosen_eta - best_eta
+        return chosen
+
+    def start(self):
+        if self.refit_task is None or self.refit_task.done():
+            self.refit_task = asyncio.create_task(self.refit_loop())
+
+    async def refit_loop(self):
+        while True:
+            await asyncio.sleep(QUOTE_ESTIMATOR_REFIT_INTERVAL)
+            await self.refit()
+
+    async def refit(self):
+        if not self.new_observations or len(self.observations) < QUOTE_ESTIMATOR_MIN_SAMPLES:
+            return
+        self.new_observations = 0
+        try:
+            model = await asyncio.to_thread(self.fit, list(self.observations))
+        except np.linalg.LinAlgError as e:
+            logger.error(f"Quote estimator refit failed: {e}")
+            return
+        self.model = model
+        self.fits += 1
+        self.fitted_at = time.monotonic()
+        self.errors = {"price": 0.0, "eta": 0.0, "count": 0}
 
-        print(f"items: {items}")
-        # Формируем запрос для расчета доставки
-        payload = {
-            "items": items,
-            "dst": {
-                "lat": user_lat,
-                "lng": user_lon
+    def stats(self):
+        quoted = quote_estimator_decisions.series.get(("quoted",), 0)
+        skipped = quote_estimator_decisions.series.get(("skipped",), 0)
+        shadow_requests = self.shadow["requests"]
+        mae = self.mae() if self.ready else (None, None)
+        return {
+            "enabled": QUOTE_ESTIMATOR_ENABLED,
+            "ready": self.ready,
+            "observations": len(self.observations),
+            "fits": self.fits,
+            "fitted_seconds_ago": round(time.monotonic() - self.fitted_at, 1) if self.fitted_at else None,
+            "mae": {"price": mae[0], "eta": mae[1], "fresh_quotes": self.errors["count"]},
+            # Сколько котировок запрошено на корзину против CLOSEST_PHARMACIES_LIMIT без оценки
+            "requests": self.requests,
+            "quotes_per_request": round(quoted / self.requests, 3) if self.requests else None,
+            "baseline_quotes_per_request": CLOSEST_PHARMACIES_LIMIT,
+            "skipped_ratio": round(skipped / (quoted + skipped), 4) if quoted + skipped else None,
+            # Потеря точности по теневым запросам: как часто выбор оценки содержит лучшую аптеку и насколько хуже
+            "shadow": {
+                "requests": shadow_requests,
+                "cheapest_hit_rate": round(self.shadow["cheapest_hits"] / shadow_requests, 4) if shadow_requests else None,
+                "fastest_hit_rate": round(self.shadow["fastest_hits"] / shadow_requests, 4) if shadow_requests else None,
+                "mean_price_regret": round(self.shadow["price_regret"] / shadow_requests, 2) if shadow_requests else None,
+                "mean_eta_regret": round(self.shadow["eta_regret"] / shadow_requests, 2) if shadow_requests else None,
             },
-            "source_code": source["code"]
         }
 
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(URL_PRICE, json=payload)
-                response.raise_for_status()
-                delivery_data = response.json()
-
-                logger.info(f"Response from URL_PRICE: {delivery_data}")
-
-                if delivery_data.get("status") == "success":
-                    delivery_options = delivery_data["result"]["delivery"]
-
-                    for option in delivery_options:
-                        results.append({
-                            "pharmacy": pharmacy,
-                            "total_price": pharmacy_total_sum + option["price"],
-                            "delivery_option": option
-                        })
-                else:
-                    logger.error(f"Unexpected response format from URL_PRICE API: {delivery_data}")
-                    return JSONResponse(
-                        content={"error": "Unexpected response format from URL_PRICE API", "details": delivery_data},
-                        status_code=502
-                    )
-
-            except httpx.RequestError as e:
-                logger.error(f"Request error while accessing URL_PRICE: {e}")
-                return JSONResponse(content={"error": "Request error while accessing URL_PRICE", "details": str(e)},
-                                    status_code=502)
-
-            except httpx.HTTPStatusError as e:
-                error_details = e.response.json() if e.response.content else {"error": str(e)}
-                logger.error(f"HTTP error while accessing URL_PRICE: {e}")
-                return JSONResponse(
-                    content={
-                        "error": f"HTTP error {e.response.status_code}",
-                        "details": error_details
-                    },
-                    status_code=e.response.status_code
-                )
+
+quote_estimator = QuoteEstimator()
+
+
+@app.on_event("startup")
+async def start_quote_estimator():
+    if QUOTE_ESTIMATOR_ENABLED:
+        quote_estimator.start()
+
+
+@app.on_event("shutdown")
+async def stop_quote_estimator():
+    if quote_estimator.refit_task is not None:
+        quote_estimator.refit_task.cancel()
+
+
+@app.get("/quote_estimator_stats")
+async def quote_estimator_stats():
+    return quote_estimator.stats()
+
+
+class QuotePrefetcher:
+    """Упреждающие запросы котировок для предварительного шорт-листа (PIPELINE_MODE=pipelined).
+    Аптеки, попавшие в шорт-лист, запрашиваются сразу, выпавшие из него - отменяются (загрузка в кэш
+    котировок при этом доживает в фоне, см. TTLCache.get_or_load).
+    Всего запускается не больше closest_limit + QUOTE_PREFETCH_MAX_EXTRA запросов, так что лишних
+    вызовов URL_PRICE не больше QUOTE_PREFETCH_MAX_EXTRA; недостающие котировки итогового шорт-листа
+    запрашиваются как обычно."""
+
+    def __init__(self, user_lat, user_lon, shared_quotes=None, deadline=None, closest_limit=None):
+        closest_limit = CLOSEST_PHARMACIES_LIMIT if closest_limit is None else closest_limit
+        self.user_lat = user_lat
+        self.user_lon = user_lon
+        self.shared_quotes = shared_quotes
+        self.deadline = deadline
+        # Общий с get_delivery_options семафор: вместе не больше PRICE_CONCURRENCY запросов
+        self.semaphore = asyncio.Semaphore(PRICE_CONCURRENCY)
+        self.budget = closest_limit + QUOTE_PREFETCH_MAX_EXTRA
+        self.started = {}  # Candidate -> (аптека в публичном формате, задача котировки)
+
+    def update(self, candidates):
+        """Приводит запущенные запросы к предварительному шорт-листу. Возвращает True, если запущены новые."""
+        for candidate in [candidate for candidate in self.started if candidate not in candidates]:
+            self._cancel(candidate)
+        started_any = False
+        for candidate in candidates:
+            if candidate in self.started or self.budget <= 0:
+                continue
+            self.budget -= 1
+            pharmacy = candidate.to_json()
+            task = asyncio.ensure_future(fetch_delivery_quote(pharmacy, self.user_lat, self.user_lon, self.semaphore,
+                                                              self.shared_quotes, self.deadline))
+            self.started[candidate] = (pharmacy, task)
+            quote_prefetches.inc("started")
+            started_any = True
+        return started_any
+
+    def finalize(self, candidates):
+        """Итоговый шорт-лист: {"list_pharmacies": [...]} в публичном формате и уже запущенные котировки
+        {код аптеки: задача} для get_delivery_options. Остальные упреждающие запросы отменяются."""
+        self.update(candidates)
+        list_pharmacies = []
+        prefetched = {}
+        for candidate in candidates:
+            if candidate not in self.started:
+                list_pharmacies.append(candidate.to_json())
+                continue
+            pharmacy, _ = self.started[candidate]
+            list_pharmacies.append(pharmacy)
+            if candidate.source.code not in prefetched:
+                prefetched[candidate.source.code] = self.started.pop(candidate)[1]
+                quote_prefetches.inc("used")
+        self.cancel()
+        return {"list_pharmacies": list_pharmacies}, prefetched
+
+    def cancel(self):
+        for candidate in list(self.started):
+            self._cancel(candidate)
+
+    def _cancel(self, candidate):
+        _, task = self.started.pop(candidate)
+        if task.done():
+            if not task.cancelled():
+                task.exception()  # Результат не нужен, но исключение не должно попасть в лог как необработанное
+        else:
+            task.cancel()
+        quote_prefetches.inc("cancelled")
+
+
+def cancel_prefetched(prefetched):
+    for task in prefetched.values():
+        task.cancel()
+
+
+async def get_delivery_options(pharmacies, user_lat, user_lon, shared_quotes=None, on_quote=None, deadline=None,
+                               quote_stats=None, semaphore=None, prefetched=None):
+    """Функция возвращает все данные о доставке для аптек без принятия решений.
+    on_quote(quote) вызывается для каждой аптеки сразу по получении ее котировки.
+    Котировки, не полученные к deadline, отбрасываются; в quote_stats (если передан) записывается,
+    сколько котировок запрошено, получено, опоздало и завершилось ошибкой.
+    prefetched - уже запущенные котировки {код аптеки: задача} (см. QuotePrefetcher)."""
+    prefetched = dict(prefetched or {})
+
+    # Проверка на наличие аптек
+    if not pharmacies.get("list_pharmacies"):
+        cancel_prefetched(prefetched)
+        return JSONResponse(content={"error": "No pharmacies available for delivery options"}, status_code=404)
+
+    # Запросы котировок выполняются параллельно, но не более PRICE_CONCURRENCY одновременно
+    semaphore = semaphore or asyncio.Semaphore(PRICE_CONCURRENCY)
+    async def fetch_and_report(pharmacy):
+        task = prefetched.pop(pharmacy.get("source", {}).get("code"), None)
+        if task is not None:
+            quote = await task
+        else:
+            quote = await fetch_delivery_quote(pharmacy, user_lat, user_lon, semaphore, shared_quotes, deadline)
+        if on_quote is not None:
+            on_quote(describe_quote(pharmacy, quote))
+        return quote
+
+    tasks = [asyncio.ensure_future(fetch_and_report(pharmacy)) for pharmacy in pharmacies["list_pharmacies"]]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=remaining_budget(deadline))
+    finally:
+        # Опоздавшие котировки (и все котировки при отмене запроса) не ждем
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        cancel_prefetched(prefetched)  # Котировки, до которых задачи не успели дойти
+    quotes = [task.result() for task in tasks if task in done]
+
+    results = []
+    errors = []
+    for quote in quotes:
+        if isinstance(quote, JSONResponse):
+            errors.append(quote)
+        else:
+            results.extend(quote)
+
+    if quote_stats is not None:
+        quote_stats.update(requested=len(tasks), received=len(quotes) - len(errors), failed=len(errors),
+                           late=len(pending))
+    if pending:
+        logger.warning(f"{len(pending)} of {len(tasks)} delivery quotes missed the request deadline")
+        # Без частичных результатов выбор по неполному шорт-листу не отдается
+        if not PRICE_PARTIAL_RESULTS or (not results and not errors):
+            return deadline_exceeded_response()
+
+    if errors:
+        # В режиме частичных результатов ошибка одной аптеки не валит весь запрос
+        if not PRICE_PARTIAL_RESULTS or not results:
+            return errors[0]
+        logger.warning(f"{len(errors)} of {len(quotes)} delivery quotes failed, continuing with partial results")
 
     return results
 
 
-async def best_option(delivery_data):
-    """Функция для сравнения аптек и выбора лучших опций с учетом времени закрытия, цены и условий."""
+async def best_option(delivery_data, now=None, encoded_city=None):
+    """Функция для сравнения аптек и выбора лучших опций с учетом времени закрытия, цены и условий.
+    Статус работы каждой аптеки считается один раз на момент now (по умолчанию - текущее время),
+    все победители выбираются за один проход по delivery_data. Расписания берутся из индекса города
+    encoded_city: один код аптеки в разных городах может означать разные аптеки."""
 
     # Проверка наличия данных о доставке
     if not delivery_data:
@@ -525,120 +3695,73 @@ async def best_option(delivery_data):
         if "pharmacy" not in option or "total_price" not in option or "delivery_option" not in option:
             return JSONResponse(content={"error": "Invalid delivery option data format"}, status_code=502)
 
-    cheapest_open_pharmacy = None
-    cheapest_closed_pharmacy = None
-    alternative_cheapest_option = None
+    now = now or datetime.now(ALMATY_TZ)
+    statuses = {}  # code -> (closed, closes_soon)
 
+    cheapest_open_pharmacy = None
     fastest_open_pharmacy = None
+    # Лучшие открытые аптеки, которые не закрываются в ближайший час (альтернативы)
+    cheapest_lasting_pharmacy = None
+    fastest_lasting_pharmacy = None
+    # Лучшие закрытые аптеки (кандидаты на "на 30% выгоднее")
+    cheapest_closed_pharmacy = None
     fastest_closed_pharmacy = None
-    alternative_fastest_option = None
 
-    # Первый проход для выбора самой дешевой и самой быстрой открытых аптек
     for option in delivery_data:
-        pharmacy = option.get("pharmacy", {})
-        source = pharmacy.get("source", {})
-        closes_at = source.get("closes_at")
-        opens_at = source.get("opens_at")
-        opening_hours = source.get("opening_hours", "")
-
+        source = option.get("pharmacy", {}).get("source", {})
         if 'code' not in source:
             logger.warning(f"Missing 'code' in pharmacy source: {source}")
             continue
 
-        pharmacy_closed = is_pharmacy_closed(closes_at, opens_at, opening_hours)
-        pharmacy_closes_soon = is_pharmacy_open_soon(closes_at, opens_at, opening_hours) if closes_at else False
-
-        if not pharmacy_closed:
-            # Самая дешевая открытая аптека
-            if cheapest_open_pharmacy is None or option["total_price"] < cheapest_open_pharmacy["total_price"]:
-                cheapest_open_pharmacy = option
-                if not pharmacy_closes_soon:
-                    alternative_cheapest_option = None
-                else:
-                    logger.info(f"Step 4: Pharmacy {source['code']} closes soon, looking for an alternative")
-                    # Ищем самую дешевую аптеку, которая не закрывается скоро
-                    if not alternative_cheapest_option:
-                        for alt_option in delivery_data:
-                            alt_pharmacy = alt_option.get("pharmacy", {})
-                            alt_source = alt_pharmacy.get("source", {})
-                            alt_closes_at = alt_source.get("closes_at")
-                            alt_opens_at = alt_source.get("opens_at")
-                            alt_opening_hours = alt_source.get("opening_hours", "")
-
-                            alt_pharmacy_closes_soon = is_pharmacy_open_soon(alt_closes_at, alt_opens_at, alt_opening_hours)
-                            alt_pharmacy_closed = is_pharmacy_closed(alt_closes_at, alt_opens_at, alt_opening_hours)
-
-                            # Логика для поиска самой дешевой альтернативы, которая не закрывается скоро
-                            if not alt_pharmacy_closes_soon and not alt_pharmacy_closed and \
-                                    (alternative_cheapest_option is None or alt_option["total_price"] <
-                                     alternative_cheapest_option["total_price"]):
-                                logger.info(
-                                    f"Step 5: Found alternative_cheapest_option with code {alt_source.get('code')}, works longer than 1 hour, and price {alt_option['total_price']}")
-                                alternative_cheapest_option = alt_option
-
-            # Самая быстрая открытая аптека
-            if fastest_open_pharmacy is None or option["delivery_option"]["eta"] < \
-                    fastest_open_pharmacy["delivery_option"]["eta"]:
-                fastest_open_pharmacy = option
-                if not pharmacy_closes_soon:
-                    alternative_fastest_option = None
-                else:
-                    logger.info(
-                        f"Step 4.1: Pharmacy {source['code']} closes soon, looking for an alternative fastest pharmacy")
-                    # Ищем самую быструю аптеку, которая не закрывается скоро
-                    if not alternative_fastest_option:
-                        for alt_option in delivery_data:
-                            alt_pharmacy = alt_option.get("pharmacy", {})
-                            alt_source = alt_pharmacy.get("source", {})
-                            alt_closes_at = alt_source.get("closes_at")
-                            alt_opens_at = alt_source.get("opens_at")
-                            alt_opening_hours = alt_source.get("opening_hours", "")
-
-                            alt_pharmacy_closes_soon = is_pharmacy_open_soon(alt_closes_at, alt_opens_at, alt_opening_hours)
-                            alt_pharmacy_closed = is_pharmacy_closed(alt_closes_at, alt_opens_at, alt_opening_hours)
-
-                            # Логика для поиска самой быстрой альтернативы, которая не закрывается скоро
-                            if not alt_pharmacy_closes_soon and not alt_pharmacy_closed and \
-                                    (alternative_fastest_option is None or alt_option["delivery_option"]["eta"] <
-                                     alternative_fastest_option["delivery_option"]["eta"]):
-                                logger.info(
-                                    f"Step 5.1: Found alternative_fastest_option with code {alt_source.get('code')}, works longer than 1 hour, and eta {alt_option['delivery_option']['eta']}")
-                                alternative_fastest_option = alt_option
-
-    # Второй проход для анализа закрытых аптек с учетом уже выбранных открытых аптек
-    for option in delivery_data:
-        pharmacy = option.get("pharmacy", {})
-        source = pharmacy.get("source", {})
-        closes_at = source.get("closes_at")
-        opens_at = source.get("opens_at")
-        opening_hours = source.get("opening_hours", "")
+        status = statuses.get(source["code"])
+        if status is None:
+            status = statuses[source["code"]] = pharmacy_status(source, now, encoded_city)
+        pharmacy_closed, pharmacy_closes_soon = status
+        price = option["total_price"]
+        eta = option["delivery_option"]["eta"]
 
-        if 'code' not in source:
+        if pharmacy_closed:
+            if cheapest_closed_pharmacy is None or price < cheapest_closed_pharmacy["total_price"]:
+                cheapest_closed_pharmacy = option
+            if fastest_closed_pharmacy is None or eta < fastest_closed_pharmacy["delivery_option"]["eta"]:
+                fastest_closed_pharmacy = option
             continue
 
-        pharmacy_closed = is_pharmacy_closed(closes_at, opens_at, opening_hours)
-
-        if pharmacy_closed and cheapest_open_pharmacy:
-            logger.info(
-                f"Checking closed pharmacy {source['code']} with total price {option['total_price']} against cheapest_open_pharmacy: {cheapest_open_pharmacy['total_price']}")
-
-            if option["total_price"] <= cheapest_open_pharmacy["total_price"] * 0.7:
-                if cheapest_closed_pharmacy is None or option["total_price"] < cheapest_closed_pharmacy["total_price"]:
-                    cheapest_closed_pharmacy = option
+        if cheapest_open_pharmacy is None or price < cheapest_open_pharmacy["total_price"]:
+            cheapest_open_pharmacy = option
+        if fastest_open_pharmacy is None or eta < fastest_open_pharmacy["delivery_option"]["eta"]:
+            fastest_open_pharmacy = option
 
-            logger.info(f"Closed pharmacy {source['code']} is not 30% cheaper than the open one.")
+        if not pharmacy_closes_soon:
+            if cheapest_lasting_pharmacy is None or price < cheapest_lasting_pharmacy["total_price"]:
+                cheapest_lasting_pharmacy = option
+            if fastest_lasting_pharmacy is None or eta < fastest_lasting_pharmacy["delivery_option"]["eta"]:
+                fastest_lasting_pharmacy = option
 
-        if pharmacy_closed and fastest_open_pharmacy:
-            logger.info(
-                f"Checking closed pharmacy {source['code']} with eta {option['delivery_option']['eta']} against fastest_open_pharmacy eta: {fastest_open_pharmacy['delivery_option']['eta']}")
+    def closes_soon(option):
+        return statuses[option["pharmacy"]["source"]["code"]][1]
 
-            if option["delivery_option"]["eta"] <= fastest_open_pharmacy["delivery_option"]["eta"] * 0.7:
-                if fastest_closed_pharmacy is None or option["delivery_option"]["eta"] < \
-                        fastest_closed_pharmacy["delivery_option"]["eta"]:
-                    fastest_closed_pharmacy = option
+    # Альтернатива нужна, только если лучшая открытая аптека закрывается в ближайший час
+    alternative_cheapest_option = None
+    if cheapest_open_pharmacy and closes_soon(cheapest_open_pharmacy):
+        logger.info(f"Pharmacy {cheapest_open_pharmacy['pharmacy']['source']['code']} closes soon, "
+                    f"alternative cheapest option: {cheapest_lasting_pharmacy and cheapest_lasting_pharmacy['pharmacy']['source']['code']}")
+        alternative_cheapest_option = cheapest_lasting_pharmacy
 
-            logger.info(f"Closed pharmacy {source['code']} is not 30% faster than the open one.")
+    alternative_fastest_option = None
+    if fastest_open_pharmacy and closes_soon(fastest_open_pharmacy):
+        logger.info(f"Pharmacy {fastest_open_pharmacy['pharmacy']['source']['code']} closes soon, "
+                    f"alternative fastest option: {fastest_lasting_pharmacy and fastest_lasting_pharmacy['pharmacy']['source']['code']}")
+        alternative_fastest_option = fastest_lasting_pharmacy
 
+    # Закрытая аптека предлагается, только если она на 30% дешевле (быстрее) лучшей открытой
+    if cheapest_closed_pharmacy and (not cheapest_open_pharmacy or
+                                     cheapest_closed_pharmacy["total_price"] > cheapest_open_pharmacy["total_price"] * 0.7):
+        cheapest_closed_pharmacy = None
+    if fastest_closed_pharmacy and (not fastest_open_pharmacy or
+                                    fastest_closed_pharmacy["delivery_option"]["eta"] >
+                                    fastest_open_pharmacy["delivery_option"]["eta"] * 0.7):
+        fastest_closed_pharmacy = None
 
     if cheapest_closed_pharmacy and cheapest_open_pharmacy:
         logger.info("Step 7: Returning both cheapest open and cheapest closed pharmacies due to 30% discount")
@@ -662,6 +3785,7 @@ async def best_option(delivery_data):
 
 #  функция для проверки выбранных на каждой стадии отбора аптек (сохраняет списки аптек в файлы локально)
 def save_response_to_file(data, file_name='data.json'):
+    """Возвращает True, если файл записан, и False при ошибке (она пишется в лог)."""
     try:
         # Проверяем, является ли data объектом JSONResponse
         if isinstance(data, JSONResponse):
@@ -673,9 +3797,108 @@ def save_response_to_file(data, file_name='data.json'):
         with open(file_name, 'w', encoding='utf-8') as file:
             json.dump(data, file, ensure_ascii=False, indent=4)
 
-        print(f"Данные успешно сохранены в файл: {file_name}")
+        logger.debug(f"Данные успешно сохранены в файл: {file_name}")
+        return True
     except Exception as e:
-        print(f"Ошибка при сохранении данных: {e}")
+        logger.error(f"Ошибка при сохранении данных в {file_name}: {e}")
+        return False
+
+
+# Дампы стадий пишутся фоновой задачей через ограниченную очередь, чтобы не блокировать event loop.
+# При переполнении очереди дамп отбрасывается. Последние трейсы доступны через /admin/traces.
+dump_queue = None
+dump_writer_task = None
+dump_stats = {"enqueued": 0, "written": 0, "failed": 0, "dropped": 0}
+recent_traces = deque(maxlen=DEBUG_TRACE_BUFFER_SIZE)
+
+
+def start_trace(request):
+    """Создает трейс запроса, если дампы включены глобально или заголовком X-Debug-Dump."""
+    header_value = request.headers.get(DEBUG_DUMP_HEADER, "").strip().lower()
+    if not DEBUG_DUMPS_ENABLED and header_value not in ("1", "true", "yes", "on"):
+        return None
+    trace = {
+        "request_id": uuid.uuid4().hex[:12],
+        "started_at": datetime.now(pytz.UTC).isoformat(),
+        "stages": {},
+    }
+    recent_traces.append(trace)
+    return trace
+
+
+def dump_stage(trace, data, file_name):
+    """Сохраняет результат стадии в трейс и ставит запись файла в фоновую очередь."""
+    if trace is None:
+        return
+    started = time.perf_counter()
+    if isinstance(data, JSONResponse):
+        data = json.loads(data.body.decode("utf-8"))
+    trace["stages"][file_name] = data
+    ensure_dump_writer()
+    path = os.path.join(DEBUG_DUMP_DIR, f"{trace['request_id']}_{file_name}")
+    try:
+        dump_queue.put_nowait((data, path))
+        dump_stats["enqueued"] += 1
+    except asyncio.QueueFull:
+        dump_stats["dropped"] += 1
+        logger.warning(f"Debug dump queue is full, dropping {path}")
+    stage_duration.observe(time.perf_counter() - started, "dump")
+
+
+def ensure_dump_writer():
+    global dump_queue, dump_writer_task
+    if dump_queue is None:
+        dump_queue = asyncio.Queue(maxsize=DEBUG_DUMP_QUEUE_SIZE)
+    if dump_writer_task is None or dump_writer_task.done():
+        dump_writer_task = asyncio.create_task(dump_writer())
+
+
+async def dump_writer():
+    try:
+        os.makedirs(DEBUG_DUMP_DIR, exist_ok=True)
+    except OSError as e:
+        # Файлы не запишутся, но очередь разбирается и ошибки попадают в счетчик failed
+        logger.error(f"Cannot create debug dump directory {DEBUG_DUMP_DIR}: {e}")
+    while True:
+        data, path = await dump_queue.get()
+        try:
+            if await asyncio.to_thread(save_response_to_file, data, path):
+                dump_stats["written"] += 1
+            else:
+                dump_stats["failed"] += 1
+        finally:
+            dump_queue.task_done()
+
+
+@app.on_event("shutdown")
+async def stop_dump_writer():
+    if dump_writer_task is None:
+        return
+    # Даем фоновой задаче дописать очередь перед остановкой
+    try:
+        await asyncio.wait_for(dump_queue.join(), timeout=5)
+    except asyncio.TimeoutError:
+        logger.warning(f"Debug dump writer stopped with {dump_queue.qsize()} dumps not written")
+    dump_writer_task.cancel()
+
+
+@app.get("/admin/traces")
+async def list_traces():
+    return {
+        "stats": {**dump_stats, "queued": dump_queue.qsize() if dump_queue else 0},
+        "traces": [
+            {"request_id": trace["request_id"], "started_at": trace["started_at"], "stages": list(trace["stages"])}
+            for trace in reversed(recent_traces)
+        ],
+    }
+
+
+@app.get("/admin/traces/{request_id}")
+async def get_trace(request_id: str):
+    for trace in recent_traces:
+        if trace["request_id"] == request_id:
+            return trace
+    return JSONResponse(content={"error": "Trace not found"}, status_code=404)
 
 
 # мок ручки для возврата тестовых результатов запроса поиска аптек
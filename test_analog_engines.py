@@ -0,0 +1,65 @@
+"""Движки подбора аналогов (ANALOG_ENGINE python и columnar) дают одинаковый результат.
+
+Запуск из корня репозитория: python -m pytest -q
+"""
+import copy
+
+import pytest
+
+import main
+from benchmarks.synthetic import generate_search_response
+
+
+def python_engine(records):
+    return main.candidates_json(main.iter_matched_pharmacies(records))
+
+
+def columnar_engine(records, columns=None):
+    return main.candidates_json(main.filter_with_analogs_columnar(records, columns)["filtered_pharmacies"])
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_engines_match_on_synthetic_responses(seed):
+    data = generate_search_response(pharmacies=seed * 7 + 1, skus=seed % 6 + 1, analog_depth=seed % 4,
+                                    stock_ratio=(0.2, 0.5, 0.8)[seed % 3], seed=seed)
+    records = main.parse_search_response(data)
+
+    assert columnar_engine(records) == python_engine(records)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_prebuilt_columns_match_on_subset(seed):
+    data = generate_search_response(pharmacies=60, skus=seed + 1, analog_depth=3, stock_ratio=0.4, seed=seed)
+    records = main.parse_search_response(data)
+    columns = main.AnalogColumns(records)
+    # Часть аптек ответа, как после prefilter_open_pharmacies
+    subset = records[seed::2]
+
+    assert columnar_engine(records, columns) == python_engine(records)
+    assert columnar_engine(subset, columns) == python_engine(subset)
+
+
+def test_engines_match_on_incomplete_records():
+    data = generate_search_response(pharmacies=40, skus=3, analog_depth=3, stock_ratio=0.3, seed=1)
+    broken = copy.deepcopy(data)
+    for index, pharmacy in enumerate(broken["result"]):
+        product = pharmacy["products"][index % len(pharmacy["products"])]
+        if index % 3 == 0:
+            del product["quantity"]
+        elif index % 3 == 1:
+            del product["quantity_desired"]
+        # Цена аналога, которого все равно не хватает, подбору не нужна
+        for analog in product.get("analogs") or []:
+            if analog["quantity"] < product.get("quantity_desired", 0):
+                del analog["base_price"]
+    records = main.parse_search_response(broken)
+
+    assert len(records) == len(broken["result"])
+    assert columnar_engine(records) == python_engine(records)
+    # Аптека с неполным товаром не собирает корзину ни в одном движке
+    codes = {pharmacy["source"]["code"] for pharmacy in python_engine(records)}
+    assert not codes & {pharmacy["source"]["code"] for pharmacy in broken["result"][::3]}
+
+
+def test_engines_match_on_empty_input():
+    assert columnar_engine([]) == python_engine([]) == []
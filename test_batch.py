@@ -0,0 +1,36 @@
+"""Пакетная ручка /best_analog/batch.
+
+Запуск из корня репозитория: python -m pytest -q
+"""
+import asyncio
+
+import httpx
+
+import main
+
+
+def test_full_batch_does_not_time_out_in_queue(monkeypatch):
+    basket_seconds = 0.05
+
+    async def process_basket(basket, shared_searches=None, shared_quotes=None, deadline=None):
+        # Корзина укладывается в свой бюджет, только если он не потрачен на ожидание слота
+        if main.remaining_budget(deadline) < basket_seconds:
+            return main.deadline_exceeded_response()
+        await asyncio.sleep(basket_seconds)
+        return {"index": basket["index"]}
+
+    monkeypatch.setattr(main, "process_basket", process_basket)
+    baskets = [{"index": index} for index in range(6 * main.BATCH_CONCURRENCY)]
+
+    async def post_batch():
+        async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+            # Бюджет хватает на одну корзину, но не на весь батч с очередью из шести волн
+            return await client.post("/best_analog/batch", json={"baskets": baskets},
+                                     headers={main.REQUEST_DEADLINE_HEADER: str(3 * basket_seconds)})
+
+    response = asyncio.run(post_batch())
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == [200] * len(baskets)
+    assert [result["result"]["index"] for result in results] == list(range(len(baskets)))
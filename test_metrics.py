@@ -0,0 +1,25 @@
+"""Рендер метрик /metrics в текстовом формате Prometheus.
+
+Запуск из корня репозитория: python -m pytest -q
+"""
+import main
+
+
+def render(metric):
+    lines = metric.render()
+    main.metrics_registry.remove(metric)
+    return lines
+
+
+def test_histogram_value_above_top_bucket():
+    histogram = main.Histogram("test_latency_seconds", "Test latency", buckets=(0.01, 1, 10))
+    histogram.observe(20.0)
+    histogram.observe(0.002)
+
+    lines = render(histogram)
+
+    assert "test_latency_seconds_bucket{le=\"0.01\"} 1" in lines
+    assert "test_latency_seconds_bucket{le=\"10\"} 1" in lines
+    assert "test_latency_seconds_bucket{le=\"+Inf\"} 2" in lines
+    assert "test_latency_seconds_sum 20.002" in lines
+    assert "test_latency_seconds_count 2" in lines